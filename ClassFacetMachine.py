@@ -56,6 +56,595 @@ MyLogger.setSilent("MyLogger")
 import cpuinfo
 from DDFacet.ToolsDir import ModFFTW
 import scipy.ndimage
+import os
+import shutil
+import tempfile
+import time
+import json
+import fnmatch
+import re
+import socket
+import errno
+import fcntl
+import multiprocessing
+import copy
+import hashlib
+import signal
+import sys
+import threading
+import weakref
+
+def _lockWisdomFile(WisdomFile, Exclusive=False):
+    """
+    Takes a flock on <WisdomFile>.lock (shared for readers, exclusive for writers), so that several
+    DDFacet processes on the same node type can read and update the wisdom store concurrently.
+    Returns the open lock file, close it to release the lock.
+    """
+    fh = open(WisdomFile + ".lock", "a")
+    fcntl.flock(fh, fcntl.LOCK_EX if Exclusive else fcntl.LOCK_SH)
+    return fh
+
+def _readWisdomFile(WisdomFile):
+    """Returns the wisdom dict stored in WisdomFile (or None), read under a shared lock"""
+    if not os.path.isfile(WisdomFile):
+        return None
+    fh = _lockWisdomFile(WisdomFile)
+    try:
+        return cPickle.load(file(WisdomFile))
+    except Exception, e:
+        print>>log, ModColor.Str("Could not read wisdom file %s (%s), ignoring it" % (WisdomFile, e))
+        return None
+    finally:
+        fh.close()
+
+def _mergeWisdomFile(WisdomFile, ListTypeKeys):
+    """
+    Merges the wisdom of the current process, learned for ListTypeKeys, into WisdomFile. The file is
+    re-read under an exclusive lock so that updates made meanwhile by other processes are kept, and
+    is replaced atomically (temporary file in the same directory + rename).
+    """
+    fh = _lockWisdomFile(WisdomFile, Exclusive=True)
+    try:
+        DictWisdom = None
+        if os.path.isfile(WisdomFile):
+            try:
+                DictWisdom = cPickle.load(file(WisdomFile))
+            except Exception:
+                DictWisdom = None
+        WisdomTypes = []
+        if DictWisdom is not None:
+            pyfftw.import_wisdom(DictWisdom["Wisdom"])
+            WisdomTypes = list(DictWisdom["WisdomTypes"])
+        for TypeKey in ListTypeKeys:
+            if TypeKey not in WisdomTypes:
+                WisdomTypes.append(TypeKey)
+        DictWisdom = {"Wisdom": pyfftw.export_wisdom(),
+                      "WisdomTypes": WisdomTypes}
+        fd, tmpname = tempfile.mkstemp(prefix=".Wisdom.", dir=os.path.dirname(WisdomFile))
+        with os.fdopen(fd, "w") as tmpfile:
+            cPickle.dump(DictWisdom, tmpfile)
+        os.rename(tmpname, WisdomFile)
+    finally:
+        fh.close()
+
+def _learnWisdomKey(TypeKey):
+    """Pool worker: learns the wisdom for one (size, dtype) key and returns the key and the wisdom"""
+    ModFFTW.learnFFTWWisdom(*TypeKey)
+    return TypeKey, pyfftw.export_wisdom()
+
+def _learnWisdomInBackground(WisdomFile, ListTypeKeys, NCPU):
+    """
+    Body of the background wisdom process: learns the missing sizes over a small pool of processes,
+    merging each size into the wisdom store as soon as it is learned. If terminated (see
+    ClassFacetMachine.awaitWisdom()), the pool is torn down and only the sizes still being learned
+    are lost; the store is only ever replaced atomically.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    if NCPU > 1 and len(ListTypeKeys) > 1:
+        pool = multiprocessing.Pool(min(NCPU, len(ListTypeKeys)))
+        try:
+            for TypeKey, Wisdom in pool.imap_unordered(_learnWisdomKey, ListTypeKeys):
+                pyfftw.import_wisdom(Wisdom)
+                _mergeWisdomFile(WisdomFile, [TypeKey])
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for TypeKey in ListTypeKeys:
+            ModFFTW.learnFFTWWisdom(*TypeKey)
+            _mergeWisdomFile(WisdomFile, [TypeKey])
+
+class ClassMemmapDict(object):
+    """
+    Out-of-core stand-in for a shared_dict of arrays (e.g. the facet grids). Each array lives in
+    its own .npy file under a scratch directory and is memory-mapped on first access. Instances
+    pickle to just the directory, so a worker only ever maps (and pages in) the arrays it touches.
+    Directories are named DDF.<name>.<host>.<pid>, so that those left behind by a crashed run can be
+    found and removed, see cleanStale().
+    """
+
+    def __init__(self, directory, name):
+        self.path = os.path.join(directory, "DDF.%s.%s.%i" % (name, socket.gethostname(), os.getpid()))
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._arrays = {}
+
+    @staticmethod
+    def cleanStale(directory):
+        """Removes the directories of this host whose process is gone (e.g. after a crash)"""
+        if not os.path.isdir(directory):
+            return
+        Host = socket.gethostname()
+        for Name in os.listdir(directory):
+            Fields = Name.split(".")
+            if len(Fields) < 4 or Fields[0] != "DDF" or Fields[-2] != Host or not Fields[-1].isdigit():
+                continue
+            pid = int(Fields[-1])
+            if pid == os.getpid():
+                continue
+            try:
+                os.kill(pid, 0)
+                continue
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    continue
+            print>>log, "removing stale scratch directory %s" % os.path.join(directory, Name)
+            shutil.rmtree(os.path.join(directory, Name), ignore_errors=True)
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._arrays = {}
+
+    def _filename(self, key):
+        return os.path.join(self.path, "%s.npy" % str(key))
+
+    def readonly(self):
+        return self
+
+    def readwrite(self):
+        return self
+
+    def reload(self):
+        pass
+
+    def keys(self):
+        return [int(f[:-4]) if f[:-4].isdigit() else f[:-4] for f in os.listdir(self.path) if f.endswith(".npy")]
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key))
+
+    def __getitem__(self, key):
+        if key not in self._arrays:
+            self._arrays[key] = np.lib.format.open_memmap(self._filename(key), mode="r+")
+        return self._arrays[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def addSharedArray(self, key, shape, dtype):
+        """Creates a new zeroed array. The file is sparse, so no disk space is used until it is written to"""
+        self._arrays[key] = np.lib.format.open_memmap(self._filename(key), mode="w+", dtype=dtype, shape=shape)
+        return self._arrays[key]
+
+    def zero(self, key):
+        """
+        Zeroes an array by replacing its file with a new (sparse) one, rather than writing zeros through
+        the whole map. The new file is renamed into place, so processes that still map the old one keep
+        reading valid (if stale) pages rather than getting a SIGBUS.
+        """
+        array = self[key]
+        fd, tmpname = tempfile.mkstemp(prefix=".%s." % str(key), suffix=".npy", dir=self.path)
+        os.close(fd)
+        np.lib.format.open_memmap(tmpname, mode="w+", dtype=array.dtype, shape=array.shape)
+        os.rename(tmpname, self._filename(key))
+        self._arrays.pop(key, None)
+        return self[key]
+
+    def delete_item(self, key):
+        self._arrays.pop(key, None)
+        if key in self:
+            os.unlink(self._filename(key))
+
+    def delete(self):
+        self._arrays = {}
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ClassMemmapImages(object):
+    """
+    Out-of-core stand-in for the shared dict of images made by FacetsToIm(). The stitched cubes ("ImagData"
+    and "MeanImage") are kept as the memory-mapped scratch arrays they were stitched into (see
+    GiveEmptyMainField()) rather than copied into shared memory; everything else goes into the shared dict,
+    whose methods (addSubdict, reload, delete, ...) this passes on. The cubes are only seen through this
+    object, in this process: a worker attaching to the shared dict does not find them.
+    """
+    MemmapKeys = ("ImagData", "MeanImage")
+
+    def __init__(self, Dict):
+        self._dict = Dict
+        self._memmaps = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._dict, name)
+
+    def keys(self):
+        return self._dict.keys() + self._memmaps.keys()
+
+    def __contains__(self, key):
+        return key in self._memmaps or key in self._dict
+
+    def __getitem__(self, key):
+        if key in self._memmaps:
+            return self._memmaps[key]
+        return self._dict[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __setitem__(self, key, value):
+        if key in self.MemmapKeys and isinstance(value, np.memmap):
+            self._memmaps[key] = value
+        else:
+            self._memmaps.pop(key, None)
+            self._dict[key] = value
+
+    def delete_item(self, key):
+        if key in self._memmaps:
+            del self._memmaps[key]
+        else:
+            self._dict.delete_item(key)
+
+    def delete(self):
+        self._memmaps = {}
+        self._dict.delete()
+
+
+class ClassJobTrace(object):
+    """
+    Records the APP jobs issued by the facet machines as a Chrome/Perfetto trace (load the file in
+    chrome://tracing or ui.perfetto.dev). Each worker process gets its own lane showing job execution,
+    and the time each job spent queued since its submission as async events (which may overlap, as many
+    jobs wait in the queue at once). The main process lane shows
+    the awaitJobResults() barriers. Execution times come from the job timing records, see
+    ClassFacetMachine._giveJobStats().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._t00 = time.time()
+        self._submitted = {}
+        self._events = []
+        self._async_id = 0
+        self._pids = set()
+        self._main_pid = os.getpid()
+
+    def _us(self, t):
+        return (t - self._t00) * 1e6
+
+    def _addEvent(self, name, cat, t0, t1, pid, tid, args=None):
+        self._pids.add(pid)
+        self._events.append({"name": name, "cat": cat, "ph": "X", "ts": self._us(t0), "dur": max(0., (t1 - t0) * 1e6),
+                             "pid": pid, "tid": tid, "args": args or {}})
+
+    def _addAsyncEvent(self, name, cat, t0, t1, pid, args=None):
+        self._pids.add(pid)
+        self._async_id += 1
+        for ph, t in (("b", t0), ("e", t1)):
+            self._events.append({"name": name, "cat": cat, "ph": ph, "ts": self._us(t), "id": self._async_id,
+                                 "pid": pid, "args": args or {}})
+
+    def submit(self, JobName):
+        self._submitted[JobName] = time.time()
+
+    @staticmethod
+    def _giveJobKey(JobName):
+        """Job names end with the facet (F/f) or buffer (B) number of the job, e.g. "FM.Grid.label:F12" """
+        Match = re.search(r"([A-Za-z]?)(\d+)$", JobName)
+        if Match is None:
+            return None
+        return ("b" if Match.group(1) == "B" else "f", int(Match.group(2)))
+
+    def addBarrier(self, Pattern, t0, t1, results):
+        """Records a barrier on the main process, and the queueing and execution of the jobs it collected"""
+        self._addEvent("await %s" % Pattern, "barrier", t0, t1, self._main_pid, 0, {"njobs": len(results)})
+        # submission time of each job, by facet or buffer number
+        DicoSubmit = {}
+        for JobName in [JobName for JobName in self._submitted if fnmatch.fnmatch(JobName, Pattern)]:
+            DicoSubmit[self._giveJobKey(JobName)] = self._submitted.pop(JobName)
+        for res in results:
+            Stats = res.get("Stats") if isinstance(res, dict) else \
+                    (res[-1] if isinstance(res, tuple) and isinstance(res[-1], dict) else None)
+            if Stats is None:
+                continue
+            if isinstance(Stats, dict):
+                Stats = [Stats]
+            if isinstance(res, dict) and "iBuffer" in res:
+                Key = ("b", res["iBuffer"])
+            else:
+                Key = ("f", Stats[0]["iFacet"]) if Stats else None
+            for i, ThisStats in enumerate(Stats):
+                Name = "%s F%s" % (ThisStats["Job"], ThisStats["iFacet"])
+                Args = dict([(key, ThisStats.get(key)) for key in ("iFacet", "NVis", "GridSize")])
+                # only the first facet of a multi-facet job was queued, the others ran straight after it
+                if i == 0 and Key in DicoSubmit:
+                    self._addAsyncEvent(Name, "queue", DicoSubmit[Key], ThisStats["t0"], ThisStats["pid"], Args)
+                self._addEvent(Name, "exec", ThisStats["t0"], ThisStats["t1"], ThisStats["pid"], 0, Args)
+
+    def save(self):
+        Meta = []
+        for pid in sorted(self._pids):
+            Meta.append({"name": "process_name", "ph": "M", "pid": pid,
+                         "args": {"name": "main" if pid == self._main_pid else "worker %i" % pid}})
+            Meta.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "run"}})
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": Meta + self._events, "displayTimeUnit": "ms"}, f)
+        print>>log, "wrote job trace (%i events) to %s" % (len(self._events), self.path)
+
+
+class ClassSHMAccount(object):
+    """
+    Accounting of the shared memory held by the shared dicts of the facet machines. Tracks the
+    bytes in each dict (by name) and the high-water mark of the total, and checks new allocations
+    against a budget (Parallel-SHMBudget, in GB, 0 for none) and the free space left in /dev/shm.
+    The dicts themselves are kept, and re-measured before every check, so that a dict deleted (and
+    emptied) by its owner, e.g. the images given to the caller of FacetsToIm(), stops counting.
+    """
+
+    def __init__(self, budget=0, shm_path="/dev/shm"):
+        self.budget = budget
+        self.shm_path = shm_path
+        self.bytes = {}
+        self.dicts = {}
+        self.high_water = 0
+        self.high_water_dicts = {}
+
+    @staticmethod
+    def giveSize(Dict):
+        """Bytes of all arrays in a shared dict, including its subdicts"""
+        size = 0
+        for key in Dict.keys():
+            value = Dict[key]
+            if isinstance(value, np.memmap):
+                continue
+            if isinstance(value, np.ndarray):
+                size += value.nbytes
+            elif isinstance(value, dict):
+                size += ClassSHMAccount.giveSize(value)
+        return size
+
+    def total(self):
+        return sum(self.bytes.values())
+
+    def giveFree(self):
+        """Free bytes in the shared memory filesystem, or None if it can't be found"""
+        try:
+            st = os.statvfs(self.shm_path)
+        except OSError:
+            return None
+        return st.f_bavail * st.f_frsize
+
+    def refresh(self):
+        """Re-measures the tracked dicts"""
+        for name, Dict in self.dicts.items():
+            path = getattr(Dict, "path", None)
+            if path is not None and not os.path.exists(path):
+                # deleted through another handle, e.g. shared_dict.delete("normDict")
+                self.bytes[name] = 0
+                continue
+            try:
+                self.bytes[name] = self.giveSize(Dict)
+            except Exception:
+                self.bytes[name] = 0
+
+    def check(self, name, nbytes):
+        """Returns None if nbytes more can be put into dict name, else the reason why not"""
+        GB = 1024.**3
+        self.refresh()
+        if self.budget and self.total() + nbytes > self.budget * GB:
+            return "adding %.2f GB to %s would take shared memory to %.2f GB, over the budget of %.2f GB" % \
+                   (nbytes / GB, name, (self.total() + nbytes) / GB, self.budget)
+        free = self.giveFree()
+        if free is not None and nbytes > free:
+            return "adding %.2f GB to %s would exhaust %s (%.2f GB free)" % (nbytes / GB, name, self.shm_path, free / GB)
+        return None
+
+    def update(self, name, nbytes, Dict=None):
+        self.bytes[name] = nbytes
+        if Dict is not None:
+            self.dicts[name] = Dict
+        total = self.total()
+        if total > self.high_water:
+            self.high_water = total
+            self.high_water_dicts = dict(self.bytes)
+
+    def release(self, name):
+        self.bytes.pop(name, None)
+        self.dicts.pop(name, None)
+
+    def summary(self):
+        return {"budget_GB": self.budget, "current": dict(self.bytes), "total": self.total(),
+                "high_water": self.high_water, "high_water_dicts": self.high_water_dicts}
+
+    def report(self):
+        GB = 1024.**3
+        print>>log, "shared memory high-water mark: %.2f GB%s" % (self.high_water / GB,
+            (" (budget %.2f GB)" % self.budget) if self.budget else "")
+        for name, nbytes in sorted(self.high_water_dicts.items(), key=lambda x: -x[1]):
+            print>>log, "  %-24s %.2f GB" % (name, nbytes / GB)
+
+
+class ClassNUMAScheduler(object):
+    """
+    Places facets on NUMA nodes. Each facet gets a preferred node (facets are spread over the nodes
+    by grid size), and the jobs of a facet (CF init, gridding, FFT, degridding) are run with the CPU
+    affinity of their worker restricted to the CPUs of that node. Pages of shared memory go to the node
+    of the process that first writes them, so the CFs and grids of a facet, first written by its jobs,
+    end up on the node where they are then used.
+    """
+
+    def __init__(self, ListNodeCPUs):
+        self.ListNodeCPUs = ListNodeCPUs
+        self.NodeOfFacet = {}
+
+    @staticmethod
+    def _parseCPUList(CPUList):
+        """Parses a kernel cpulist such as "0-3,8-11" """
+        CPUs = []
+        for Range in CPUList.strip().split(","):
+            if not Range:
+                continue
+            if "-" in Range:
+                c0, c1 = Range.split("-")
+                CPUs += range(int(c0), int(c1) + 1)
+            else:
+                CPUs.append(int(Range))
+        return CPUs
+
+    @staticmethod
+    def giveNodeCPUs(SysDir="/sys/devices/system/node"):
+        """Returns the list of CPUs of every NUMA node of the host (a single node if the topology is unknown)"""
+        ListNodeCPUs = []
+        if os.path.isdir(SysDir):
+            for Node in sorted([d for d in os.listdir(SysDir) if d.startswith("node") and d[4:].isdigit()],
+                               key=lambda d: int(d[4:])):
+                try:
+                    CPUs = ClassNUMAScheduler._parseCPUList(open(os.path.join(SysDir, Node, "cpulist")).read())
+                except IOError:
+                    continue
+                if CPUs:
+                    ListNodeCPUs.append(CPUs)
+        return ListNodeCPUs
+
+    def assign(self, DicoSizes):
+        """Assigns facets (dict of facet number to grid size) to nodes, largest first, to the least loaded node"""
+        Load = np.zeros(len(self.ListNodeCPUs), np.float64)
+        for iFacet in sorted(DicoSizes.keys(), key=lambda i: -DicoSizes[i]):
+            iNode = int(np.argmin(Load / np.array([len(CPUs) for CPUs in self.ListNodeCPUs])))
+            self.NodeOfFacet[iFacet] = iNode
+            Load[iNode] += DicoSizes[iFacet]
+
+    @staticmethod
+    def getAffinity():
+        if hasattr(os, "sched_getaffinity"):
+            return sorted(os.sched_getaffinity(0))
+        import psutil
+        return psutil.Process().cpu_affinity()
+
+    @staticmethod
+    def setAffinity(CPUs):
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, CPUs)
+        else:
+            import psutil
+            psutil.Process().cpu_affinity(list(CPUs))
+
+    def pin(self, iFacet):
+        """Restricts the current process to the CPUs of the node of a facet. Returns the previous affinity"""
+        Previous = self.getAffinity()
+        self.setAffinity(self.ListNodeCPUs[self.NodeOfFacet.get(iFacet, 0)])
+        return Previous
+
+
+class ClassBeamJonesCache(object):
+    """
+    Disk-backed store of beam Jones dicts (DATA["Beam"]), shared by all the imaging runs that point at
+    the same directory, so that the beam of a chunk is only evaluated once for a given MS, time sampling,
+    frequency sampling, set of directions and beam settings. An entry is a .npz of the flattened dict
+    (nested keys joined with "/"), written to a temporary file and renamed into place, so that
+    concurrent runs never see a partial entry. Entries are written by background threads, see save().
+    """
+
+    def __init__(self, directory):
+        self.path = directory
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._writers = []
+
+    @staticmethod
+    def giveKey(MSName, Times, Freqs, RaDec, BeamGD):
+        """Hash of the MS name, time and frequency sampling, directions and beam settings"""
+        h = hashlib.sha1()
+        h.update(str(MSName))
+        for Array in (Times, Freqs, RaDec):
+            Array = np.ascontiguousarray(Array, np.float64)
+            h.update(str(Array.shape))
+            h.update(Array.tostring())
+        h.update(repr(sorted(BeamGD.items())))
+        return h.hexdigest()
+
+    def _filename(self, Key):
+        return os.path.join(self.path, "%s.npz" % Key)
+
+    def has(self, Key):
+        return os.path.exists(self._filename(Key))
+
+    @staticmethod
+    def _flatten(Dico, Prefix=""):
+        Flat = {}
+        for key in Dico.keys():
+            value = Dico[key]
+            if isinstance(value, dict) or hasattr(value, "addSubdict"):
+                Flat.update(ClassBeamJonesCache._flatten(value, "%s%s/" % (Prefix, key)))
+            else:
+                Flat["%s%s" % (Prefix, key)] = value
+        return Flat
+
+    def save(self, Key, DicoBeam):
+        """
+        Copies the entry and writes it from a thread, so that the caller can go on (and the chunk be
+        released) while it is written. Use awaitWrites() to wait for the writes.
+        """
+        Flat = dict([(key, np.array(value)) for key, value in self._flatten(DicoBeam).iteritems()])
+        Writer = threading.Thread(target=self._write, args=(Key, Flat))
+        Writer.start()
+        self._writers.append(Writer)
+
+    def _write(self, Key, Flat):
+        try:
+            fd, tmpname = tempfile.mkstemp(prefix=".%s." % Key, suffix=".npz", dir=self.path)
+            with os.fdopen(fd, "w") as tmpfile:
+                np.savez(tmpfile, **Flat)
+            os.rename(tmpname, self._filename(Key))
+        except Exception, e:
+            print>>log, ModColor.Str("Could not write cached beam %s (%s)" % (self._filename(Key), e))
+
+    def awaitWrites(self):
+        """Waits for all pending writes"""
+        for Writer in self._writers:
+            Writer.join()
+        self._writers = []
+
+    def load(self, Key, DicoBeam):
+        """Fills DicoBeam (a dict or shared dict) with the entry. Returns False if there is no (readable) entry"""
+        if not self.has(Key):
+            return False
+        try:
+            npzfile = np.load(self._filename(Key))
+            Flat = dict(npzfile.iteritems())
+        except Exception, e:
+            print>>log, ModColor.Str("Could not read cached beam %s (%s), ignoring it" % (self._filename(Key), e))
+            return False
+        for key, value in sorted(Flat.items()):
+            Dico = DicoBeam
+            Path = key.split("/")
+            for subkey in Path[:-1]:
+                subkey = int(subkey) if subkey.isdigit() else subkey
+                if subkey not in Dico:
+                    Dico = Dico.addSubdict(subkey) if hasattr(Dico, "addSubdict") else Dico.setdefault(subkey, {})
+                else:
+                    Dico = Dico[subkey]
+            Dico[int(Path[-1]) if Path[-1].isdigit() else Path[-1]] = value[()] if value.shape == () else value
+        return True
+
 
 class ClassFacetMachine():
     """
@@ -126,39 +715,462 @@ class ClassFacetMachine():
         self.FacetNorm = None
 
         self._facet_grids = self.DATA = None
+        self._facet_grids_name = None
+        # band weights of the last residual image, for _buildFacetMeanResidual()
+        self._facet_mean_wband = 1
+        # out-of-core mode: facet grids and stitched images are memory-mapped files on local scratch
+        self._out_of_core = self.GD["Facets"].get("OutOfCore", False)
+        # background threads writing stitched images, see FacetsToFitsInBackground()
+        self._fits_writers = []
+        self._scratch_dir = self.GD["Cache"].get("ScratchDir") or tempfile.gettempdir()
+        if not ClassFacetMachine._scratch_cleaned:
+            ClassMemmapDict.cleanStale(self._scratch_dir)
+            ClassFacetMachine._scratch_cleaned = True
         self._grid_job_id = self._fft_job_id = self._degrid_job_id = None
         self._smooth_job_label=None
 
-        # create semaphores if not already created
-        if not ClassFacetMachine._degridding_semaphores:
-            NSemaphores = 3373
-            ClassFacetMachine._degridding_semaphores = [Multiprocessing.getShmName("Semaphore", sem=i) for i in xrange(NSemaphores)]
-            _pyGridderSmearPols.pySetSemaphores(ClassFacetMachine._degridding_semaphores)
-            atexit.register(ClassFacetMachine._delete_degridding_semaphores)
+        # Degridding mode: "Shared" has all facets subtract into DATA["data"] under the row semaphores,
+        # "Private" has each degrid job subtract its facets into its own buffer (no row locking), summed
+        # afterwards. Semaphores are only created (and sized to the data) on the first shared degridding call
+        self._degrid_output_dict = None
+        self._degrid_buffer_facets = None
+        self._degrid_DATA = None
+        self._degrid_mode = self.GD["RIME"].get("DegridMode", "Shared") or "Shared"
+        if self._degrid_mode not in ("Shared", "Private"):
+            raise ValueError("unknown RIME-DegridMode=%s" % self._degrid_mode)
+
+        # W-term mode: "WProjection" grids each facet with the full set of W-kernels (CF-Nw up to CF-wmax).
+        # "WStacking" grids into RIME-NWPlanes w-planes, each with a small set of W-kernels for the
+        # residual w within the plane, and applies the w-term of the planes in the image domain.
+        # This trades memory for kernel size: every facet has one full grid per w-plane (NWPlanes
+        # times the facet grid memory, checked against Parallel-SHMBudget with the grids, see ReinitDirty()),
+        # and every chunk gets a plane-relative copy of its uvw per BDA mapping, see _setWPlanes()
+        self._wmode = self.GD["RIME"].get("WMode", "WProjection") or "WProjection"
+        if self._wmode not in ("WProjection", "WStacking"):
+            raise ValueError("unknown RIME-WMode=%s" % self._wmode)
+        self._wplanes = self._giveWPlanes()
+        if self._wmode == "WStacking":
+            print>>log, "W-stacking on %i w-planes: the facet grids take %i times the memory of W-projection" % \
+                (len(self._wplanes), len(self._wplanes))
+        # largest |w| of the data, for CF-AdaptiveW, see _giveDataWMax()
+        self._data_wmax = None
+        # padding needed for the aliasing budget, for Facets-PaddingMode=Adaptive, see _giveMinPadding()
+        self._min_padding = None
+        # cache of the beam Jones matrices of the chunks, shared between runs, see _setBeamJones()
+        self._beam_cache = None
+        if self.GD["Beam"]["Model"] is not None and self.GD["Cache"].get("BeamJones", False):
+            BeamDir = self.GD["Cache"].get("BeamJonesDir") or \
+                      os.path.join(self.GD["Cache"].get("Dir") or ".", "BeamJones")
+            self._beam_cache = ClassBeamJonesCache(BeamDir)
+        self._beam_keys_saved = set()
+        # FFT timings of this CPU type, and the sizes missing from them, see _giveFFTTimes()
+        self._fft_times = None
+        self._fft_sizes_missing = set()
+        # NUMA node of each facet, see _setNUMANodes()
+        self._numa = None
+        # gridding checkpoints (Cache-GridCheckpoint: every so many chunks of the first gridding pass),
+        # see _saveCheckpoint(). _grid_pass counts the calls to ReinitDirty()
+        self._checkpoint_every = self.GD["Cache"].get("GridCheckpoint", 0) or 0
+        self._checkpoint_chunks = []
+        self._checkpoint_resumed = set()
+        self._checkpoint_thread = None
+        self._grid_pass = 0
+        # KD-tree of the solution directions, and interpolation weights of the facets, see _setFacetSolsTable()
+        self._sols_tree = None
+        self._facet_sols = None
 
         # this is used to store model images in shared memory, for the degridder
         self._model_dict = None
+        # True if the model image is a persistent buffer, see giveModelImageBuffer()
+        self._model_persistent = False
         # this is used to store NormImage in shared memory, for the degridder
         self._norm_dict = None
+        # aggregates of the timing records returned by the workers, per job type, see _recordJobStats()
+        self._job_metrics = {}
+        # the metrics and the job trace are written when the facet machine goes, or at exit, whichever comes
+        # first (see flushJobReports()). The exit hook only holds a weak reference, so that it doesn't keep
+        # the grids alive, and it does nothing in the (forked) workers
+        self._reports_flushed = False
+        self._main_pid = os.getpid()
+        atexit.register(ClassFacetMachine._flushJobReportsAtExit, weakref.ref(self))
 
 
-    # static attribute initialized below, once
+    # stale scratch directories are removed once per process, see ClassMemmapDict.cleanStale()
+    _scratch_cleaned = False
+
+    # FFTW wisdom (size, dtype) keys being learned by background processes started in setWisdom()
+    _wisdom_learning = []
+    _wisdom_processes = []
+    # planner effort of this process before setWisdom() switched it to estimate mode, see awaitWisdom()
+    _wisdom_effort = None
+
+    @staticmethod
+    def awaitWisdom(Timeout=None):
+        """
+        Waits up to Timeout seconds (None for no limit) for the background wisdom processes to merge
+        what they learned into the store, then terminates those still running (the sizes they had
+        already merged are kept, the others will be learned again by the next run). Called at
+        shutdown(), and at exit.
+        """
+        t0 = time.time()
+        for proc in ClassFacetMachine._wisdom_processes:
+            if Timeout is None:
+                proc.join()
+            else:
+                proc.join(max(0, Timeout - (time.time() - t0)))
+            if proc.is_alive():
+                print>>log, "terminating the background FFTW wisdom process, keeping the sizes it has learned so far"
+                proc.terminate()
+                proc.join()
+        ClassFacetMachine._wisdom_processes = []
+        ClassFacetMachine._wisdom_learning = []
+        if ClassFacetMachine._wisdom_effort is not None:
+            pyfftw.config.PLANNER_EFFORT = ClassFacetMachine._wisdom_effort
+            ClassFacetMachine._wisdom_effort = None
+
+    # static attribute initialized by _setDegriddingSemaphores(), on the first degridding call
     _degridding_semaphores = None
+    # semaphores of earlier (smaller) sets, which workers may still hold: only deleted at exit
+    _old_degridding_semaphores = []
+    # semaphores set in the current (worker) process
+    _process_semaphores = None
+    # never use more semaphores than this, whatever the size of the data
+    _max_degridding_semaphores = 3373
+
+    @staticmethod
+    def _setDegriddingSemaphores(NRows):
+        """
+        Creates the named semaphores used by the degridders to lock visibility rows, one per row
+        of the largest chunk seen so far (up to _max_degridding_semaphores). Returns the list of names.
+        A larger set gets new names: workers may still be attached to the previous set, which is
+        kept until exit.
+        """
+        NSemaphores = max(1, min(NRows, ClassFacetMachine._max_degridding_semaphores))
+        Current = ClassFacetMachine._degridding_semaphores
+        if Current and len(Current) >= NSemaphores:
+            return Current
+        if Current:
+            ClassFacetMachine._old_degridding_semaphores.append(Current)
+        else:
+            atexit.register(ClassFacetMachine._delete_degridding_semaphores)
+        Generation = len(ClassFacetMachine._old_degridding_semaphores)
+        print>>log, "creating %i degridding semaphores" % NSemaphores
+        ClassFacetMachine._degridding_semaphores = [Multiprocessing.getShmName("Semaphore", gen=Generation, sem=i)
+                                                    for i in xrange(NSemaphores)]
+        _pyGridderSmearPols.pySetSemaphores(ClassFacetMachine._degridding_semaphores)
+        ClassFacetMachine._process_semaphores = ClassFacetMachine._degridding_semaphores
+        return ClassFacetMachine._degridding_semaphores
+
+    @staticmethod
+    def _attachDegriddingSemaphores(ListSemaphores):
+        """Makes sure the given semaphores are set in this (worker) process, which may have been forked before they were created"""
+        if ListSemaphores is not None and ClassFacetMachine._process_semaphores != ListSemaphores:
+            _pyGridderSmearPols.pySetSemaphores(ListSemaphores)
+            ClassFacetMachine._process_semaphores = ListSemaphores
 
     @staticmethod
     def _delete_degridding_semaphores():
         if ClassFacetMachine._degridding_semaphores:
-            _pyGridderSmearPols.pyDeleteSemaphore(ClassFacetMachine._degridding_semaphores)
-            for sem in ClassFacetMachine._degridding_semaphores:
-                NpShared.DelArray(sem)
+            for ListSemaphores in ClassFacetMachine._old_degridding_semaphores + [ClassFacetMachine._degridding_semaphores]:
+                _pyGridderSmearPols.pyDeleteSemaphore(ListSemaphores)
+                for sem in ListSemaphores:
+                    NpShared.DelArray(sem)
+            ClassFacetMachine._degridding_semaphores = None
+            ClassFacetMachine._old_degridding_semaphores = []
+            ClassFacetMachine._process_semaphores = None
 
     def __del__(self):
+        self.flushJobReports()
         self.releaseGrids()
+        self.releaseModelImage(force=True)
+
+    def _giveJobStats(self, Job, iFacet, t0, NVis=0, GridSize=None):
+        """
+        Worker-side timing record of a facet job started at time t0, returned to the main process
+        with the job result. Costs one time.time() call and a small dict per facet.
+        """
+        t1 = time.time()
+        return {"Job": Job, "iFacet": iFacet, "t0": t0, "t1": t1, "wall": t1 - t0,
+                "NVis": int(NVis),
+                "GridSize": int(self.DicoImager[iFacet]["NpixFacetPadded"] if GridSize is None else GridSize),
+                "pid": os.getpid()}
+
+    def _recordJobStats(self, Stats):
+        """Adds a (list of) timing record(s) from _giveJobStats() to the per-job aggregates"""
+        if isinstance(Stats, dict):
+            Stats = [Stats]
+        for ThisStats in Stats:
+            Agg = self._job_metrics.get(ThisStats["Job"])
+            if Agg is None:
+                Agg = self._job_metrics[ThisStats["Job"]] = {"count": 0, "wall_total": 0., "wall_max": 0.,
+                                                             "nvis_total": 0, "wall_facet": {}}
+            Agg["count"] += 1
+            Agg["wall_total"] += ThisStats["wall"]
+            Agg["wall_max"] = max(Agg["wall_max"], ThisStats["wall"])
+            Agg["nvis_total"] += ThisStats["NVis"]
+            Agg["wall_facet"][ThisStats["iFacet"]] = Agg["wall_facet"].get(ThisStats["iFacet"], 0.) + ThisStats["wall"]
+
+    def _recordJobResults(self, results):
+        """Stores the timing records of a list of job results, re-raising any worker exception"""
+        for DicoResult in results:
+            if isinstance(DicoResult, Exception):
+                raise DicoResult
+            self._recordJobStats(DicoResult["Stats"])
+
+    def writeJobMetrics(self, MetricsName=None, NSlowest=10):
+        """
+        Writes the per-job aggregates of the timing records (count, total/mean/max wall time, visibility
+        throughput) and the slowest facets of each job type to a JSON file (default
+        <ImageName>.<FM>.metrics.json). Called by flushJobReports().
+        """
+        if not self._job_metrics:
+            return None
+        if MetricsName is None:
+            MetricsName = "%s.%s.metrics.json" % (self.ImageName, self._app_id)
+        Summary = {}
+        for Job, Agg in sorted(self._job_metrics.items()):
+            Slowest = sorted(Agg["wall_facet"].items(), key=lambda x: -x[1])[:NSlowest]
+            Summary[Job] = {"count": Agg["count"],
+                            "wall_total": Agg["wall_total"],
+                            "wall_mean": Agg["wall_total"] / Agg["count"],
+                            "wall_max": Agg["wall_max"],
+                            "nvis_total": Agg["nvis_total"],
+                            "nvis_per_sec": Agg["nvis_total"] / Agg["wall_total"] if Agg["wall_total"] > 0 else 0.,
+                            "slowest_facets": [{"iFacet": int(iFacet), "wall": float(wall)} for iFacet, wall in Slowest]}
+        Metrics = {"ImageName": self.ImageName,
+                   "FacetMachine": self._app_id,
+                   "NFacets": len(self.DicoImager),
+                   "Summary": Summary,
+                   "SHM": self._giveSHMAccount().summary()}
+        with open(MetricsName, "w") as f:
+            json.dump(Metrics, f, indent=1, sort_keys=True)
+        print>>log, "wrote timings of %i facet jobs to %s" % (sum([Agg["count"] for Agg in self._job_metrics.values()]),
+                                                            MetricsName)
+        self._giveSHMAccount().report()
+        return MetricsName
+
+    def flushJobReports(self):
+        """
+        Waits for the background writers, then writes the job metrics and the job trace (if enabled).
+        Done once, by the first of shutdown(), __del__() and the exit hook registered by __init__()
+        """
+        if self._reports_flushed or os.getpid() != self._main_pid:
+            return
+        self._reports_flushed = True
+        self.awaitFitsWriters()
+        if self._beam_cache is not None:
+            self._beam_cache.awaitWrites()
+        self.writeJobMetrics()
+        self.writeJobTrace()
+
+    @staticmethod
+    def _flushJobReportsAtExit(FacetMachineRef):
+        FacetMachine = FacetMachineRef()
+        if FacetMachine is not None:
+            FacetMachine.flushJobReports()
+
+    def shutdown(self):
+        """Writes the job reports (see flushJobReports()) and waits for the FFTW wisdom learner"""
+        self.flushJobReports()
+        self.awaitWisdom(self.GD["Cache"].get("WisdomTimeout", 60))
+
+    # job trace shared by all facet machines of the process, see _runJob()
+    _job_trace = None
+
+    def _runJob(self, JobName, handler, args=(), iFacet=None, Estimate=None):
+        """APP.runJob(), recording the submission time if the job trace (Debug-TraceJobs) is enabled.
+        Jobs of a facet (iFacet given) run on the NUMA node of the facet if Parallel-NUMAAffinity is set.
+        If Estimate is set (by default, if the wisdom of the grid size of the facet is being learned,
+        see setWisdom()), the job plans its FFTs in estimate mode"""
+        if self.GD["Debug"].get("TraceJobs", False):
+            if ClassFacetMachine._job_trace is None:
+                ClassFacetMachine._job_trace = ClassJobTrace("%s.jobs.trace.json" % self.ImageName)
+            ClassFacetMachine._job_trace.submit(JobName)
+        if Estimate is None:
+            Estimate = iFacet is not None and self._isLearningWisdom(iFacet)
+        if Estimate and hasattr(pyfftw, "config"):
+            args = (handler.__name__,) + tuple(args)
+            handler = self._estimate_job_worker
+        if self._numa is not None and iFacet is not None:
+            APP.runJob(JobName, self._numa_job_worker, args=(iFacet, handler.__name__) + tuple(args))
+        else:
+            APP.runJob(JobName, handler, args=args)
+
+    def _estimate_job_worker(self, HandlerName, *args):
+        """Runs a job with the FFTs planned in estimate mode, then restores the planner effort of the worker"""
+        Effort = pyfftw.config.PLANNER_EFFORT
+        pyfftw.config.PLANNER_EFFORT = "FFTW_ESTIMATE"
+        try:
+            return getattr(self, HandlerName)(*args)
+        finally:
+            pyfftw.config.PLANNER_EFFORT = Effort
+
+    def _numa_job_worker(self, iFacet, HandlerName, *args):
+        """Runs a facet job with the worker restricted to the NUMA node of the facet, then restores its affinity"""
+        Previous = self._numa.pin(iFacet)
+        try:
+            return getattr(self, HandlerName)(*args)
+        finally:
+            self._numa.setAffinity(Previous)
+
+    def _setNUMANodes(self):
+        """Sets up the NUMA scheduler (Parallel-NUMAAffinity), if the host has more than one node"""
+        self._numa = None
+        if not self.GD["Parallel"].get("NUMAAffinity", False):
+            return
+        ListNodeCPUs = ClassNUMAScheduler.giveNodeCPUs()
+        try:
+            ClassNUMAScheduler.getAffinity()
+        except ImportError:
+            print>>log, ModColor.Str("NUMA affinity needs os.sched_setaffinity or psutil, disabling it")
+            return
+        if len(ListNodeCPUs) < 2:
+            return
+        self._numa = ClassNUMAScheduler(ListNodeCPUs)
+        self._numa.assign(dict([(iFacet, self.DicoImager[iFacet]["NpixFacetPadded"]**2) for iFacet in self.DicoImager.keys()]))
+        print>>log, "facets placed on %i NUMA nodes: %s facets" % (len(ListNodeCPUs),
+            "/".join([str(self._numa.NodeOfFacet.values().count(iNode)) for iNode in xrange(len(ListNodeCPUs))]))
+
+    def _touch_grid_worker(self, iFacet, griddict):
+        """Zeroes the grids of a facet from its NUMA node, so that their pages are allocated there"""
+        for iPlane in xrange(len(self._wplanes)):
+            griddict[self._giveWGridKey(iFacet, iPlane)].fill(0)
+        return {"iFacet": iFacet}
+
+    def _awaitJobResults(self, Pattern, progress=None):
+        """APP.awaitJobResults(), recording the barrier and the jobs it collected in the job trace, if any"""
+        t0 = time.time()
+        results = APP.awaitJobResults(Pattern, progress=progress)
+        if ClassFacetMachine._job_trace is not None:
+            ClassFacetMachine._job_trace.addBarrier(Pattern, t0, time.time(), results)
+        return results
+
+    def writeJobTrace(self):
+        if ClassFacetMachine._job_trace is not None:
+            ClassFacetMachine._job_trace.save()
+
+    # shared memory accounting shared by all facet machines of the process, see _checkSHM()
+    _shm_account = None
+
+    def _giveSHMAccount(self):
+        if ClassFacetMachine._shm_account is None:
+            ClassFacetMachine._shm_account = ClassSHMAccount(self.GD["Parallel"].get("SHMBudget", 0) or 0)
+        return ClassFacetMachine._shm_account
+
+    def _checkSHM(self, name, nbytes, spill=False):
+        """
+        Checks that nbytes more can be allocated in shared dict name. If not, raises a MemoryError,
+        or, if the caller can spill the dict to disk instead (spill=True), warns and returns False.
+        """
+        reason = self._giveSHMAccount().check(name, nbytes)
+        if reason is None:
+            return True
+        if spill:
+            print>>log, ModColor.Str("%s: spilling %s to %s" % (reason, name, self._scratch_dir))
+            return False
+        raise MemoryError(reason)
+
+    def _accountSHM(self, name, Dict):
+        """Records the current size of a shared dict"""
+        self._giveSHMAccount().update(name, ClassSHMAccount.giveSize(Dict), Dict)
+
+    def _releaseSHM(self, name):
+        self._giveSHMAccount().release(name)
+
+    def _createSHMDict(self, name, nbytes):
+        """
+        shared_dict.create(), after checking that nbytes can be allocated in it. The create replaces
+        any dict of the same name, so that one no longer counts.
+        """
+        self._releaseSHM(name)
+        self._checkSHM(name, nbytes)
+        Dict = shared_dict.create(name)
+        self._accountSHM(name, Dict)
+        return Dict
+
+    # facet grid dicts given up by one facet machine (see recycleGrids()), for another to borrow
+    # in ReinitDirty(). Entries are (name, dict). Names of all grid dicts held by a facet machine
+    # or by the pool are in _grid_names, so that shared_dict.create() never resets one of them.
+    _grid_pool = []
+    _grid_names = set()
+
+    def _giveGridShapes(self):
+        return dict([(self._giveWGridKey(iFacet, iPlane),
+                      (self.VS.NFreqBands, self.npol,
+                       self.DicoImager[iFacet]["NpixFacetPadded"], self.DicoImager[iFacet]["NpixFacetPadded"]))
+                     for iFacet in self.DicoGridMachine.keys() for iPlane in xrange(len(self._wplanes))])
+
+    def _borrowGrids(self):
+        """Takes a set of facet grids of the right shapes and kind from the pool. Returns (name, dict) or (None, None)"""
+        # one key per facet and w-plane, see _giveWGridKey()
+        Shapes = self._giveGridShapes()
+        for i, (Name, Grids) in enumerate(ClassFacetMachine._grid_pool):
+            if isinstance(Grids, ClassMemmapDict) != bool(self._out_of_core):
+                continue
+            if set(Grids.keys()) != set(Shapes.keys()):
+                continue
+            if all([Grids[key].shape == Shapes[key] and Grids[key].dtype == self.CType for key in Shapes]):
+                del ClassFacetMachine._grid_pool[i]
+                self._releaseSHM("GridPool:%s" % Name)
+                return Name, Grids
+        return None, None
+
+    def recycleGrids(self):
+        """
+        Gives up the facet grids once this facet machine is done with them (the PSF one, after
+        FacetsToIm(): see Facets-RecyclePSFGrids). They go to the pool, so that another facet machine
+        that has no grids yet can use them instead of allocating its own, or are released straight
+        away if another facet machine already holds grids of its own, as nothing would borrow them.
+        The grids must not be used by this facet machine afterwards: it will get a new set
+        when gridding next.
+        """
+        if self._facet_grids is None:
+            return
+        self._awaitCheckpoint()
+        self.awaitFitsWriters()
+        Name = self._facet_grids_name
+        Pooled = set([PoolName for PoolName, _ in ClassFacetMachine._grid_pool])
+        if not self._out_of_core:
+            self._releaseSHM(Name)
+        if ClassFacetMachine._grid_names - Pooled - set([Name]):
+            print>>log, "facet grids %s released: the other facet machine has its own" % Name
+            ClassFacetMachine._grid_names.discard(Name)
+            self._facet_grids.delete()
+        else:
+            if not self._out_of_core:
+                self._accountSHM("GridPool:%s" % Name, self._facet_grids)
+            if not ClassFacetMachine._grid_pool:
+                atexit.register(ClassFacetMachine._deleteGridPool)
+            ClassFacetMachine._grid_pool.append((Name, self._facet_grids))
+            print>>log, "facet grids %s given up for reuse" % Name
+        self._facet_grids = self._facet_grids_name = None
+        for GM in self.DicoGridMachine.itervalues():
+            GM.pop("Dirty", None)
+        self.IsDirtyInit = False
+        self.HasFourierTransformed = False
+
+    @staticmethod
+    def _deleteGridPool():
+        for Name, Grids in ClassFacetMachine._grid_pool:
+            if ClassFacetMachine._shm_account is not None:
+                ClassFacetMachine._shm_account.release("GridPool:%s" % Name)
+            ClassFacetMachine._grid_names.discard(Name)
+            Grids.delete()
+        ClassFacetMachine._grid_pool = []
 
     def releaseGrids(self):
+        self._awaitCheckpoint()
+        self.awaitFitsWriters()
         if self._facet_grids is not None:
+            if not self._out_of_core:
+                self._releaseSHM(self._facet_grids_name)
+            ClassFacetMachine._grid_names.discard(self._facet_grids_name)
             self._facet_grids.delete()
-            self._facet_grids = None
+            self._facet_grids = self._facet_grids_name = None
+        if self._degrid_output_dict is not None:
+            self._releaseSHM("%sDegridOutput" % self._app_id)
+            self._degrid_output_dict.delete()
+            self._degrid_output_dict = None
         for GM in self.DicoGridMachine.itervalues():
             if "Dirty" in GM:
                 del GM["Dirty"]
@@ -238,6 +1250,9 @@ class ClassFacetMachine():
                                          [RadiusTot, RadiusTot],
                                          [-RadiusTot, RadiusTot]])
         self.setFacetsLocs()
+        self._setFacetsSols()
+        # FFT sizes the adaptive padding had no timings for are measured while the run goes on
+        self._timeFFTSizesInBackground()
 
     def AppendFacet(self, iFacet, l0, m0, diam):
         """
@@ -260,6 +1275,8 @@ class ClassFacetMachine():
 
         NpixFacet, _ = EstimateNpix(diam / self.CellSizeRad, Padding=1)
         _, NpixPaddedGrid = EstimateNpix(NpixFacet, Padding=self.Padding)
+        if self.GD["Facets"].get("PaddingMode", "Fixed") == "Adaptive":
+            NpixPaddedGrid = self._giveAdaptivePaddedSize(NpixFacet, NpixPaddedGrid)
 
         diam = NpixFacet * self.CellSizeRad
         diamPadded = NpixPaddedGrid * self.CellSizeRad
@@ -276,13 +1293,7 @@ class ClassFacetMachine():
             m0 - RadiusFacetPadded, \
             m0 + RadiusFacetPadded
 
-        lSol, mSol = self.lmSols
-        raSol, decSol = self.radecSols
-        dSol = np.sqrt((l0 - lSol) ** 2 + (m0 - mSol) ** 2)
-        iSol = np.where(dSol == np.min(dSol))[0]
-        self.DicoImager[iFacet]["lmSol"] = lSol[iSol], mSol[iSol]
-        self.DicoImager[iFacet]["radecSol"] = raSol[iSol], decSol[iSol]
-        self.DicoImager[iFacet]["iSol"] = iSol
+        # the nearest solution directions (lmSol, radecSol, iSol) are set for all facets at once, see _setFacetsSols()
 
         # print>>log,"#[%3.3i] %f, %f"%(iFacet,l0,m0)
         DicoConfigGM = {"NPix": NpixFacet,
@@ -293,6 +1304,7 @@ class ClassFacetMachine():
                         "OverS": self.GD["CF"]["OverS"],
                         "wmax": self.GD["CF"]["wmax"],
                         "Nw": self.GD["CF"]["Nw"],
+                        "WMode": self._wmode,
                         "WProj": True,
                         "DoDDE": self.DoDDE,
                         "Padding": self.GD["Facets"]["Padding"]}
@@ -316,6 +1328,7 @@ class ClassFacetMachine():
         self.DicoImager[iFacet]["NpixFacetPadded"] = NpixPaddedGrid
         self.DicoImager[iFacet]["DicoConfigGM"] = DicoConfigGM
         self.DicoImager[iFacet]["IDFacet"] = iFacet
+        DicoConfigGM["wmax"], DicoConfigGM["Nw"], DicoConfigGM["Support"] = self._giveCFPars(iFacet)
         # print self.DicoImager[iFacet]
 
         # self.JonesDirCat.ra[iFacet] = raFacet[0]
@@ -470,6 +1483,103 @@ class ClassFacetMachine():
 
     # ############### Initialisation #####################
 
+    # ##############################################
+    # ##### Facet to solution mapping ##############
+
+    def _giveSolsTree(self):
+        """KD-tree of the (l,m) of the solution directions, rebuilt when self.lmSols is changed"""
+        from scipy.spatial import cKDTree
+        lSol, mSol = self.lmSols
+        Key = (id(lSol), id(mSol), len(lSol))
+        if self._sols_tree is None or self._sols_tree[0] != Key:
+            self._sols_tree = Key, cKDTree(np.array([lSol, mSol], np.float64).T)
+        return self._sols_tree[1]
+
+    def _giveNearestSols(self, l, m):
+        """
+        For each (l,m), the indices of the closest solution direction(s), as a full distance scan
+        would give them (i.e. all of them in the rare case of a tie, in increasing order)
+        """
+        Tree = self._giveSolsTree()
+        k = min(4, Tree.n)
+        d, ind = Tree.query(np.array([l, m], np.float64).T, k=k)
+        d, ind = d.reshape((-1, k)), ind.reshape((-1, k))
+        return [np.sort(ind[i][d[i] == d[i, 0]]) for i in xrange(d.shape[0])]
+
+    def _setFacetsSols(self):
+        """Sets the nearest solution direction(s) of every facet centre, with one query of the KD-tree once the facets are laid out"""
+        ListFacets = sorted(self.DicoImager.keys())
+        if not ListFacets:
+            return
+        lSol, mSol = self.lmSols
+        raSol, decSol = self.radecSols
+        lm = np.array([self.DicoImager[iFacet]["lmShift"] for iFacet in ListFacets], np.float64).reshape((-1, 2))
+        for iFacet, iSol in zip(ListFacets, self._giveNearestSols(lm[:, 0], lm[:, 1])):
+            self.DicoImager[iFacet]["lmSol"] = lSol[iSol], mSol[iSol]
+            self.DicoImager[iFacet]["radecSol"] = raSol[iSol], decSol[iSol]
+            self.DicoImager[iFacet]["iSol"] = iSol
+
+    def _giveSolsFluxes(self):
+        """Flux of the solution directions (the I of the cluster catalog), for the interpolation weights"""
+        ISols = getattr(self, "ISols", None)
+        if ISols is None:
+            return np.ones(len(self.lmSols[0]), np.float64)
+        return np.float64(ISols)
+
+    def _giveInterpWeights(self, lFacet, mFacet, NMax=4, Threshold=0.2, NBlock=256):
+        """
+        Krigging-style interpolation weights of the solution directions at the facet centres, as a CSR
+        matrix (Indptr, Indices, Weights): w = I/(1+d/d0)^gamma, normalised, then weights below
+        Threshold times the largest one are dropped, at most NMax are kept, and the kept ones are
+        normalised to a sum of 1. Computed over blocks of NBlock facets at a time.
+        """
+        lSol, mSol = self.lmSols
+        lSol, mSol = np.float64(lSol), np.float64(mSol)
+        ISol = self._giveSolsFluxes()
+        d0 = self.GD["DDESolutions"]["Scale"] * np.pi / 180
+        gamma = self.GD["DDESolutions"]["gamma"]
+        NMax = min(NMax, lSol.size)
+        ListIndices, ListWeights, Counts = [], [], []
+        for i0 in xrange(0, lFacet.size, NBlock):
+            l, m = lFacet[i0:i0 + NBlock, None], mFacet[i0:i0 + NBlock, None]
+            d = np.sqrt((l - lSol[None, :])**2 + (m - mSol[None, :])**2)
+            w = ISol[None, :] / (1. + d / d0)**gamma
+            w /= np.sum(w, axis=1).reshape((-1, 1))
+            # the NMax largest weights of each facet, then thresholded
+            Ind = np.argsort(-w, axis=1)[:, :NMax]
+            wKept = w[np.arange(w.shape[0])[:, None], Ind]
+            Keep = wKept >= Threshold * wKept[:, :1]
+            wKept = np.where(Keep, wKept, 0.)
+            wKept /= np.sum(wKept, axis=1).reshape((-1, 1))
+            ListIndices.append(Ind[Keep])
+            ListWeights.append(wKept[Keep])
+            Counts.append(np.sum(Keep, axis=1))
+        Indptr = np.zeros(lFacet.size + 1, np.int64)
+        np.cumsum(np.concatenate(Counts), out=Indptr[1:])
+        return Indptr, np.int32(np.concatenate(ListIndices)), np.float64(np.concatenate(ListWeights))
+
+    def _setFacetSolsTable(self):
+        """
+        Builds, in one batched pass over all facets, the sparse interpolation weights of the solutions at
+        the facet centres (see _giveInterpWeights), as the CSR matrix "Indptr", "Indices", "Weights". Must be
+        (re)built once the fluxes of the solution directions (self.ISols) are known.
+        """
+        ListFacets = sorted(self.DicoImager.keys())
+        lm = np.array([self.DicoImager[iFacet]["lmShift"] for iFacet in ListFacets], np.float64).reshape((-1, 2))
+        Indptr, Indices, Weights = self._giveInterpWeights(lm[:, 0], lm[:, 1])
+        self._facet_sols = {"Facets": ListFacets, "Indptr": Indptr, "Indices": Indices, "Weights": Weights}
+
+    def giveFacetInterpWeights(self, iFacet):
+        """Returns (indices, weights) of the solution directions interpolated at the centre of a facet"""
+        if self._facet_sols is None:
+            self._setFacetSolsTable()
+        i = self._facet_sols["Facets"].index(iFacet)
+        i0, i1 = self._facet_sols["Indptr"][i:i + 2]
+        return self._facet_sols["Indices"][i0:i1], self._facet_sols["Weights"][i0:i1]
+
+    # ##############################################
+    # ##############################################
+
     def PlotFacetSols(self):
 
         DicoClusterDirs= NpShared.SharedToDico("%sDicoClusterDirs" % self.IdSharedMemData)
@@ -481,22 +1591,14 @@ class ClassFacetMachine():
         InterpMode=self.GD["DDESolutions"]["Type"]
         if InterpMode=="Krigging":
             import pylab
+            # the weights depend on the fluxes of the directions
+            self.ISols = sI
+            self._setFacetSolsTable()
             for iFacet in sorted(self.DicoImager.keys()):
                 l0, m0 = self.DicoImager[iFacet]["lmShift"]
-                d0 = self.GD["DDESolutions"]["Scale"]*np.pi/180
-                gamma = self.GD["DDESolutions"]["gamma"]
-
-                d = np.sqrt((l0-lc)**2+(m0-mc)**2)
-                idir = np.argmin(d)  # this is not used
-                w = sI/(1.+d/d0) ** gamma
-                w /= np.sum(w)
-                w[w < (0.2 * w.max())] = 0
-                ind = np.argsort(w)[::-1]
-                w[ind[4::]] = 0
-
-                ind = np.where(w != 0)[0]
+                ind, w = self.giveFacetInterpWeights(iFacet)
                 pylab.clf()
-                pylab.scatter(lc[ind], mc[ind], c=w[ind], vmin=0, vmax=w.max())
+                pylab.scatter(lc[ind], mc[ind], c=w, vmin=0, vmax=w.max())
                 pylab.scatter([l0], [m0], marker="+")
                 pylab.xlim(x0, x1)
                 pylab.ylim(y0, y1)
@@ -511,6 +1613,13 @@ class ClassFacetMachine():
         self.DicoGridMachine = {}
         for iFacet in self.DicoImager.keys():
             self.DicoGridMachine[iFacet] = {}
+        if self.GD["CF"].get("AdaptiveW", False):
+            ListNw = [self.DicoImager[iFacet]["DicoConfigGM"]["Nw"] for iFacet in self.DicoImager.keys()]
+            ListSupport = [self.DicoImager[iFacet]["DicoConfigGM"]["Support"] for iFacet in self.DicoImager.keys()]
+            print>>log, "adaptive W-kernels: Nw=%i..%i, Support=%i..%i, %i kernels in total (vs %i)" % \
+                (min(ListNw), max(ListNw), min(ListSupport), max(ListSupport), sum(ListNw),
+                 len(ListNw) * self.GD["CF"]["Nw"])
+        self._setNUMANodes()
         self.setWisdom()
         self._CF = None
         self.IsDDEGridMachineInit = False
@@ -518,67 +1627,263 @@ class ClassFacetMachine():
         self._Im2Grid = ClassImToGrid(OverS=self.GD["CF"]["OverS"], GD=self.GD)
 
 
-    def setWisdom(self):
-        """
-        Set fft wisdom
-        """
-        import socket, os
+    def _giveWisdomCachePath(self):
+        """Returns (and creates) the directory of the FFTW wisdom and FFT timings of this CPU type"""
         from os.path import expanduser
-        if self.GD["RIME"]["FFTMachine"]!="FFTW": return
         self.wisdom_cache_path = self.GD["Cache"]["DirWisdomFFTW"]
         #hostname=socket.gethostname()
         cpuname=cpuinfo.get_cpu_info()["brand"].replace(" ","")
         if "~" in self.wisdom_cache_path:
             home = expanduser("~")        
             self.wisdom_cache_path=self.wisdom_cache_path.replace("~",home)
-        self.wisdom_cache_path_host = "/".join([self.wisdom_cache_path,cpuname])
+        wisdom_cache_path_host = "/".join([self.wisdom_cache_path,cpuname])
+        if not os.path.isdir(wisdom_cache_path_host):
+            print>>log, "Wisdom file %s does not exist, create it" % (wisdom_cache_path_host)
+            os.makedirs(wisdom_cache_path_host)
+        return wisdom_cache_path_host
+
+    # ##############################################
+    # ##### Adaptive padding #######################
+
+    # rational approximation of the prolate spheroidal function (m=6, alpha=1, Schwab 1984), on [0,0.75) and [0.75,1]
+    _sphe_p = [[8.203343e-2, -3.644705e-1, 6.278660e-1, -5.335581e-1, 2.312756e-1],
+               [4.028559e-3, -3.697768e-2, 1.021332e-1, -1.201436e-1, 6.412774e-2]]
+    _sphe_q = [[1.0000000e0, 8.212018e-1, 2.078043e-1],
+               [1.0000000e0, 9.599102e-1, 2.918724e-1]]
+
+    @staticmethod
+    def _giveSpheroidal(nu):
+        """Prolate spheroidal function psi(nu) for |nu|<=1, 0 beyond"""
+        nu = np.abs(np.asarray(nu, np.float64))
+        psi = np.zeros_like(nu)
+        for part, (nu0, nu1) in enumerate([(0., 0.75), (0.75, 1.)]):
+            Sel = (nu >= nu0) & ((nu < nu1) if part == 0 else (nu <= nu1))
+            d = nu[Sel]**2 - nu1**2
+            psi[Sel] = np.polyval(ClassFacetMachine._sphe_p[part][::-1], d) / \
+                       np.polyval(ClassFacetMachine._sphe_q[part][::-1], d)
+        return psi
+
+    @staticmethod
+    def _giveAliasingError(Support, Padding, NSample=65, NAlias=8, NKernel=2001):
+        """
+        Largest aliasing error over a facet gridded on a grid Padding times larger than the facet. The gridder
+        tapers the padded facet with the prolate spheroidal psi(2x) (x in units of the padded field), so its
+        uv-kernel is the fixed (1-nu^2).psi(nu), nu=u/3 (u in cells, 6 cells wide), cut to Support cells.
+        The error at x (the facet covers |x|<1/(2.Padding)) is the sum of the grid correction function of
+        the cut kernel at the aliases x+k, relative to its value at x.
+        """
+        HalfWidth = min(float(Support), 6.) / 2
+        u = np.linspace(-HalfWidth, HalfWidth, NKernel)
+        nu = u / 3.
+        Kernel = (1 - nu**2) * ClassFacetMachine._giveSpheroidal(nu)
+        du = u[1] - u[0]
+        def GridCorr(x):
+            return np.dot(np.cos(2 * np.pi * np.outer(x, u)), Kernel) * du
+        x = np.linspace(0, 0.5 / Padding, NSample)
+        Alias = sum([GridCorr(x + k)**2 + GridCorr(x - k)**2 for k in xrange(1, NAlias + 1)])
+        return np.max(np.sqrt(Alias) / np.abs(GridCorr(x)))
+
+    def _giveMinPadding(self):
+        """
+        Smallest padding (in steps of 0.01, at most Facets-Padding) for an aliasing error below Facets-AliasingBudget,
+        for the smallest kernel support any facet can get (CF-AdaptiveMinSupport with CF-AdaptiveW, CF-Support otherwise)
+        """
+        if self._min_padding is None:
+            Budget = self.GD["Facets"].get("AliasingBudget", 1e-3) or 1e-3
+            Support = self.GD["CF"]["Support"]
+            if self.GD["CF"].get("AdaptiveW", False):
+                MinSupport = self.GD["CF"].get("AdaptiveMinSupport", 5) or 5
+                Support = min(Support, MinSupport + 1 - MinSupport % 2)
+            self._min_padding = self.Padding
+            for Padding in np.arange(1.05, self.Padding, 0.01):
+                if self._giveAliasingError(Support, Padding) <= Budget:
+                    self._min_padding = Padding
+                    break
+            else:
+                print>>log, "adaptive padding: the aliasing budget needs more than Facets-Padding=%.2f (support %i)" % \
+                    (self.Padding, Support)
+            print>>log, "adaptive padding: %.2f for an aliasing error below %g (support %i)" % \
+                (self._min_padding, Budget, Support)
+        return self._min_padding
+
+    @staticmethod
+    def _giveFFTSizes(NMin, NMax, Parity):
+        """Sizes between NMin and NMax, of the given parity, with no prime factors other than 2, 3, 5 and 7"""
+        ListSizes = []
+        for N in xrange(NMin + (NMin - Parity) % 2, NMax + 1, 2):
+            n = N
+            for p in (2, 3, 5, 7):
+                while n % p == 0:
+                    n //= p
+            if n == 1:
+                ListSizes.append(N)
+        return ListSizes
+
+    def _timeFFT(self, N, NTries=3):
+        """Best time of NTries 2D FFTs of size N, as done on the facet grids"""
+        Grid = np.zeros((N, N), self.CType)
+        fft = pyfftw.builders.fft2(Grid, overwrite_input=True, planner_effort="FFTW_ESTIMATE", threads=1)
+        Best = np.inf
+        for i in xrange(NTries):
+            t0 = time.time()
+            fft()
+            Best = min(Best, time.time() - t0)
+        return Best
+
+    def _giveFFTTableFile(self):
+        return "/".join([self._giveWisdomCachePath(), "FFTSizes.%s.json" % np.dtype(self.CType).name])
+
+    def _giveFFTTimes(self, ListSizes):
+        """
+        Returns the FFT times of the given sizes on this CPU type, from the table of timings kept with
+        the FFTW wisdom (FFTSizes.json), read once per facet machine. Sizes not in the table are given
+        by a N^2.log(N) cost model scaled to the largest measured size. Those up to Facets-FFTSizeBenchMax
+        are noted, to be measured for the next runs once the facets are laid out, see _timeFFTSizesInBackground().
+        """
+        if self._fft_times is None:
+            TableFile = self._giveFFTTableFile()
+            fh = _lockWisdomFile(TableFile)
+            try:
+                self._fft_times = json.load(open(TableFile)) if os.path.isfile(TableFile) else {}
+            except ValueError:
+                self._fft_times = {}
+            finally:
+                fh.close()
+        Table = self._fft_times
+        NBenchMax = self.GD["Facets"].get("FFTSizeBenchMax", 8192) or 8192
+        self._fft_sizes_missing.update([N for N in ListSizes if str(N) not in Table and N <= NBenchMax])
+        Times = {}
+        if Table:
+            NRef = max([int(N) for N in Table.keys()])
+            TRef = Table[str(NRef)] / (NRef**2 * np.log2(NRef))
+        else:
+            TRef = 1.
+        for N in ListSizes:
+            Times[N] = Table[str(N)] if str(N) in Table else TRef * N**2 * np.log2(N)
+        return Times
+
+    def _timeFFTSizesInBackground(self):
+        """
+        Measures the FFT sizes that _giveFFTTimes() found missing from the timing table, in a daemon thread,
+        so that the facet setup never waits for them. Each size is merged into the table (under the wisdom
+        lock, with an atomic replace) as soon as it is measured, so an early exit loses at most one.
+        """
+        if not self._fft_sizes_missing:
+            return
+        ListSizes = sorted(self._fft_sizes_missing)
+        self._fft_sizes_missing = set()
+        print>>log, "timing FFTs of sizes %s in the background, for the next runs" % ", ".join(map(str, ListSizes))
+        Timer = threading.Thread(target=self._timeFFTSizes, args=(self._giveFFTTableFile(), ListSizes))
+        Timer.daemon = True
+        Timer.start()
+
+    def _timeFFTSizes(self, TableFile, ListSizes):
+        """Body of the FFT timing thread, see _timeFFTSizesInBackground()"""
+        for N in ListSizes:
+            t = self._timeFFT(N)
+            fh = _lockWisdomFile(TableFile, Exclusive=True)
+            try:
+                try:
+                    Table = json.load(open(TableFile)) if os.path.isfile(TableFile) else {}
+                except ValueError:
+                    Table = {}
+                Table[str(N)] = t
+                fd, tmpname = tempfile.mkstemp(prefix=".FFTSizes.", dir=os.path.dirname(TableFile))
+                with os.fdopen(fd, "w") as tmpfile:
+                    json.dump(Table, tmpfile)
+                os.rename(tmpname, TableFile)
+            finally:
+                fh.close()
+
+    def _giveAdaptivePaddedSize(self, NpixFacet, NpixPaddedDefault):
+        """
+        Padded facet size for Facets-PaddingMode=Adaptive: the fastest FFT size (2/3/5/7 radices, same parity
+        as the default size, plus the default size itself) from the size needed for the aliasing budget up to
+        the larger of the default padded size and 10% above the aliasing size, so that a facet whose padding
+        can't shrink may still get a faster size than the default. A size larger than the smallest candidate
+        is only taken if its FFT is at least 10% faster.
+        """
+        NMin = min(NpixPaddedDefault, max(NpixFacet, int(np.ceil(NpixFacet * self._giveMinPadding()))))
+        NMax = max(NpixPaddedDefault, int(np.ceil(1.1 * NMin)))
+        ListSizes = sorted(set(self._giveFFTSizes(NMin, NMax, NpixPaddedDefault % 2)[:8] + [NpixPaddedDefault]))
+        Times = self._giveFFTTimes(ListSizes)
+        Best = ListSizes[0]
+        for N in ListSizes[1:]:
+            if Times[N] < 0.9 * Times[Best]:
+                Best = N
+        return Best
+
+    # ##############################################
+    # ##############################################
+
+    def setWisdom(self):
+        """
+        Set fft wisdom
+        """
+        import socket, os
+        from os.path import expanduser
+        if self.GD["RIME"]["FFTMachine"]!="FFTW": return
+        self.wisdom_cache_path_host = self._giveWisdomCachePath()
         self.wisdom_cache_file =  "/".join([self.wisdom_cache_path_host,"Wisdom.pickle"])
         #self.wisdom_cache_path_host="'%s'"%self.wisdom_cache_path_host
         #self.wisdom_cache_file="'%s'"%self.wisdom_cache_file
-        
-
-
-        if not os.path.isdir(self.wisdom_cache_path_host):
-            print>>log, "Wisdom file %s does not exist, create it" % (self.wisdom_cache_path_host)
-            os.makedirs(self.wisdom_cache_path_host)
 
-        if os.path.isfile(self.wisdom_cache_file):
+        DictWisdom = _readWisdomFile(self.wisdom_cache_file)
+        if DictWisdom is not None:
             print>>log, "Loading wisdom file %s" % (self.wisdom_cache_file)
-            DictWisdom = cPickle.load(file(self.wisdom_cache_file))
             pyfftw.import_wisdom(DictWisdom["Wisdom"])
             WisdomTypes=DictWisdom["WisdomTypes"]
         else:
             WisdomTypes=[]
 
-        HasTouchedWisdomFile = False
-        T=ClassTimeIt.ClassTimeIt("setWisdom")
-        T.disable()
-        for iFacet in sorted(self.DicoImager.keys()):
-            NPixPadded=self.DicoImager[iFacet]["NpixFacetPadded"]
-            if self.GD["RIME"]["Precision"]=="S":
-                TypeKey=(NPixPadded,np.complex64)
-            elif self.GD["RIME"]["Precision"]=="D":
-                TypeKey=(NPixPadded,np.complex128)
-
-            if TypeKey not in WisdomTypes:
-                HasTouchedWisdomFile = True
-                ModFFTW.learnFFTWWisdom(*TypeKey)
-                WisdomTypes.append(TypeKey)
-
-        NOut = self.OutImShape[-1]
-        TypeKey=(NOut,np.float32)
-        if TypeKey not in WisdomTypes:
-            HasTouchedWisdomFile = True
-            ModFFTW.learnFFTWWisdom(*TypeKey)
-            WisdomTypes.append(TypeKey)
+        if self.GD["RIME"]["Precision"]=="S":
+            FacetType=np.complex64
+        elif self.GD["RIME"]["Precision"]=="D":
+            FacetType=np.complex128
+        ListTypeKeys=[(self.DicoImager[iFacet]["NpixFacetPadded"],FacetType) for iFacet in sorted(self.DicoImager.keys())]
+        ListTypeKeys.append((self.OutImShape[-1],np.float32))
+        # sizes not in the store, and not already being learned for another facet machine
+        MissingTypeKeys=[]
+        for TypeKey in ListTypeKeys:
+            if TypeKey not in WisdomTypes and TypeKey not in MissingTypeKeys and \
+               TypeKey not in ClassFacetMachine._wisdom_learning:
+                MissingTypeKeys.append(TypeKey)
+
+        if MissingTypeKeys:
+            WisdomMode=self.GD["Cache"].get("WisdomMode","Background")
+            NCPU=self.GD["Cache"].get("WisdomNCPU",None) or max(1,self.GD["Parallel"]["NCPU"]//4)
+            if WisdomMode=="Serial":
+                print>>log, "Learning FFTW wisdom for %d sizes" % len(MissingTypeKeys)
+                for TypeKey in MissingTypeKeys:
+                    ModFFTW.learnFFTWWisdom(*TypeKey)
+                print>>log, "Saving wisdom file to %s"%self.wisdom_cache_file
+                _mergeWisdomFile(self.wisdom_cache_file, MissingTypeKeys)
+            else:
+                # don't hold up startup: the sizes are learned by a separate process (with its own small pool)
+                # and merged into the store when done, while this run plans its FFTs in estimate mode
+                print>>log, "Learning FFTW wisdom for %d sizes in the background (%d processes), using estimate-mode plans meanwhile" % \
+                    (len(MissingTypeKeys), NCPU)
+                proc=multiprocessing.Process(target=_learnWisdomInBackground,
+                                             args=(self.wisdom_cache_file, MissingTypeKeys, NCPU))
+                proc.start()
+                if not ClassFacetMachine._wisdom_processes:
+                    atexit.register(ClassFacetMachine.awaitWisdom, self.GD["Cache"].get("WisdomTimeout", 60))
+                ClassFacetMachine._wisdom_learning+=MissingTypeKeys
+                ClassFacetMachine._wisdom_processes.append(proc)
+                # FFTs planned by this process meanwhile (and by workers forked from it) use estimate mode;
+                # wisdom from a more thorough planner is still used for the sizes that have it
+                if hasattr(pyfftw, "config") and ClassFacetMachine._wisdom_effort is None:
+                    ClassFacetMachine._wisdom_effort = pyfftw.config.PLANNER_EFFORT
+                    pyfftw.config.PLANNER_EFFORT = "FFTW_ESTIMATE"
         self.FFTW_Wisdom = pyfftw.export_wisdom()
-        DictWisdom={"Wisdom":self.FFTW_Wisdom,
-                    "WisdomTypes":WisdomTypes}
 
-        if HasTouchedWisdomFile:
-            print>>log, "Saving wisdom file to %s"%self.wisdom_cache_file
-            cPickle.dump(DictWisdom, file(self.wisdom_cache_file, "w"))
 
+    def _isLearningWisdom(self, iFacet=None):
+        """True if the FFTW wisdom of the grid size of a facet (of any size, if None) is being learned in the background"""
+        if iFacet is None:
+            return bool(ClassFacetMachine._wisdom_learning)
+        NPix = self.DicoImager[iFacet]["NpixFacetPadded"]
+        return any([N == NPix for N, _ in ClassFacetMachine._wisdom_learning])
 
     def initCFInBackground (self, other_fm=None):
         # if we have another FacetMachine supplied, check if the same CFs apply
@@ -593,6 +1898,10 @@ class ClassFacetMachine():
                         ImagerMainFacet=self.GD["Image"], 
                         Facets=self.GD["Facets"], 
                         RIME=self.GD["RIME"])
+        if self.GD["CF"].get("AdaptiveW", False):
+            cachekey["DataWMax"] = self._giveDataWMax()
+        if self.GD["Facets"].get("PaddingMode", "Fixed") == "Adaptive":
+            cachekey["NpixFacetPadded"] = [self.DicoImager[iFacet]["NpixFacetPadded"] for iFacet in sorted(self.DicoImager.keys())]
         cachename = self._cf_cachename = "CF"
         # in oversize-PSF mode, make separate cache for PSFs
         if self.DoPSF and self.Oversize != 1:
@@ -603,14 +1912,15 @@ class ClassFacetMachine():
         # up to workers to load/save cache
         for iFacet in self.DicoImager.iterkeys():
             facet_dict = self._CF.addSubdict(iFacet)
-            APP.runJob("%s.InitCF.f%s"%(self._app_id, iFacet), self._initcf_worker,
-                            args=(iFacet, facet_dict.writeonly(), cachepath, cachevalid))
+            self._runJob("%s.InitCF.f%s"%(self._app_id, iFacet), self._initcf_worker,
+                            args=(iFacet, facet_dict.writeonly(), cachepath, cachevalid), iFacet=iFacet)
         #workers_res=APP.awaitJobResults("%s.InitCF.*"%self._app_id, progress="Init CFs")
 
 
     def _initcf_worker (self, iFacet, facet_dict, cachepath, cachevalid):
         """Worker method of InitParal"""
         path = "%s/%s.npz" % (cachepath, iFacet)
+        t0 = time.time()
         T=ClassTimeIt.ClassTimeIt("_initcf_worker")
         # try to load the cache, and copy it to the shared facet dict
         if cachevalid:
@@ -619,8 +1929,10 @@ class ClassFacetMachine():
                 for key, value in npzfile.iteritems():
                     facet_dict[key] = value
                 # validate dict
-                ClassDDEGridMachine.ClassDDEGridMachine.verifyCFDict(facet_dict, self.GD["CF"]["Nw"])
-                return "cached",path,iFacet
+                ClassDDEGridMachine.ClassDDEGridMachine.verifyCFDict(facet_dict, self.DicoImager[iFacet]["DicoConfigGM"]["Nw"])
+                if self._wmode == "WStacking":
+                    facet_dict["WStackNMinusOne"] = self._giveNMinusOne(iFacet)
+                return "cached",path,iFacet,self._giveJobStats("InitCF", iFacet, t0)
             except:
                 print>>log,traceback.format_exc()
                 print>>log, "Error loading %s, will re-generate"%path
@@ -651,6 +1963,8 @@ class ClassFacetMachine():
         # Will speedup degridding
         sw[sw<1e-3]=0.
         facet_dict["SW"] = sw
+        if self._wmode == "WStacking":
+            facet_dict["WStackNMinusOne"] = self._giveNMinusOne(iFacet)
 
         # Initialize a grid machine per iFacet, this will implicitly compute wterm and Sphe
         self._createGridMachine(iFacet, cf_dict=facet_dict, compute_cf=True)
@@ -668,15 +1982,17 @@ class ClassFacetMachine():
         #         DoPrintErr=True
         #         print>>log,ModColor.Str("Failed to save %s"%path)
         #         time.sleep(1.)
-        return "compute",path, iFacet
+        return "compute",path, iFacet, self._giveJobStats("InitCF", iFacet, t0)
 
     def awaitInitCompletion (self):
         if not self.IsDDEGridMachineInit:
-            workers_res=APP.awaitJobResults("%s.InitCF.*"%self._app_id, progress="Init CFs")
+            workers_res=self._awaitJobResults("%s.InitCF.*"%self._app_id, progress="Init CFs")
             self._CF.reload()
+            self._accountSHM("CFPSF" if self.DoPSF else "CF", self._CF)
             # mark cache as safe
             for res in workers_res:
-                Type,path,iFacet=res
+                Type,path,iFacet,Stats=res
+                self._recordJobStats(Stats)
                 if Type=="compute":
                     #print iFacet
                     facet_dict=self._CF[iFacet]
@@ -700,7 +2016,7 @@ class ClassFacetMachine():
         """Helper method for workers: creates a GridMachine with the given extra keyword arguments"""
         FacetInfo = self.DicoImager[iFacet]
         return ClassDDEGridMachine.ClassDDEGridMachine(
-            self.GD,
+            self._giveGridMachineGD(iFacet),
             FacetInfo["DicoConfigGM"]["ChanFreq"],
             FacetInfo["DicoConfigGM"]["NPix"],
             FacetInfo["lmShift"],
@@ -709,8 +2025,207 @@ class ClassFacetMachine():
             self.VS.StokesConverter.RequiredStokesProductsIds(),
             **kw)
 
+    def _giveCFPars(self, iFacet):
+        """
+        Returns the (wmax, Nw, Support) of the W-kernels of a facet. In W-stacking mode, the kernels
+        only cover the residual w within a plane, i.e. up to half the plane width, with the same
+        w-spacing as W-projection would use (or RIME-WStackNw kernels). In CF-AdaptiveW mode, see
+        _giveAdaptiveWPars().
+        """
+        wmax, Nw, Support = self.GD["CF"]["wmax"], self.GD["CF"]["Nw"], self.GD["CF"]["Support"]
+        if self._wmode == "WStacking":
+            NPlanes = len(self._wplanes)
+            wmax = wmax / float(NPlanes)
+            Nw = self.GD["RIME"].get("WStackNw") or max(2, int(np.ceil(Nw / float(NPlanes))))
+        if self.GD["CF"].get("AdaptiveW", False):
+            wmax, Nw, Support = self._giveAdaptiveWPars(iFacet, wmax, Nw, Support)
+        return wmax, Nw, Support
+
+    def _giveDataWMax(self):
+        """
+        Returns the largest |w| (in metres) of the measurement sets, cached in the VS cache,
+        or CF-wmax if the measurement sets can't be read
+        """
+        if self._data_wmax is not None:
+            return self._data_wmax
+        ListMSName = [getattr(MS, "MSName", None) for MS in self.VS.ListMS]
+        if None in ListMSName:
+            self._data_wmax = float(self.GD["CF"]["wmax"])
+            return self._data_wmax
+        WMax, cachepath = self._loadCachedImage("WMax", dict(MSName=ListMSName))
+        if WMax is None:
+            from pyrap.tables import table
+            WMax = 0.
+            for MSName in ListMSName:
+                t = table(MSName, ack=False)
+                NRow = t.nrows()
+                # read UVW by pieces, so as not to load the whole column at once
+                for row0 in xrange(0, NRow, 1000000):
+                    w = t.getcol("UVW", row0, min(1000000, NRow - row0))[:, 2]
+                    if w.size:
+                        WMax = max(WMax, np.abs(w).max())
+                t.close()
+            WMax = np.array([WMax])
+            self._saveCachedImage("WMax", cachepath, WMax)
+        self._data_wmax = float(WMax[0])
+        print>>log, "largest |w| in the data is %.1fm" % self._data_wmax
+        return self._data_wmax
+
+    def _giveAdaptiveWPars(self, iFacet, wmax, Nw, Support):
+        """
+        Sizes the W-kernels of a facet for a w-term phase error of at most CF-AdaptiveWTol (radians).
+        Over the padded facet, the w-term is exp(2i.pi.w.(n-n0)), n0 at the facet centre:
+          - with kernels every dw, the w of a visibility is off by at most dw/2, so dw=Tol/(pi.max|n-n0|)
+            at the highest frequency, and Nw covers the largest |w| of the data (at most CF-Nw kernels)
+          - the kernel spreads a visibility over w.max|grad(n)| wavelengths on each side, i.e.
+            w.max|grad(n)|.2R uv-cells for a facet of padded radius R, added to CF-AdaptiveMinSupport
+            (at most CF-Support)
+        Small and central facets thus get few, small kernels.
+        """
+        Tol = self.GD["CF"].get("AdaptiveWTol", 0.1) or 0.1
+        MinSupport = self.GD["CF"].get("AdaptiveMinSupport", 5) or 5
+        wmax = min(wmax, self._giveDataWMax())
+        wmaxLambda = wmax * np.max(self.VS.GlobalFreqs) / 299792458.
+
+        lc, mc = self.DicoImager[iFacet]["lmShift"]
+        l0, l1, m0, m1 = self.DicoImager[iFacet]["lmExtentPadded"]
+        l, m = np.mgrid[l0:l1:9j, m0:m1:9j]
+        n = np.sqrt(np.maximum(1e-6, 1. - l**2 - m**2))
+        nc = np.sqrt(max(1e-6, 1. - lc**2 - mc**2))
+        dN = np.max(np.abs(n - nc))
+        GradN = np.max(np.sqrt(l**2 + m**2) / n)
+
+        if dN > 0 and wmaxLambda > 0:
+            dwLambda = Tol / (np.pi * dN)
+            NwFacet = int(np.ceil(wmaxLambda / dwLambda)) + 1
+        else:
+            NwFacet = 2
+        NwFacet = int(min(Nw, max(2, NwFacet)))
+
+        RadiusPadded = self.DicoImager[iFacet]["RadiusFacetPadded"]
+        HalfWidth = int(np.ceil(wmaxLambda * GradN * 2 * RadiusPadded))
+        SupportFacet = MinSupport + 2 * HalfWidth
+        SupportFacet = int(min(Support, max(MinSupport, SupportFacet)))
+        # kernels have odd supports
+        SupportFacet += 1 - SupportFacet % 2
+        return wmax, NwFacet, SupportFacet
+
+    def _giveGridMachineGD(self, iFacet):
+        """Returns the GD given to the GridMachine of a facet: a copy with its own CF section if the
+        W-kernels of the facet differ from GD["CF"]"""
+        DicoConfigGM = self.DicoImager[iFacet]["DicoConfigGM"]
+        wmax, Nw, Support = DicoConfigGM["wmax"], DicoConfigGM["Nw"], DicoConfigGM["Support"]
+        CF = self.GD["CF"]
+        if (wmax, Nw, Support) == (CF["wmax"], CF["Nw"], CF["Support"]):
+            return self.GD
+        GD = copy.copy(self.GD)
+        GD["CF"] = copy.copy(CF)
+        GD["CF"]["wmax"], GD["CF"]["Nw"], GD["CF"]["Support"] = wmax, Nw, Support
+        return GD
+
+    # ##############################################
+    # ##### W-stacking #############################
+
+    def _giveWPlanes(self):
+        """Returns the w (in metres) of the centres of the w-planes: RIME-NWPlanes planes of equal
+        width over [-CF-wmax, CF-wmax] in W-stacking mode, a single plane at w=0 otherwise"""
+        if self._wmode != "WStacking":
+            return np.zeros(1, np.float64)
+        NPlanes = max(1, self.GD["RIME"].get("NWPlanes", 8) or 8)
+        wmax = float(self.GD["CF"]["wmax"])
+        Width = 2 * wmax / NPlanes
+        return -wmax + (np.arange(NPlanes) + 0.5) * Width
+
+    def _giveWGridKey(self, iFacet, iPlane):
+        """Key of the grid of w-plane iPlane of a facet in the grids dict. Plane 0 uses the facet number,
+        so that the grid holding the (summed) facet image after the FFT is where the rest of the code expects it"""
+        return iFacet if iPlane == 0 else "%i.W%i" % (iFacet, iPlane)
+
+    def _setWPlanes(self, DATA, BDAKey):
+        """
+        Assigns every BDA block of DATA[BDAKey] to the w-plane nearest to its mean w (blocks beyond
+        CF-wmax go to the outermost planes), and makes a copy of the uvw with the w of each row taken
+        relative to the centre of its plane. Blocks, rather than rows, are assigned so that the
+        gridder selects the rows of a plane through its sparsification vector.
+        Sets DATA["WPlane.<BDAKey>"] and DATA["uvw.<BDAKey>"], once per chunk. The uvw copy lives in
+        the (shared) chunk dict for as long as the chunk, so it is checked against the SHM budget.
+        """
+        PlaneKey = "WPlane.%s" % BDAKey
+        if self._wmode != "WStacking" or PlaneKey in DATA:
+            return
+        BlockOfRow, Rows, ChanStart, _ = self._giveBDABlocks(DATA[BDAKey])
+        NBlocks = ChanStart.size
+        uvw = DATA["uvw"]
+        wBlock = np.bincount(BlockOfRow, weights=uvw[Rows, 2], minlength=NBlocks) / \
+                 np.maximum(np.bincount(BlockOfRow, minlength=NBlocks), 1)
+        wmax = float(self.GD["CF"]["wmax"])
+        NPlanes = len(self._wplanes)
+        PlaneOfBlock = np.int32(np.floor((wBlock + wmax) / (2 * wmax) * NPlanes))
+        PlaneOfBlock = np.clip(PlaneOfBlock, 0, NPlanes - 1)
+        self._checkSHM("uvw.%s" % BDAKey, uvw.nbytes)
+        uvwPlane = uvw.copy()
+        uvwPlane[Rows, 2] -= self._wplanes[PlaneOfBlock[BlockOfRow]]
+        DATA[PlaneKey] = PlaneOfBlock
+        DATA["uvw.%s" % BDAKey] = uvwPlane
+
+    @staticmethod
+    def _giveWPlaneSelection(DATA, BDAKey, Sparsification):
+        """Yields (iPlane, sparsification vector of the blocks of that plane) for the non-empty w-planes"""
+        PlaneOfBlock = DATA["WPlane.%s" % BDAKey]
+        if Sparsification is not None and len(Sparsification):
+            PlaneOfBlock = np.where(Sparsification, PlaneOfBlock, -1)
+        for iPlane in np.unique(PlaneOfBlock):
+            if iPlane >= 0:
+                yield iPlane, PlaneOfBlock == iPlane
+
+    def _giveNMinusOne(self, iFacet):
+        """(n-1) at the pixel centres of the padded facet (pixel Npix/2 at the facet centre), for the w-term
+        of the w-planes. Made once per facet, in the CF dict, see _initcf_worker()"""
+        Npix = self.DicoImager[iFacet]["NpixFacetPadded"]
+        l0, m0 = self.DicoImager[iFacet]["lmShift"]
+        Offsets = (np.arange(Npix) - Npix // 2) * self.CellSizeRad
+        l, m = np.meshgrid(l0 + Offsets, m0 + Offsets, indexing="ij")
+        return np.float32(np.sqrt(np.maximum(0., 1. - l**2 - m**2)) - 1.)
+
+    def _giveWPhases(self, cf_dict, Freqs, Sign=1):
+        """
+        Yields (iPlane, image-domain w-term exp(Sign*2i.pi.w.(n-1)) of the plane) over the padded facet, for
+        all w-planes in turn, one per frequency (shape [nfreq,1,Npix,Npix]). The gridder phase-shifts each facet
+        with the w relative to its plane, so the w of the plane centre multiplies (n-1) of the absolute sky
+        position. The planes are equally spaced, so only the first plane and the step between planes take
+        an exponential; the others are products.
+        Applying it at the band (rather than channel) frequency leaves a phase error of w(n-1).dnu/c,
+        which is negligible over a band.
+        """
+        NMinusOne = cf_dict["WStackNMinusOne"]
+        Npix = NMinusOne.shape[0]
+        Step = self._wplanes[1] - self._wplanes[0] if len(self._wplanes) > 1 else 0.
+        Phase = np.empty((len(Freqs), 1, Npix, Npix), np.complex128)
+        PhaseStep = np.empty_like(Phase)
+        for i, Freq in enumerate(Freqs):
+            Phase[i, 0] = np.exp(Sign * 2j * np.pi * self._wplanes[0] * Freq / 299792458. * NMinusOne)
+            PhaseStep[i, 0] = np.exp(Sign * 2j * np.pi * Step * Freq / 299792458. * NMinusOne)
+        for iPlane in xrange(len(self._wplanes)):
+            if iPlane:
+                Phase *= PhaseStep
+            yield iPlane, Phase
+
+    # ##############################################
+    # ##############################################
+
     def ToCasaImage(self, ImageIn, Fits=True, ImageName=None,
-                    beam=None, beamcube=None, Freqs=None, Stokes=["I"]):
+                    beam=None, beamcube=None, Freqs=None, Stokes=["I"], kind="Dirty"):
+        """
+        Writes ImageIn as a CASA image (and FITS, if Fits=True). If ImageIn is None, the stitched
+        image of the given kind is streamed from the facet grids into ImageName.fits instead, by a
+        background thread (see FacetsToFitsInBackground()), and the writer thread is returned.
+        """
+        if ImageIn is None:
+            if not Fits:
+                raise RuntimeError("stitched images can only be streamed to FITS")
+            if ImageName is None:
+                ImageName = self.ImageName
+            return self.FacetsToFitsInBackground("%s.fits" % ImageName, kind=kind, Freqs=Freqs, Stokes=Stokes, beam=beam)
         self.setCasaImage(ImageName=ImageName, Shape=ImageIn.shape,
                           Freqs=Freqs, Stokes=Stokes)
 
@@ -723,13 +2238,168 @@ class ClassFacetMachine():
         self.CasaImage.close()
         self.CasaImage = None
 
-    def GiveEmptyMainField(self):
+    def _giveFitsHeader(self, Shape, Freqs=None, Stokes=["I"], beam=None):
+        """Makes a FITS header for a stitched image cube of the given shape (nch, npol, Npix, Npix)"""
+        from astropy.io import fits
+        nch, npol, NPix, _ = Shape
+        rac, decc = self.MainRaDec
+        header = fits.Header()
+        header["SIMPLE"] = True
+        header["BITPIX"] = -32
+        header["NAXIS"] = 4
+        header["NAXIS1"] = NPix
+        header["NAXIS2"] = NPix
+        header["NAXIS3"] = npol
+        header["NAXIS4"] = nch
+        header["BUNIT"] = "JY/BEAM"
+        header["EQUINOX"] = 2000.
+        header["RADESYS"] = "FK5"
+        for iAxis, ctype, crval, cdelt in ((1, "RA---SIN", rac * 180 / np.pi, -self.Cell / 3600.),
+                                           (2, "DEC--SIN", decc * 180 / np.pi, self.Cell / 3600.)):
+            header["CTYPE%i" % iAxis] = ctype
+            header["CRPIX%i" % iAxis] = NPix / 2 + 1
+            header["CRVAL%i" % iAxis] = crval
+            header["CDELT%i" % iAxis] = cdelt
+            header["CUNIT%i" % iAxis] = "deg"
+        header["CTYPE3"] = "STOKES"
+        header["CRPIX3"] = 1
+        header["CRVAL3"] = "IQUV".index(Stokes[0]) + 1
+        header["CDELT3"] = 1
+        if Freqs is None:
+            Freqs = [np.mean(self.ChanFreq)]
+        header["CTYPE4"] = "FREQ"
+        header["CRPIX4"] = 1
+        header["CRVAL4"] = Freqs[0]
+        header["CDELT4"] = Freqs[1] - Freqs[0] if len(Freqs) > 1 else 1.
+        header["CUNIT4"] = "Hz"
+        if beam is not None:
+            header["BMAJ"], header["BMIN"], header["BPA"] = beam
+        return header
+
+    def FacetsToFitsInBackground(self, ImageName, kind="Dirty", Freqs=None, Stokes=["I"], beam=None,
+                                 NormImage=None, AddImage=None, NRowsTile=256):
+        """
+        Stitches the facet grids straight into a FITS file, band by band, in tiles of NRowsTile
+        image rows, so that the full stitched cube never has to be in memory. The file is written
+        by a background thread; use awaitFitsWriters() to wait for it. The facet grids are
+        not reset by ReinitDirty() until all writers are done.
+        Preconditions: FacetsToIm() has been called, so the grids are Fourier transformed and
+        the normalization terms are computed.
+        Args:
+            ImageName: name of the output FITS file
+            kind: "Dirty" or "PSF", which must match the kind of grids this facet machine makes
+            NormImage: if given, stitched tiles are divided by this (e.g. the square root of the JonesNorm)
+            AddImage: if given (for example a restored model), this is added to the stitched tiles
+                      after normalization. Both images are indexed as (nch or 1, npol or 1, Npix, Npix),
+                      and may be memory-mapped.
+        Returns:
+            the writer thread
+        """
+        if kind not in ("Dirty", "PSF"):
+            raise RuntimeError,"unknown kind=%s argument -- this is a silly bug"%kind
+        if (kind == "PSF") != bool(self.DoPSF):
+            raise RuntimeError("can't write a %s image from the grids of a %s facet machine" %
+                               (kind, "PSF" if self.DoPSF else "dirty"))
+        if self._facet_grids is None and self.DoPSF:
+            raise RuntimeError("the PSF facet grids were given up after FacetsToIm(): set Facets-RecyclePSFGrids=0 "
+                               "to stream the PSF to FITS")
+        if not self.HasFourierTransformed:
+            raise RuntimeError("FacetsToIm() must be called before writing the stitched image. This is a bug!")
+        header = self._giveFitsHeader(self.OutImShape, Freqs=Freqs, Stokes=Stokes, beam=beam)
+        Writer = threading.Thread(target=self._writeFacetsToFits,
+                                  args=(ImageName, kind, header, NormImage, AddImage, NRowsTile))
+        Writer.start()
+        self._fits_writers.append(Writer)
+        return Writer
+
+    def awaitFitsWriters(self):
+        """Waits for all background FITS writers to finish"""
+        for Writer in self._fits_writers:
+            if Writer.isAlive():
+                print>>log, "waiting for background FITS writer to finish"
+            Writer.join()
+        self._fits_writers = []
+
+    def _writeFacetsToFits(self, ImageName, kind, header, NormImage, AddImage, NRowsTile):
+        """
+        Worker of FacetsToFitsInBackground(). A FITS image plane is the stitched image flipped and
+        transposed (see ClassCasaImage.setdata with CorrT=True), so rows [i0,i1) of the FITS
+        plane are columns [i0,i1) of the stitched image, read backwards.
+        """
+        from astropy.io import fits
+        nch, npol, NPixOut, NPixOut = self.OutImShape
+        FacetNorm = self._norm_dict["FacetNorm"]
+        print>>log, "Writing stitched %s image %s in tiles of %i rows" % (kind, ImageName, NRowsTile)
+        HDU = fits.StreamingHDU(ImageName, header)
+        # facet edges in the stitched image
+        FacetEdges = {}
+        for iFacet in self.DicoImager.keys():
+            xc, yc = self.DicoImager[iFacet]["pixCentral"]
+            NpixFacet = self.DicoGridMachine[iFacet]["Dirty"].shape[-1]
+            FacetEdges[iFacet] = GiveEdges((xc, yc), NPixOut, (NpixFacet/2, NpixFacet/2), NpixFacet)
+
+        for Channel in xrange(nch):
+            for pol in xrange(npol):
+                for i0 in xrange(0, NPixOut, NRowsTile):
+                    i1 = min(i0 + NRowsTile, NPixOut)
+                    Tile = np.zeros((NPixOut, i1 - i0), self.stitchedType)
+                    for iFacet, (Aedge, Bedge) in FacetEdges.iteritems():
+                        x0main, x1main, y0main, y1main = Aedge
+                        x0facet, x1facet, y0facet, y1facet = Bedge
+                        ya, yb = max(y0main, i0), min(y1main, i1)
+                        if ya >= yb:
+                            continue
+                        # facet columns [yfa,yfb) are rows [Nf-yfb,Nf-yfa) of the (unflipped) facet image
+                        yfa, yfb = y0facet + ya - y0main, y0facet + yb - y0main
+                        Grid = self.DicoGridMachine[iFacet]["Dirty"]
+                        Nf = Grid.shape[-1]
+                        r0, r1 = Nf - yfb, Nf - yfa
+                        ThisSumWeights = self.DicoImager[iFacet]["SumWeights"][Channel]
+                        ThisSumJones = self.DicoImager[iFacet]["SumJonesNorm"][Channel]
+                        weights = ThisSumWeights[pol]*np.sqrt(ThisSumJones)
+                        SPhe = self._CF[iFacet]["Sphe"][r0:r1]
+                        InvSPhe = self._CF[iFacet]["InvSphe"][r0:r1]
+                        SpacialWeigth = self._CF[iFacet]["SW"].T[::-1, :][r0:r1]
+                        Im = Grid[Channel, pol, r0:r1].real.copy()
+                        numexpr.evaluate('Im*InvSPhe*SpacialWeigth/weights',out=Im,casting="unsafe")
+                        Im[SPhe < 1e-3] = 0
+                        Im = Im[::-1, x0facet:x1facet].T
+                        a = Tile[x0main:x1main, ya - i0:yb - i0]
+                        numexpr.evaluate('a+Im',out=a,casting="unsafe")
+                    Tile /= FacetNorm[:, i0:i1]
+                    if NormImage is not None:
+                        Tile /= NormImage[min(Channel, NormImage.shape[0]-1), min(pol, NormImage.shape[1]-1)][:, i0:i1]
+                    if AddImage is not None:
+                        Tile += AddImage[min(Channel, AddImage.shape[0]-1), min(pol, AddImage.shape[1]-1)][:, i0:i1]
+                    HDU.write(np.ascontiguousarray(Tile[::-1].T, dtype=">f4"))
+        HDU.close()
+        print>>log, "Wrote stitched %s image %s" % (kind, ImageName)
+
+    def GiveEmptyMainField(self, Shape=None):
         """
-        Gives empty image of the correct shape to act as buffer for e.g. the stitching process
+        Gives empty image of the correct shape (default self.OutImShape) to act as buffer for e.g. the stitching process
         Returns:
             ndarray of type complex
+        In out-of-core mode, this is a memory-mapped scratch file, unlinked straight away so
+        that it disappears with the array.
         """
-        return np.zeros(self.OutImShape, dtype=self.stitchedType)
+        if self._out_of_core:
+            fd, filename = tempfile.mkstemp(suffix=".npy", prefix="DDF.Stitched.", dir=self._scratch_dir)
+            os.close(fd)
+            Image = np.lib.format.open_memmap(filename, mode="w+", dtype=self.stitchedType, shape=Shape or self.OutImShape)
+            os.unlink(filename)
+            return Image
+        return np.zeros(Shape or self.OutImShape, dtype=self.stitchedType)
+
+    def _giveMeanImage(self, Cube, WBAND):
+        """Band-weighted mean of a stitched cube. In out-of-core mode, it is summed band by band into a memory-mapped image"""
+        nch, npol, Npix, _ = Cube.shape
+        if not self._out_of_core:
+            return np.sum(Cube * WBAND, axis=0).reshape((1, npol, Npix, Npix))
+        Mean = self.GiveEmptyMainField(Shape=(1, npol, Npix, Npix))
+        for Channel in xrange(nch):
+            Mean[0] += Cube[Channel] * WBAND[Channel]
+        return Mean
 
     def putChunkInBackground(self, DATA):
         """
@@ -750,20 +2420,59 @@ class ClassFacetMachine():
 
 
     def setModelImage(self, ModelImage):
-        """Sets current model image. Copies it to a shared dict and returns shared array version of image."""
+        """Sets current model image. Copies it to a shared dict and returns shared array version of image.
+        If ModelImage is the buffer given by giveModelImageBuffer(), nothing is copied. If a persistent
+        buffer of the same shape exists, the model is copied into it, without reallocating."""
         if self.DoPSF:
             raise RuntimeError("Can't call getChunk on a PSF mode FacetMachine. This is a bug!")
-        self._model_dict = shared_dict.create("Model")
+        if self._model_persistent and self._model_dict["Image"].shape != ModelImage.shape:
+            self.releaseModelImage(force=True)
+        if self._model_persistent:
+            Image = self._model_dict["Image"]
+            if ModelImage.__array_interface__["data"][0] != Image.__array_interface__["data"][0]:
+                Image[...] = ModelImage
+            return Image
+        self._model_dict = self._createSHMDict("Model", ModelImage.nbytes)
         self._model_dict["Image"] = ModelImage
         for iFacet in range(self.NFacets):
             self._model_dict.addSubdict(iFacet)
+        self._accountSHM("Model", self._model_dict)
+        return self._model_dict["Image"]
+
+    def giveModelImageBuffer(self, Shape=None):
+        """
+        Returns a persistent model image in shared memory, owned by the facet machine.
+        The deconvolution machine can build its model straight into this buffer and update
+        it in place between major cycles: setModelImage() then has nothing to copy, and
+        releaseModelImage() leaves it alone.
+        Args:
+            Shape: shape of the model cube (defaults to OutImShape)
+        """
+        if self.DoPSF:
+            raise RuntimeError("Can't call giveModelImageBuffer on a PSF mode FacetMachine. This is a bug!")
+        Shape = tuple(Shape or self.OutImShape)
+        if self._model_persistent and self._model_dict is not None:
+            if self._model_dict["Image"].shape == Shape:
+                return self._model_dict["Image"]
+        self.releaseModelImage(force=True)
+        self._model_dict = self._createSHMDict("Model", int(np.prod(Shape)) * np.dtype(self.stitchedType).itemsize)
+        self._model_dict.addSharedArray("Image", Shape, self.stitchedType)
+        for iFacet in self.DicoImager.keys():
+            self._model_dict.addSubdict(iFacet)
+        self._accountSHM("Model", self._model_dict)
+        self._model_persistent = True
         return self._model_dict["Image"]
 
-    def releaseModelImage(self):
-        """Deletes current model image from SHM. USe to save RAM."""
+    def releaseModelImage(self, force=False):
+        """Deletes current model image from SHM. USe to save RAM.
+        A persistent buffer from giveModelImageBuffer() is only deleted if force=True."""
+        if self._model_persistent and not force:
+            return
         if self._model_dict is not None:
+            self._releaseSHM("Model")
             self._model_dict.delete()
             self._model_dict = None
+        self._model_persistent = False
 
     def FacetsToIm(self, NormJones=False):
         """
@@ -792,6 +2501,7 @@ class ClassFacetMachine():
             "freqs" = channel information on the bands being averaged into each of the continuum slices of the residual
             "SumWeights" = sum of visibility weights used in normalizing the gridded correlations
             "WeightChansImages" = normalized weights
+            In out-of-core mode this is a ClassMemmapImages, which keeps "ImagData" and "MeanImage" memory-mapped.
         """
         # wait for any outstanding grid jobs to finish
         self.collectGriddingResults()
@@ -801,7 +2511,13 @@ class ClassFacetMachine():
             self.collectFourierTransformResults()
             self.HasFourierTransformed = True
         _, npol, Npix, Npix = self.OutImShape
-        DicoImages = shared_dict.create("%s_AllImages"%self._app_id)
+        # (at least a stitched cube will be put into it)
+        if self._out_of_core:
+            # the stitched cubes stay in their memory-mapped scratch files, see ClassMemmapImages
+            DicoImages = ClassMemmapImages(self._createSHMDict("%s_AllImages" % self._app_id, 0))
+        else:
+            DicoImages = self._createSHMDict("%s_AllImages" % self._app_id,
+                                             int(np.prod(self.OutImShape)) * np.dtype(self.stitchedType).itemsize)
         DicoImages["freqs"] = {}
         DicoImages.addSubdict("freqs")
         DicoImages.addSubdict("ImageInfo")
@@ -837,7 +2553,16 @@ class ClassFacetMachine():
         # build Jones amplitude image
         DoCalcJonesNorm = NormJones and not "JonesNorm" in self._norm_dict
         if DoCalcJonesNorm:
-            self._norm_dict["JonesNorm"] = self.FacetsToIm_Channel("Jones-amplitude")
+            # the Jones amplitude image depends on the facet geometry, on the beam and solutions the per-facet
+            # Jones averages are made of, and on the visibility weights, rows and flags they are averaged over
+            cachekey = dict(FacetNorm=self._giveFacetNormCacheKey(),
+                            Beam=self.GD["Beam"], DDESolutions=self.GD["DDESolutions"],
+                            Weight=self.GD["Weight"], Selection=self.GD["Selection"], Data=self.GD["Data"])
+            JonesNorm, cachepath = self._loadCachedImage("JonesNorm", cachekey)
+            if JonesNorm is None:
+                JonesNorm = self.FacetsToIm_Channel("Jones-amplitude")
+                self._saveCachedImage("JonesNorm", cachepath, JonesNorm)
+            self._norm_dict["JonesNorm"] = JonesNorm
 
         JonesNorm = self._norm_dict["JonesNorm"]
 
@@ -991,7 +2716,7 @@ class ClassFacetMachine():
 
             DicoImages["ImagData"] = self.FacetsToIm_Channel("PSF")
             if self.VS.MultiFreqMode:
-                DicoImages["MeanImage"] = np.sum(DicoImages["ImagData"] * WBAND, axis=0).reshape((1, npol, Npix, Npix))
+                DicoImages["MeanImage"] = self._giveMeanImage(DicoImages["ImagData"], WBAND)
             else:
                 DicoImages["MeanImage"] = DicoImages["ImagData"]
 
@@ -1005,28 +2730,27 @@ class ClassFacetMachine():
             # print>>log,"copying dictPSF"
             DicoImages.reload()
             self._psf_dict = DicoImages
+            self._accountSHM("%s_AllImages" % self._app_id, DicoImages)
+            # the PSF is now in DicoImages, so this facet machine is done with its grids: they are given up
+            # as soon as it is, rather than held until it goes
+            if self.GD["Facets"].get("RecyclePSFGrids", True):
+                self.recycleGrids()
             return DicoImages
 
         # else build Dirty (residual) image
         else:
 
-            DicoImages.addSubdict("FacetMeanResidual")
-            for iFacet in sorted(self.DicoImager.keys()):
-                DicoImages["FacetMeanResidual"].addSubdict(iFacet)
-                nch,npol,npix_x,npix_y=self.DicoGridMachine[iFacet]["Dirty"].shape
-                ThisW=self.DicoImager[iFacet]["SumWeights"].reshape((self.VS.NFreqBands,npol,1,1))
-                SumJonesNorm=np.sqrt(self.DicoImager[iFacet]["SumJonesNorm"])
-                if np.max(SumJonesNorm)>0.:
-                    ThisW=ThisW*SumJonesNorm.reshape((self.VS.NFreqBands,1,1,1))
-                ThisDirty=self.DicoGridMachine[iFacet]["Dirty"].real/ThisW
-                DicoImages["FacetMeanResidual"][iFacet]=np.sum(ThisDirty*WBAND,axis=0).reshape((1,npol,npix_x,npix_y))
-                DicoImages["FacetMeanResidual"][iFacet]=DicoImages["FacetMeanResidual"][iFacet]/self._CF[iFacet]["Sphe"]
+            # the per-facet mean residuals are only needed to restore facets (see giveRestoredFacets()),
+            # so outside of RestoreAndShift mode they are only built on demand, from the facet grids
+            self._facet_mean_wband = WBAND
+            if self.GD["Image"]["Mode"] == "RestoreAndShift":
+                self._buildFacetMeanResidual(DicoImages)
                 
             # Build a residual image consisting of multiple continuum bands
             stitchedResidual = self.FacetsToIm_Channel("Dirty")
 
             if self.VS.MultiFreqMode:
-                MeanResidual = np.sum(stitchedResidual * WBAND, axis=0).reshape((1, npol, Npix, Npix))
+                MeanResidual = self._giveMeanImage(stitchedResidual, WBAND)
             else:
                 ### (Oleg 24/12/2016: removed the .copy(), why was this needed? Note that in e.g.
                 ### ClassImageDeconvMachineMSMF.SubStep(), there is an if-clause such as
@@ -1037,6 +2761,7 @@ class ClassFacetMachine():
             DicoImages["MeanImage"] = MeanResidual
             DicoImages["FacetNorm"] = FacetNorm  # grid-correcting map
             DicoImages["JonesNorm"] = JonesNorm
+            self._accountSHM("%s_AllImages" % self._app_id, DicoImages)
             return DicoImages
 
     def getNormDict(self): return self._norm_dict
@@ -1068,6 +2793,7 @@ class ClassFacetMachine():
             # put arrays into shared
             self._norm_dict["FacetNorm"]=FacetNorm
             self._norm_dict["FacetNormReShape"]=FacetNormReShape
+            self._accountSHM("normDict", self._norm_dict)
             
             self.DoCalcJonesNorm = False
 
@@ -1077,6 +2803,41 @@ class ClassFacetMachine():
         self.FacetNormReShape=self._norm_dict["FacetNormReShape"]
 
 
+    def _giveFacetNormCacheKey(self):
+        """
+        Cache key of the facet-normalisation image: the facet geometry (image shape and cell, facet centres
+        and padded sizes) and the options the spatial weights depend on. Nothing else in GD["Image"] or
+        GD["RIME"] changes the image, and keying on them would make the cache miss needlessly.
+        """
+        Facets = sorted(self.DicoImager.keys())
+        return dict(ImagerCF=self.GD["CF"],
+                    Facets=self.GD["Facets"],
+                    Cell=self.GD["Image"]["Cell"],
+                    Oversize=self.Oversize,
+                    OutImShape=list(self.OutImShape),
+                    pixCentral=[[int(x) for x in self.DicoImager[iFacet]["pixCentral"]] for iFacet in Facets],
+                    NpixFacetPadded=[self.DicoImager[iFacet]["NpixFacetPadded"] for iFacet in Facets])
+
+    def _loadCachedImage(self, cachename, cachekey):
+        """
+        Looks up an image in the VS cache. Returns the image (memory-mapped from the cache) on a hit,
+        None otherwise, and the path to save the image to with _saveCachedImage().
+        """
+        cachepath, cachevalid = self.VS.maincache.checkCache(cachename, cachekey)
+        if cachevalid:
+            try:
+                Image = np.load(cachepath, mmap_mode="r")
+                print>>log, "  loaded cached %s image from %s" % (cachename, cachepath)
+                return Image, cachepath
+            except:
+                print>>log, traceback.format_exc()
+                print>>log, "Error loading %s, will re-generate" % cachepath
+        return None, cachepath
+
+    def _saveCachedImage(self, cachename, cachepath, Image):
+        np.save(file(cachepath, "w"), Image)
+        self.VS.maincache.saveCache(cachename)
+
     def BuildFacetNormImage(self):
         """
         Creates a stitched tesselation weighting map. This can be useful
@@ -1091,31 +2852,36 @@ class ClassFacetMachine():
         if self._norm_dict is None:
             self._norm_dict = shared_dict.attach("normDict")
         if "FacetNorm" not in self._norm_dict:
-            print>>log, "  Building Facet-normalisation image"
-            #import pdb; pdb.set_trace()
-            nch, npol = self.nch, self.npol
-            _, _, NPixOut, NPixOut = self.OutImShape
-            print "NPixOut, NPixOut:", NPixOut, NPixOut
-            # in PSF mode, make the norm image in memory. In normal mode, make it in the shared dict,
-            # since the degridding workers require it
-            FacetNorm = np.zeros((NPixOut, NPixOut), dtype=self.stitchedType)
-            for iFacet in self.DicoImager.keys():
-                xc, yc = self.DicoImager[iFacet]["pixCentral"]
-                NpixFacet = self.DicoImager[iFacet]["NpixFacetPadded"]
-                
-                Aedge, Bedge = GiveEdges((xc, yc), NPixOut,
-                                         (NpixFacet/2, NpixFacet/2), NpixFacet)
-                x0d, x1d, y0d, y1d = Aedge
-                x0p, x1p, y0p, y1p = Bedge
-                
-                SpacialWeigth = self._CF[iFacet]["SW"].T[::-1, :]
-                SW = SpacialWeigth[::-1, :].T[x0p:x1p, y0p:y1p]
-                FacetNorm[x0d:x1d, y0d:y1d] += np.real(SW)
+            # the norm image only depends on the tesselation and the spatial weights, cached along with the CFs
+            FacetNorm, cachepath = self._loadCachedImage("FacetNorm", self._giveFacetNormCacheKey())
+            if FacetNorm is None:
+                print>>log, "  Building Facet-normalisation image"
+                #import pdb; pdb.set_trace()
+                nch, npol = self.nch, self.npol
+                _, _, NPixOut, NPixOut = self.OutImShape
+                print "NPixOut, NPixOut:", NPixOut, NPixOut
+                # in PSF mode, make the norm image in memory. In normal mode, make it in the shared dict,
+                # since the degridding workers require it
+                FacetNorm = np.zeros((NPixOut, NPixOut), dtype=self.stitchedType)
+                for iFacet in self.DicoImager.keys():
+                    xc, yc = self.DicoImager[iFacet]["pixCentral"]
+                    NpixFacet = self.DicoImager[iFacet]["NpixFacetPadded"]
+
+                    Aedge, Bedge = GiveEdges((xc, yc), NPixOut,
+                                             (NpixFacet/2, NpixFacet/2), NpixFacet)
+                    x0d, x1d, y0d, y1d = Aedge
+                    x0p, x1p, y0p, y1p = Bedge
+
+                    SpacialWeigth = self._CF[iFacet]["SW"].T[::-1, :]
+                    SW = SpacialWeigth[::-1, :].T[x0p:x1p, y0p:y1p]
+                    FacetNorm[x0d:x1d, y0d:y1d] += np.real(SW)
+                self._saveCachedImage("FacetNorm", cachepath, FacetNorm)
 
             self._norm_dict["FacetNorm"]=FacetNorm
             self._norm_dict["FacetNormReShape"]=FacetNorm.reshape([1,1,
                                                                    FacetNorm.shape[0],
                                                                    FacetNorm.shape[1]])
+            self._accountSHM("normDict", self._norm_dict)
 
 
 
@@ -1249,35 +3015,199 @@ class ClassFacetMachine():
             self.DicoImager[iFacet]["SumJonesChan"]
         Also sets up self._facet_grids as a dict of facet numbers to shared grid arrays.
         """
+        # don't reset the grids under the feet of a background FITS writer
+        self.awaitFitsWriters()
         self.SumWeights.fill(0)
         self.IsDirtyInit = True
         self.HasFourierTransformed = False
+        self._grid_pass += 1
+        self._checkpoint_chunks = []
+        self._checkpoint_resumed = set()
+        # borrow a set of grids given up by another facet machine, if there is one
+        if self._facet_grids is None:
+            self._facet_grids_name, self._facet_grids = self._borrowGrids()
+            if self._facet_grids is not None:
+                print>>log, "reusing facet grids %s" % self._facet_grids_name
+        elif ClassFacetMachine._grid_pool:
+            # this facet machine has its own grids, so pooled ones (e.g. from the PSF) would never be used
+            self._deleteGridPool()
         # are we creating a new grids dict?
         if self._facet_grids is None:
-            self._facet_grids = shared_dict.create("PSFGrid" if self.DoPSF else "Grid")
+            GridName = "PSFGrid" if self.DoPSF else "Grid"
+            # don't reset grids that have been lent to another facet machine
+            i = 0
+            while GridName in ClassFacetMachine._grid_names:
+                i += 1
+                GridName = "%s%i" % ("PSFGrid" if self.DoPSF else "Grid", i)
+            if not self._out_of_core:
+                # spill the grids to disk rather than run out of shared memory
+                NBytes = sum([int(np.prod(Shape)) for Shape in self._giveGridShapes().values()]) * np.dtype(self.CType).itemsize
+                self._out_of_core = not self._checkSHM(GridName, NBytes, spill=True)
+            if self._out_of_core:
+                print>>log, "facet grids will be memory-mapped from %s" % self._scratch_dir
+                self._facet_grids = ClassMemmapDict(self._scratch_dir, GridName)
+            else:
+                self._facet_grids = shared_dict.create(GridName)
+            self._facet_grids_name = GridName
+            ClassFacetMachine._grid_names.add(GridName)
 
+        NewGrids = False
         for iFacet in self.DicoGridMachine.keys():
             NX = self.DicoImager[iFacet]["NpixFacetPadded"]
-            # init or zero grid array
-            grid = self._facet_grids.get(iFacet)
-            if grid is None:
-                grid = self._facet_grids.addSharedArray(iFacet, (self.VS.NFreqBands, self.npol, NX, NX), self.CType)
-            else:
-                grid.fill(0)
-            self.DicoGridMachine[iFacet]["Dirty"] = grid
+            # init or zero grid arrays (one per w-plane in W-stacking mode)
+            for iPlane in xrange(len(self._wplanes)):
+                key = self._giveWGridKey(iFacet, iPlane)
+                grid = self._facet_grids.get(key)
+                if grid is None:
+                    grid = self._facet_grids.addSharedArray(key, (self.VS.NFreqBands, self.npol, NX, NX), self.CType)
+                    NewGrids = True
+                elif self._out_of_core:
+                    grid = self._facet_grids.zero(key)
+                else:
+                    grid.fill(0)
+            self.DicoGridMachine[iFacet]["Dirty"] = self._facet_grids[iFacet]
             self.DicoImager[iFacet]["SumWeights"] = np.zeros((self.VS.NFreqBands, self.npol), np.float64)
             self.DicoImager[iFacet]["SumJones"] = np.zeros((2, self.VS.NFreqBands), np.float64)
             self.DicoImager[iFacet]["SumJonesChan"] = []
             for iMS in xrange(self.VS.nMS):
                 nVisChan = self.VS.ListMS[iMS].ChanFreq.size
                 self.DicoImager[iFacet]["SumJonesChan"].append(np.zeros((2, nVisChan), np.float64))
+        if not self._out_of_core:
+            self._accountSHM(self._facet_grids_name, self._facet_grids)
+        if self._numa is not None and NewGrids and not self._out_of_core:
+            # have the new grids first written on the node of their facet
+            JobName = "%s.TouchGrids:" % self._app_id
+            for iFacet in self.DicoGridMachine.keys():
+                self._runJob("%sF%d" % (JobName, iFacet), self._touch_grid_worker,
+                             args=(iFacet, self._facet_grids.readwrite()), iFacet=iFacet)
+            self._awaitJobResults(JobName + "*")
+        if self._checkpointing():
+            self._loadCheckpoint()
+
+    # ##############################################
+    # ##### Gridding checkpoints ###################
+
+    def _checkpointing(self):
+        """Checkpoints are only made during the first gridding pass (dirty image and PSF), which doesn't depend on a model"""
+        return self._checkpoint_every > 0 and self._grid_pass == 1 and self._model_dict is None
+
+    def _giveCheckpointDir(self):
+        return os.path.join(self._scratch_dir, "DDF.%s.%s.checkpoint" % (os.path.basename(self.ImageName), self._app_id))
+
+    def _giveCheckpointKey(self):
+        """Hash of the settings the grids depend on, and of the grid shapes"""
+        Dico = dict([(Section, self.GD.get(Section)) for Section in
+                     ("Data", "Selection", "Image", "Facets", "CF", "RIME", "Weight", "Freq", "Beam", "DDESolutions", "Comp")])
+        Dico["Shapes"] = sorted([(str(key), Shape) for key, Shape in self._giveGridShapes().items()])
+        Dico["ImageName"] = self.ImageName
+        return hashlib.sha1(json.dumps(Dico, sort_keys=True, default=str)).hexdigest()
+
+    def _saveCheckpoint(self):
+        """
+        Writes the facet grids (as .npy files, written through memory maps), the accumulated weights and the list of
+        gridded (iMS, iChunk) to local scratch. The checkpoint is written to a new directory and then renamed
+        into place, with Checkpoint.json written last, so that a crash while checkpointing leaves the previous
+        checkpoint usable. The writing is done by a thread, while the next chunk is being read: the weights
+        are copied here, and the grids are left alone until the thread is done, see _awaitCheckpoint().
+        """
+        self._awaitCheckpoint()
+        Weights = {}
+        for iFacet in self.DicoImager.keys():
+            Weights["SumWeights.%i" % iFacet] = self.DicoImager[iFacet]["SumWeights"].copy()
+            Weights["SumJones.%i" % iFacet] = self.DicoImager[iFacet]["SumJones"].copy()
+            for iMS, SumJonesChan in enumerate(self.DicoImager[iFacet]["SumJonesChan"]):
+                Weights["SumJonesChan.%i.%i" % (iFacet, iMS)] = SumJonesChan.copy()
+        Info = {"Key": self._giveCheckpointKey(),
+                "Chunks": sorted(self._checkpoint_chunks),
+                "Grids": [str(key) for key in self._giveGridShapes().keys()]}
+        self._checkpoint_thread = threading.Thread(target=self._writeCheckpoint,
+                                                   args=(self._giveCheckpointDir(), self._facet_grids, Weights, Info))
+        self._checkpoint_thread.start()
+
+    @staticmethod
+    def _writeCheckpoint(Dir, Grids, Weights, Info):
+        """Body of the checkpoint thread, see _saveCheckpoint(). A failed checkpoint is logged, and the run goes on"""
+        t0 = time.time()
+        NewDir, OldDir = Dir + ".new", Dir + ".old"
+        try:
+            for d in (NewDir, OldDir):
+                if os.path.isdir(d):
+                    shutil.rmtree(d, ignore_errors=True)
+            os.makedirs(NewDir)
+            for key in Info["Grids"]:
+                Grid = Grids[int(key) if key.isdigit() else key]
+                Out = np.lib.format.open_memmap(os.path.join(NewDir, "%s.npy" % key), mode="w+",
+                                                dtype=Grid.dtype, shape=Grid.shape)
+                Out[...] = Grid
+                Out.flush()
+                del Out
+            np.savez(os.path.join(NewDir, "Weights.npz"), **Weights)
+            Info = dict(Info, Time=time.time())
+            json.dump(Info, open(os.path.join(NewDir, "Checkpoint.json"), "w"))
+            if os.path.isdir(Dir):
+                os.rename(Dir, OldDir)
+            os.rename(NewDir, Dir)
+            shutil.rmtree(OldDir, ignore_errors=True)
+        except Exception, e:
+            print>>log, ModColor.Str("checkpointing facet grids to %s failed: %s" % (Dir, e))
+            return
+        print>>log, "checkpointed facet grids after %i chunks to %s (%.1fs)" % (len(Info["Chunks"]), Dir, time.time() - t0)
+
+    def _awaitCheckpoint(self):
+        """Waits for the checkpoint thread, if any, to be done with the grids"""
+        if self._checkpoint_thread is not None:
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+
+    def _loadCheckpoint(self):
+        """
+        Resumes the first gridding pass from a checkpoint of the same settings, if there is one: loads the grids
+        and weights, and records the chunks already gridded, which gridChunkInBackground() then skips.
+        """
+        Dir = self._giveCheckpointDir()
+        if not os.path.isdir(Dir) and os.path.isdir(Dir + ".old"):
+            Dir = Dir + ".old"
+        try:
+            Info = json.load(open(os.path.join(Dir, "Checkpoint.json")))
+        except (IOError, ValueError):
+            return False
+        if Info["Key"] != self._giveCheckpointKey():
+            print>>log, ModColor.Str("ignoring checkpoint %s made with other settings" % Dir)
+            return False
+        for key in self._giveGridShapes().keys():
+            self._facet_grids[key][...] = np.load(os.path.join(Dir, "%s.npy" % str(key)), mmap_mode="r")
+        Weights = np.load(os.path.join(Dir, "Weights.npz"))
+        for iFacet in self.DicoImager.keys():
+            self.DicoImager[iFacet]["SumWeights"][...] = Weights["SumWeights.%i" % iFacet]
+            self.DicoImager[iFacet]["SumJones"][...] = Weights["SumJones.%i" % iFacet]
+            for iMS, SumJonesChan in enumerate(self.DicoImager[iFacet]["SumJonesChan"]):
+                SumJonesChan[...] = Weights["SumJonesChan.%i.%i" % (iFacet, iMS)]
+        self._checkpoint_chunks = [tuple(Chunk) for Chunk in Info["Chunks"]]
+        self._checkpoint_resumed = set(self._checkpoint_chunks)
+        print>>log, ModColor.Str("resuming gridding from checkpoint %s: %i chunks already gridded" % (Dir, len(self._checkpoint_chunks)), col="green")
+        return True
+
+    def _deleteCheckpoint(self):
+        self._awaitCheckpoint()
+        Dir = self._giveCheckpointDir()
+        for d in (Dir, Dir + ".new", Dir + ".old"):
+            if os.path.isdir(d):
+                shutil.rmtree(d, ignore_errors=True)
+
+    # ##############################################
+    # ##############################################
 
     def applySparsification(self, DATA, factor):
         """Computes a sparsification vector for use in the BDA gridder. This is a vector of bools,
         same size as the number of BDA blocks, with a True for every block that will be gridded.
-        Blocks ae chosen at random with a probability of 1/factor"""
+        In the default "Random" mode, blocks ae chosen at random with a probability of 1/factor.
+        In "Stratified" mode, see _giveStratifiedSparsification()"""
         if not factor or "BDA.Grid" not in DATA:
             DATA["Sparsification"] = np.array([])
+        elif self.GD["Comp"].get("SparsificationMode", "Random") == "Stratified":
+            num_blocks = DATA["BDA.Grid"][0]
+            DATA["Sparsification.Grid"] = self._giveStratifiedSparsification(DATA, factor)
+            print>> log, "applying stratified sparsification factor of %f to %d BDA grid blocks, left with %d" % (factor, num_blocks, DATA["Sparsification.Grid"].sum())
         else:
             # randomly select blocks with 1/sparsification probability
             num_blocks = DATA["BDA.Grid"][0]
@@ -1287,7 +3217,123 @@ class ClassFacetMachine():
             #DATA["Sparsification.Degrid"] = numpy.random.sample(num_blocks) < 1.0 / factor
             #print>> log, "applying sparsification factor of %f to %d BDA degrid blocks, left with %d" % (factor, num_blocks, DATA["Sparsification.Degrid"].sum())
 
+    @staticmethod
+    def _giveBDABlocks(BDA):
+        """
+        Unpacks a BDA mapping, i.e. [NBlocks, size of each block, rows of block 0, ChanStart, ChanEnd, rows of block 1, ...].
+        Returns:
+            BlockOfRow: block number of every row entry in the mapping
+            Rows: row entries of the mapping
+            ChanStart, ChanEnd: channel range of every block
+        """
+        NBlocks = BDA[0]
+        Sizes = np.int64(BDA[1:NBlocks+1])
+        Starts = NBlocks + 1 + np.cumsum(Sizes) - Sizes
+        Entries = np.arange(Sizes.sum()) + NBlocks + 1
+        BlockOfEntry = np.repeat(np.arange(NBlocks), Sizes)
+        # the last two entries of each block are its channel range
+        IsRow = (Entries - Starts[BlockOfEntry]) < (Sizes[BlockOfEntry] - 2)
+        ChanStart = BDA[Starts + Sizes - 2]
+        ChanEnd = BDA[Starts + Sizes - 1]
+        return BlockOfEntry[IsRow], BDA[Entries[IsRow]], ChanStart, ChanEnd
+
+    def _giveStratifiedSparsification(self, DATA, factor):
+        """
+        Deterministic, stratified sparsification of the BDA grid blocks. Blocks are binned by
+        baseline length and time (on quantiles, so bins are equally populated), and exactly
+        1/factor of the blocks of each bin are kept, drawn with a random generator seeded
+        by Comp-SparsificationSeed, the MS and the chunk number. The imaging weights of the kept
+        blocks are scaled up by the inverse of the kept fraction of their bin, so that the
+        weights of each bin of the uv-plane are conserved.
+        """
+        BlockOfRow, Rows, ChanStart, ChanEnd = self._giveBDABlocks(DATA["BDA.Grid"])
+        num_blocks = ChanStart.size
+        Keep = np.zeros(num_blocks, bool)
+        if not Rows.size:
+            return Keep
+        # first row of each block defines its baseline length and time
+        FirstRow = np.zeros(num_blocks, np.int64)
+        Blocks, iFirst = np.unique(BlockOfRow, return_index=True)
+        FirstRow[Blocks] = Rows[iFirst]
+        uvw = DATA["uvw"]
+        BL = np.sqrt(uvw[FirstRow, 0]**2 + uvw[FirstRow, 1]**2)
+        Time = DATA["times"][FirstRow]
+        # aim at keeping a few blocks per bin
+        NBins = int(max(1, min(32, np.sqrt(num_blocks / (4. * factor)))))
+        Quantiles = np.linspace(0, 100, NBins + 1)[1:-1]
+        iBinBL = np.searchsorted(np.percentile(BL, Quantiles), BL, side="right")
+        iBinTime = np.searchsorted(np.percentile(Time, Quantiles), Time, side="right")
+        iBin = iBinBL * NBins + iBinTime
+
+        Seed = self.GD["Comp"].get("SparsificationSeed", 0) or 0
+        rng = np.random.RandomState([Seed, DATA["iMS"], DATA["iChunk"]])
+        Order = np.argsort(iBin, kind="mergesort")
+        _, BinStarts, BinCounts = np.unique(iBin[Order], return_index=True, return_counts=True)
+        for i0, n in zip(BinStarts, BinCounts):
+            nKeep = max(1, int(round(n / float(factor))))
+            Keep[Order[i0 + rng.permutation(n)[:nKeep]]] = True
+
+        # rescale weights of the kept blocks so that the sum of weights of each bin is conserved (once per chunk)
+        if not DATA.get("Sparsification.Rescaled"):
+            W = DATA["Weights"]
+            nrow, nchan = W.shape
+            CumW = np.zeros((nrow, nchan + 1), np.float64)
+            np.cumsum(W, axis=1, out=CumW[:, 1:])
+            WBlock = np.bincount(BlockOfRow, weights=CumW[Rows, ChanEnd[BlockOfRow]] - CumW[Rows, ChanStart[BlockOfRow]],
+                                 minlength=num_blocks)
+            WBin = np.bincount(iBin, weights=WBlock)
+            WBinKept = np.bincount(iBin, weights=WBlock * Keep, minlength=WBin.size)
+            WBinKept[WBinKept == 0] = 1.
+            Scale = (WBin / WBinKept)[iBin]
+            Sel = Keep[BlockOfRow]
+            BlockOfRow, Rows = BlockOfRow[Sel], Rows[Sel]
+            ChanRanges = np.array([ChanStart[BlockOfRow], ChanEnd[BlockOfRow]]).T
+            for ch0, ch1 in set(map(tuple, ChanRanges)):
+                Sel = (ChanRanges[:, 0] == ch0) & (ChanRanges[:, 1] == ch1)
+                W[Rows[Sel], ch0:ch1] *= Scale[BlockOfRow[Sel]].reshape((-1, 1))
+            DATA["Sparsification.Rescaled"] = True
+        return Keep
+
+    def giveBeamJonesKey(self, iMS, times, freqs):
+        """Beam cache key of a chunk: MS, time span sampled at Beam-DtBeamMin, channel frequencies, facet directions"""
+        MSName = getattr(self.VS.ListMS[iMS], "MSName", iMS)
+        Times = np.array([times.min(), times.max(), self.GD["Beam"].get("DtBeamMin", 0) or 0]) if times.size else np.zeros(3)
+        RaDec = np.array([self.LraFacet, self.LdecFacet])
+        return ClassBeamJonesCache.giveKey(MSName, Times, freqs, RaDec, self.GD["Beam"])
+
+    def hasCachedBeamJones(self, iMS, times, freqs):
+        """
+        True if the beam Jones matrices of a chunk are in the beam cache (Cache-BeamJones). For the visibility
+        server's Jones machine, which may then leave DATA["Beam"] out of the chunk rather than evaluate it:
+        _setBeamJones() fills it in from the cache.
+        """
+        return self._beam_cache is not None and self._beam_cache.has(self.giveBeamJonesKey(iMS, times, freqs))
+
+    def _setBeamJones(self, DATA):
+        """
+        Keeps the beam Jones matrices of a chunk in the beam cache (Cache-BeamJones). If the chunk comes
+        without its beam (the Jones machine skipped it, see hasCachedBeamJones()), fills DATA["Beam"] from
+        the cache, so that only the first run evaluates the beam of a given MS, time and frequency sampling
+        and set of directions. The cache is only set up with a beam model, so a chunk never gets a beam it
+        should not have.
+        """
+        if self._beam_cache is None:
+            return
+        Key = self.giveBeamJonesKey(DATA["iMS"], DATA["times"], DATA["freqs"])
+        if "Beam" in DATA:
+            if Key not in self._beam_keys_saved and not self._beam_cache.has(Key):
+                self._beam_cache.save(Key, DATA["Beam"])
+                print>>log, "saving beam Jones of chunk %s to cache" % DATA.get("label", Key)
+            self._beam_keys_saved.add(Key)
+        elif self._beam_cache.has(Key):
+            if self._beam_cache.load(Key, DATA.addSubdict("Beam")):
+                print>>log, "loaded beam Jones of chunk %s from cache" % DATA.get("label", Key)
+                self._beam_keys_saved.add(Key)
+            else:
+                DATA.delete_item("Beam")
+
     def _grid_worker(self, iFacet, DATA, cf_dict, griddict):
+        t0 = time.time()
         T = ClassTimeIt.ClassTimeIt()
         T.disable()
 
@@ -1296,11 +3342,6 @@ class ClassFacetMachine():
         #     pyfftw.import_wisdom(FFTW_Wisdom)
         # T.timeit("%s: import wisdom" % iFacet)
 
-        # Create a new GridMachine
-        GridMachine = self._createGridMachine(iFacet, cf_dict=cf_dict,
-            bda_grid=DATA["BDA.Grid"], bda_degrid=DATA["BDA.Degrid"])
-        T.timeit("%s: create GM" % iFacet)
-
         uvwThis = DATA["uvw"]
         visThis = DATA["data"]
         flagsThis = DATA["flags"]
@@ -1312,24 +3353,6 @@ class ClassFacetMachine():
         freqs = DATA["freqs"]
         ChanMapping = DATA["ChanMapping"]
 
-        DecorrMode = self.GD["RIME"]["DecorrMode"]
-        if 'F' in DecorrMode or "T" in DecorrMode:
-            uvw_dt = DATA["uvw_dt"]
-            DT, Dnu = DATA["dt"], DATA["dnu"][0]
-            lm_min=None
-            if self.GD["RIME"]["DecorrLocation"]=="Edge":
-                lm_min=self.DicoImager[iFacet]["lm_min"]
-            GridMachine.setDecorr(uvw_dt, DT, Dnu, 
-                                  SmearMode=DecorrMode, 
-                                  lm_min=lm_min,
-                                  lm_PhaseCenter=DATA["lm_PhaseCenter"])
-
-        # DecorrMode = GD["DDESolutions"]["DecorrMode"]
-        # if ('F' in DecorrMode) or ("T" in DecorrMode):
-        #     uvw_dt = DATA["uvw_dt"]
-        #     DT, Dnu = DATA["dt_dnu"]
-        #     GridMachine.setDecorr(uvw_dt, DT, Dnu, SmearMode=DecorrMode)
-
         # Create Jones Matrices Dictionary
         DicoJonesMatrices = None
         Apply_killMS = self.GD["DDESolutions"]["DDSols"]
@@ -1342,23 +3365,55 @@ class ClassFacetMachine():
         if Apply_Beam:
             DicoJonesMatrices["DicoJones_Beam"] = DATA["Beam"]
 
-        GridMachine.put(times, uvwThis, visThis, flagsThis, A0A1, W,
-                        DoNormWeights=False,
-                        DicoJonesMatrices=DicoJonesMatrices,
-                        freqs=freqs, DoPSF=self.DoPSF,
-                        ChanMapping=ChanMapping,
-                        ResidueGrid=griddict[iFacet],
-                        sparsification=DATA.get("Sparsification.Grid")
-                        )
-        T.timeit("put %s" % iFacet)
+        # in W-stacking mode, each w-plane is gridded in turn (from the blocks assigned to it, with w relative to the plane)
+        ListPlanes = [(0, DATA.get("Sparsification.Grid"))]
+        if self._wmode == "WStacking":
+            uvwThis = DATA["uvw.BDA.Grid"]
+            ListPlanes = list(self._giveWPlaneSelection(DATA, "BDA.Grid", DATA.get("Sparsification.Grid"))) or \
+                         [(0, np.zeros(DATA["BDA.Grid"][0], bool))]
+
+        Sw = SumJones = SumJonesChan = None
+        for iPlane, Sparsification in ListPlanes:
+            # Create a new GridMachine
+            GridMachine = self._createGridMachine(iFacet, cf_dict=cf_dict,
+                bda_grid=DATA["BDA.Grid"], bda_degrid=DATA["BDA.Degrid"])
+            T.timeit("%s: create GM" % iFacet)
+
+            DecorrMode = self.GD["RIME"]["DecorrMode"]
+            if 'F' in DecorrMode or "T" in DecorrMode:
+                uvw_dt = DATA["uvw_dt"]
+                DT, Dnu = DATA["dt"], DATA["dnu"][0]
+                lm_min=None
+                if self.GD["RIME"]["DecorrLocation"]=="Edge":
+                    lm_min=self.DicoImager[iFacet]["lm_min"]
+                GridMachine.setDecorr(uvw_dt, DT, Dnu, 
+                                      SmearMode=DecorrMode, 
+                                      lm_min=lm_min,
+                                      lm_PhaseCenter=DATA["lm_PhaseCenter"])
+
+            GridMachine.put(times, uvwThis, visThis, flagsThis, A0A1, W,
+                            DoNormWeights=False,
+                            DicoJonesMatrices=DicoJonesMatrices,
+                            freqs=freqs, DoPSF=self.DoPSF,
+                            ChanMapping=ChanMapping,
+                            ResidueGrid=griddict[self._giveWGridKey(iFacet, iPlane)],
+                            sparsification=Sparsification
+                            )
+            T.timeit("put %s" % iFacet)
 
+            if Sw is None:
+                Sw = GridMachine.SumWeigths.copy()
+                SumJones = GridMachine.SumJones.copy()
+                SumJonesChan = GridMachine.SumJonesChan.copy()
+            else:
+                Sw += GridMachine.SumWeigths
+                SumJones += GridMachine.SumJones
+                SumJonesChan += GridMachine.SumJonesChan
         T.timeit("Grid")
-        Sw = GridMachine.SumWeigths.copy()
-        SumJones = GridMachine.SumJones.copy()
-        SumJonesChan = GridMachine.SumJonesChan.copy()
         
 
-        return {"iFacet": iFacet, "Weights": Sw, "SumJones": SumJones, "SumJonesChan": SumJonesChan}
+        Stats = self._giveJobStats("Grid", iFacet, t0, NVis=visThis.shape[0]*visThis.shape[1])
+        return {"iFacet": iFacet, "Weights": Sw, "SumJones": SumJones, "SumJonesChan": SumJonesChan, "Stats": Stats}
 
     def gridChunkInBackground(self, DATA):
         """
@@ -1371,19 +3426,29 @@ class ClassFacetMachine():
         # wait for any previous gridding/degridding jobs to finish, if still active
         self.collectGriddingResults()
         self.collectDegriddingResults()
+        # the smooth beam is not part of the checkpoint: StackAverageBeam() is still run on resumed chunks
+        if (DATA["iMS"], DATA["iChunk"]) in self._checkpoint_resumed:
+            print>>log, "chunk %s already gridded (from checkpoint), skipping it" % DATA["label"]
+            return
+        # the previous checkpoint must be written before the grids change
+        self._awaitCheckpoint()
         # run new set of jobs
         self._grid_iMS, self._grid_iChunk = DATA["iMS"], DATA["iChunk"]
         self._grid_job_label = DATA["label"]
         self._grid_job_id = "%s.Grid.%s:" % (self._app_id, self._grid_job_label)
+        self._setWPlanes(DATA, "BDA.Grid")
+        self._setBeamJones(DATA)
         for iFacet in self.DicoImager.keys():
-            APP.runJob("%sF%d" % (self._grid_job_id, iFacet), self._grid_worker,
+            self._runJob("%sF%d" % (self._grid_job_id, iFacet), self._grid_worker,
                             args=(iFacet, DATA.readonly(), self._CF[iFacet].readonly(),
-                                  self._facet_grids.readonly()))
+                                  self._facet_grids.readonly()), iFacet=iFacet)
 
     # ##############################################
     # ##### Smooth beam ############################
     def _SmoothAverageBeam_worker(self, DATA, iDir):
+        t0 = time.time()
         self.AverageBeamMachine.StackBeam(DATA, iDir)
+        return {"iDir": iDir, "Stats": self._giveJobStats("StackBeam", iDir, t0, GridSize=0)}
 
     def StackAverageBeam(self, DATA):
         # the FacetMachinePSF does not have an AverageBeamMachine
@@ -1397,18 +3462,20 @@ class ClassFacetMachine():
         # wait for any previous gridding/degridding jobs to finish, if still active
         self.collectGriddingResults()
         self.collectDegriddingResults()
+        self._setBeamJones(DATA)
         # run new set of jobs
         self._smooth_job_label=DATA["label"]
         JobName="StackBeam%sF"%self._smooth_job_label
         for iDir in range(self.AverageBeamMachine.NDir):
-            APP.runJob("%s%d" % (JobName,iDir), 
+            self._runJob("%s%d" % (JobName,iDir), 
                        self._SmoothAverageBeam_worker,
-                       args=(DATA.readonly(), iDir))
+                       args=(DATA.readonly(), iDir), Estimate=self._isLearningWisdom())
 
 
     def finaliseSmoothBeam(self):
         # the FacetMachinePSF does not have an AverageBeamMachine
         if not self.AverageBeamMachine: return
+        self._collectSmoothBeamResults()
         # if AverageBeamMachine has loaded a cached SmoothBeam
         if self.AverageBeamMachine.SmoothBeam is None: 
             if self.AverageBeamMachine.Smooth()=="NoStackedData":
@@ -1460,11 +3527,13 @@ class ClassFacetMachine():
                 self.DicoImager[iFacet]["SumJones"]
                 self.DicoImager[iFacet]["SumJonesChan"][DATA["iMS"]]
         """
+        # stacking jobs are collected here too, since resumed chunks (see _loadCheckpoint()) have no gridding jobs
+        self._collectSmoothBeamResults()
         # if this is set to None, then results already collected
         if self._grid_job_id is None:
             return
         # collect results of grid workers
-        results = APP.awaitJobResults(self._grid_job_id+"*",progress=
+        results = self._awaitJobResults(self._grid_job_id+"*",progress=
                             ("Grid PSF %s" if self.DoPSF else "Grid %s") % self._grid_job_label)
 
         for DicoResult in results:
@@ -1472,34 +3541,58 @@ class ClassFacetMachine():
             if isinstance(DicoResult, Exception):
                 raise DicoResult
             iFacet = DicoResult["iFacet"]
+            self._recordJobStats(DicoResult["Stats"])
             self.DicoImager[iFacet]["SumWeights"] += DicoResult["Weights"]
             self.DicoImager[iFacet]["SumJones"] += DicoResult["SumJones"]
             self.DicoImager[iFacet]["SumJonesChan"][self._grid_iMS] += DicoResult["SumJonesChan"]
         self._grid_job_id = None
 
+        if self._checkpointing():
+            self._checkpoint_chunks.append((self._grid_iMS, self._grid_iChunk))
+            if (len(self._checkpoint_chunks) - len(self._checkpoint_resumed)) % self._checkpoint_every == 0:
+                self._saveCheckpoint()
+
+        return True
+
+    def _collectSmoothBeamResults(self):
+        """Waits for the beam stacking jobs of the last StackAverageBeam() call, if any"""
         if self.AverageBeamMachine is not None and \
            self.AverageBeamMachine.SmoothBeam is None and\
            self._smooth_job_label is not None:
             JobName="StackBeam%sF"%self._smooth_job_label
-            APP.awaitJobResults(JobName+"*",
-                                progress=("Stack Beam %s" % self._smooth_job_label))
-
-        return True
+            results = self._awaitJobResults(JobName+"*",
+                                            progress=("Stack Beam %s" % self._smooth_job_label))
+            self._recordJobResults(results)
+        self._smooth_job_label = None
 
     def _fft_worker(self, iFacet, cf_dict, griddict):
         """
-        Fourier transforms the grids currently housed in shared memory
+        Fourier transforms the grids currently housed in shared memory.
         Precondition:
             Should be called after all data has been gridded
         Returns:
             Dictionary of success and facet identifier
         """
         # reload shared dicts
+        t0 = time.time()
         GridMachine = self._createGridMachine(iFacet, cf_dict=cf_dict)
         Grid = griddict[iFacet]
         # note that this FFTs in-place
         GridMachine.GridToIm(Grid)
-        return {"iFacet": iFacet}
+        if self._wmode == "WStacking":
+            # apply the w-term of each plane in the image domain, and sum the planes into the facet grid
+            Freqs = [np.mean(Channels) for Channels in self.VS.FreqBandChannels]
+            for iPlane, Phase in self._giveWPhases(cf_dict, Freqs):
+                if iPlane == 0:
+                    Grid *= Phase
+                    continue
+                PlaneGrid = griddict[self._giveWGridKey(iFacet, iPlane)]
+                if not PlaneGrid.any():
+                    continue
+                GridMachine.GridToIm(PlaneGrid)
+                PlaneGrid *= Phase
+                Grid += PlaneGrid
+        return {"iFacet": iFacet, "Stats": self._giveJobStats("FFT", iFacet, t0)}
 
     def fourierTransformInBackground(self):
         '''
@@ -1508,12 +3601,15 @@ class ClassFacetMachine():
         '''
         # wait for any previous gridding jobs to finish, if still active
         self.collectGriddingResults()
+        # the pass is complete, and the grids are about to be transformed in place
+        if self._checkpointing():
+            self._deleteCheckpoint()
         # run FFT jobs
         self._fft_job_id = "%s.FFT:" % self._app_id
         for iFacet in self.DicoImager.keys():
-            APP.runJob("%sF%d" % (self._fft_job_id, iFacet), self._fft_worker,
+            self._runJob("%sF%d" % (self._fft_job_id, iFacet), self._fft_worker,
                             args=(iFacet, self._CF[iFacet].readonly(), self._facet_grids.readonly()),
-                            )
+                            iFacet=iFacet)
         # APP.awaitJobResults(self._fft_job_id+"*", progress=("FFT PSF" if self.DoPSF else "FFT"))
 
     def collectFourierTransformResults (self):
@@ -1521,7 +3617,8 @@ class ClassFacetMachine():
             return
         # collect results of FFT workers
         # (use label of previous gridding job for the progress bar)
-        APP.awaitJobResults(self._fft_job_id+"*", progress=("FFT PSF" if self.DoPSF else "FFT"))
+        results = self._awaitJobResults(self._fft_job_id+"*", progress=("FFT PSF" if self.DoPSF else "FFT"))
+        self._recordJobResults(results)
         self._fft_job_id = None
 
     def _set_model_grid_worker(self, iFacet, model_dict, cf_dict, ChanSel, ToSHMDict=False,ToGrid=False,ApplyNorm=True):
@@ -1538,6 +3635,12 @@ class ClassFacetMachine():
             model_dict[iFacet]["FacetGrid"] = ModelGrid
         return ModelGrid
 
+    def _set_model_grid_job(self, iFacet, model_dict, cf_dict, ChanSel, ToSHMDict=False,ToGrid=False,ApplyNorm=True):
+        """Job wrapper of _set_model_grid_worker(): keeps the facet model in the shared dict rather than returning it"""
+        t0 = time.time()
+        self._set_model_grid_worker(iFacet, model_dict, cf_dict, ChanSel, ToSHMDict=ToSHMDict, ToGrid=ToGrid, ApplyNorm=ApplyNorm)
+        return {"iFacet": iFacet, "Stats": self._giveJobStats("MakeGridModel", iFacet, t0)}
+
     def set_model_grid (self,ToGrid=True,ApplyNorm=True):
         self.awaitInitCompletion()
 
@@ -1554,17 +3657,21 @@ class ClassFacetMachine():
         self._set_model_grid_job_id = "%s.MakeGridModel:" % (self._app_id)
         
         for iFacet in self.DicoImager.keys():
-            APP.runJob("%sF%d" % (self._set_model_grid_job_id, iFacet), 
-                       self._set_model_grid_worker,
+            self._runJob("%sF%d" % (self._set_model_grid_job_id, iFacet), 
+                       self._set_model_grid_job,
                        args=(iFacet, self._model_dict.readwrite(), self._CF[iFacet].readonly(),
-                             ChanSel,ToSHMDict,ToGrid,ApplyNorm))
-        APP.awaitJobResults(self._set_model_grid_job_id + "*", progress="Make model grids")
+                             ChanSel,ToSHMDict,ToGrid,ApplyNorm), Estimate=self._isLearningWisdom(iFacet))
+        results = self._awaitJobResults(self._set_model_grid_job_id + "*", progress="Make model grids")
+        self._recordJobResults(results)
+        self._model_dict.reload()
+        self._accountSHM("Model", self._model_dict)
 
 
     # #####################################################"
     def _convolveShift_worker(self, iFacet, d_mat, dl,dm,
                               model_dict,DicoImages,cf_dict,
                               RestoredFacetDict,PSFGaussParsAvg):
+        t0 = time.time()
         Model=model_dict[iFacet]["FacetGrid"]
         _,npol,nx,ny=Model.shape
         Model=np.mean(Model,axis=0).reshape((1,npol,nx,ny))
@@ -1572,7 +3679,26 @@ class ClassFacetMachine():
         
         majax,minax,PA=PSFGaussParsAvg
         PA+=np.pi/2
-        
+
+        iDir = None
+        if d_mat is not None:
+            iDir = np.argmin(d_mat[iFacet])
+            if dl[iDir] == 0. and dm[iDir] == 0.:
+                iDir = None
+
+        if self.GD["Image"].get("ShiftMode", "FFT") == "FFT":
+            # restoring beam convolution and shift in one go, in Fourier space
+            Mask = cf_dict[iFacet]["Sphe"] < 1e-3
+            Residual = Residual.copy()
+            Residual[:, :, Mask] = 0
+            FT = np.fft.rfft2(Residual) + np.fft.rfft2(Model) * self._giveGaussianTransfer(nx, ny, (majax, minax, PA))
+            if iDir is not None:
+                FT *= self._givePhaseRamp(nx, ny, dm[iDir], dl[iDir])
+            Restored = np.fft.irfft2(FT, s=(nx, ny)).astype(Residual.dtype)
+            Restored[:, :, Mask] = 0
+            RestoredFacetDict[iFacet] = Restored
+            return {"iFacet": iFacet, "Stats": self._giveJobStats("convolveShift", iFacet, t0)}
+
         ModelConv=ModFFTW.ConvolveGaussian(Model, CellSizeRad=self.CellSizeRad,
                                            GaussPars=[(majax,minax,PA)])
         
@@ -1590,19 +3716,65 @@ class ClassFacetMachine():
         # pylab.draw()
         # pylab.show()
         
-        if d_mat is not None:
-            d=d_mat[iFacet]
-            iDir=np.argmin(d)
-            if not(dl[iDir]==0. and dm[iDir]==0.):
-                Restored=scipy.ndimage.interpolation.shift(Restored, (0,0,dm[iDir],dl[iDir]))
+        if iDir is not None:
+            Restored=scipy.ndimage.interpolation.shift(Restored, (0,0,dm[iDir],dl[iDir]))
         RestoredFacetDict[iFacet]=Restored
         #Restored.fill(1.)
+        return {"iFacet": iFacet, "Stats": self._giveJobStats("convolveShift", iFacet, t0)}
 
         
 
+    # Fourier-space Gaussian restoring beams of the current (worker) process, see _giveGaussianTransfer()
+    _gauss_transfer_cache = {}
+
+    def _giveGaussianTransfer(self, nx, ny, GaussPars):
+        """
+        Transfer function (in rfft2 layout) of ModFFTW.ConvolveGaussian() for an nx*ny image, obtained
+        by convolving a centred delta function, so that both paths restore with exactly the same beam.
+        Cached per image size and beam.
+        """
+        key = (nx, ny, tuple(GaussPars), self.CellSizeRad)
+        Transfer = ClassFacetMachine._gauss_transfer_cache.get(key)
+        if Transfer is None:
+            Delta = np.zeros((1, 1, nx, ny), np.float32)
+            Delta[0, 0, nx//2, ny//2] = 1
+            Kernel = ModFFTW.ConvolveGaussian(Delta, CellSizeRad=self.CellSizeRad, GaussPars=[GaussPars])[0, 0]
+            Transfer = np.fft.rfft2(np.roll(np.roll(Kernel, -(nx//2), axis=0), -(ny//2), axis=1))
+            ClassFacetMachine._gauss_transfer_cache[key] = Transfer
+        return Transfer
+
+    @staticmethod
+    def _givePhaseRamp(nx, ny, dx, dy):
+        """Fourier-space phase ramp (in rfft2 layout) moving an nx*ny image by (dx,dy) pixels, like scipy.ndimage shift"""
+        fx = np.fft.fftfreq(nx).reshape((nx, 1))
+        fy = np.fft.rfftfreq(ny).reshape((1, ny//2+1))
+        return np.exp(-2j * np.pi * (fx * dx + fy * dy))
+
+    def _buildFacetMeanResidual(self, DicoImages):
+        """
+        Puts the band-averaged residual of every facet (grid-corrected, i.e. divided by Sphe) into
+        DicoImages["FacetMeanResidual"]. Must be called before the facet grids are reused, i.e. between
+        FacetsToIm() and the next gridding.
+        """
+        WBAND = self._facet_mean_wband
+        DicoImages.addSubdict("FacetMeanResidual")
+        for iFacet in sorted(self.DicoImager.keys()):
+            DicoImages["FacetMeanResidual"].addSubdict(iFacet)
+            nch,npol,npix_x,npix_y=self.DicoGridMachine[iFacet]["Dirty"].shape
+            ThisW=self.DicoImager[iFacet]["SumWeights"].reshape((self.VS.NFreqBands,npol,1,1))
+            SumJonesNorm=np.sqrt(self.DicoImager[iFacet]["SumJonesNorm"])
+            if np.max(SumJonesNorm)>0.:
+                ThisW=ThisW*SumJonesNorm.reshape((self.VS.NFreqBands,1,1,1))
+            ThisDirty=self.DicoGridMachine[iFacet]["Dirty"].real/ThisW
+            DicoImages["FacetMeanResidual"][iFacet]=np.sum(ThisDirty*WBAND,axis=0).reshape((1,npol,npix_x,npix_y))
+            DicoImages["FacetMeanResidual"][iFacet]=DicoImages["FacetMeanResidual"][iFacet]/self._CF[iFacet]["Sphe"]
+
     def giveRestoredFacets(self,DicoImages,PSFGaussParsAvg,ShiftFile=None):
+        if "FacetMeanResidual" not in DicoImages:
+            self._buildFacetMeanResidual(DicoImages)
         self.set_model_grid (ToGrid=False,ApplyNorm=False)
         d_mat=None
+        dl=dm=None
         if ShiftFile is not None:
             ra_rad,dec_rad,dl,dm=np.genfromtxt(ShiftFile).T
             a1,d1=ra_rad.reshape(-1,1),dec_rad.reshape(-1,1)
@@ -1614,18 +3786,22 @@ class ClassFacetMachine():
             d_mat=np.arccos(s(d0)*s(d1.T)+c(d0)*c(d1.T)*c(a0-a1.T))
             #d_mat[d_mat==0]=1e10
 
-        RestoredFacetDict = shared_dict.create("RestoredFacetDict")
+        NBytes = sum([self.npol * self.DicoImager[iFacet]["NpixFacetPadded"]**2
+                      for iFacet in self.DicoImager.keys()]) * np.dtype(np.float32).itemsize
+        RestoredFacetDict = self._createSHMDict("RestoredFacetDict", NBytes)
 
 
         for iFacet in self.DicoImager.keys():
-            APP.runJob("convolveShiftF%d" % (iFacet), 
+            self._runJob("convolveShiftF%d" % (iFacet), 
                        self._convolveShift_worker,
                        args=(iFacet, d_mat, dl,dm,
                              self._model_dict.readonly(),DicoImages.readonly(),self._CF.readonly(),
-                             RestoredFacetDict.readwrite(),PSFGaussParsAvg))#,serial=True)
-        APP.awaitJobResults("convolveShiftF*", progress="Build restored facets")
+                             RestoredFacetDict.readwrite(),PSFGaussParsAvg), Estimate=self._isLearningWisdom())#,serial=True)
+        results = self._awaitJobResults("convolveShiftF*", progress="Build restored facets")
+        self._recordJobResults(results)
 
         RestoredFacetDict.reload()
+        self._accountSHM("RestoredFacetDict", RestoredFacetDict)
         for iFacet in sorted(self.DicoImager.keys()):
             self._model_dict.reload()
             Restored=RestoredFacetDict[iFacet]
@@ -1634,7 +3810,8 @@ class ClassFacetMachine():
             self.DicoImager[iFacet]["SumWeights"]=self.SumWeights.copy()
             self.DicoImager[iFacet]["SumWeights"].fill(1.)
             self.DicoImager[iFacet]["SumJonesNorm"]=np.ones(self.VS.NFreqBands, np.float64)
-
+        self._releaseSHM("RestoredFacetDict")
+        RestoredFacetDict.delete()
 
         Restored=self.FacetsToIm_Channel(kind="Dirty",ChanSel=[0])
         _,npol,nx,ny=Restored.shape
@@ -1644,16 +3821,17 @@ class ClassFacetMachine():
     # #####################################################"
 
     # DeGrid worker that is called by Multiprocessing.Process
-    def _degrid_worker(self, iFacet, DATA, cf_dict, ChanSel, modeldict):
+    def _degrid_worker(self, iFacet, DATA, cf_dict, ChanSel, modeldict, ListSemaphores, visThis=None):
+        """Degrids a facet. With ListSemaphores=None (private buffers), the rows are not locked"""
+        t0 = time.time()
         ModelGrid = self._set_model_grid_worker(iFacet, modeldict, cf_dict, ChanSel)
 
-        # Create a new GridMachine
-        GridMachine = self._createGridMachine(iFacet, cf_dict=cf_dict,
-            ListSemaphores=ClassFacetMachine._degridding_semaphores,
-            bda_grid=DATA["BDA.Grid"], bda_degrid=DATA["BDA.Degrid"])
+        self._attachDegriddingSemaphores(ListSemaphores)
 
         uvwThis = DATA["uvw"]
-        visThis = DATA["data"]
+        # model visibilities are subtracted from DATA["data"], unless a private buffer is given
+        if visThis is None:
+            visThis = DATA["data"]
         flagsThis = DATA["flags"]
         times = DATA["times"]
         A0 = DATA["A0"]
@@ -1675,27 +3853,111 @@ class ClassFacetMachine():
         if Apply_Beam:
             DicoJonesMatrices["DicoJones_Beam"] = DATA["Beam"]
 
-        DecorrMode = self.GD["RIME"]["DecorrMode"]
-        if 'F' in DecorrMode or "T" in DecorrMode:
-            uvw_dt = DATA["uvw_dt"]
-            DT, Dnu = DATA["dt"], DATA["dnu"][0]
-            lm_min=None
-            if self.GD["RIME"]["DecorrLocation"]=="Edge":
-                lm_min=self.DicoImager[iFacet]["lm_min"]
-            GridMachine.setDecorr(uvw_dt, DT, Dnu, 
-                                  SmearMode=DecorrMode, 
-                                  lm_min=lm_min,
-                                  lm_PhaseCenter=DATA["lm_PhaseCenter"])
-
-        GridMachine.get(times, uvwThis, visThis, flagsThis, A0A1,
-                          ModelGrid, ImToGrid=False,
-                          DicoJonesMatrices=DicoJonesMatrices,
-                          freqs=freqs, TranformModelInput="FT",
-                          ChanMapping=ChanMapping,
-                          sparsification=DATA.get("Sparsification.Degrid")
-                        )
+        # in W-stacking mode, each w-plane is degridded in turn from the model times the conjugate w-term of the plane
+        ListPlanes = [(0, DATA.get("Sparsification.Degrid"))]
+        if self._wmode == "WStacking":
+            uvwThis = DATA["uvw.BDA.Degrid"]
+            ListPlanes = self._giveWPlaneSelection(DATA, "BDA.Degrid", DATA.get("Sparsification.Degrid"))
+            # frequency of each model channel, from the visibility channels mapped to it
+            ModelChans = ChanSel if ModelGrid.shape[0] == len(ChanSel) else range(ModelGrid.shape[0])
+            Freqs = []
+            for iChan in ModelChans:
+                Sel = np.asarray(ChanMapping) == iChan
+                Freqs.append(np.mean(freqs[Sel]) if Sel.any() else np.mean(freqs))
+            # the planes come in increasing order, see _giveWPlaneSelection()
+            WPhases = self._giveWPhases(cf_dict, Freqs, Sign=-1)
+
+        for iPlane, Sparsification in ListPlanes:
+            # Create a new GridMachine
+            GridMachine = self._createGridMachine(iFacet, cf_dict=cf_dict,
+                ListSemaphores=ListSemaphores,
+                bda_grid=DATA["BDA.Grid"], bda_degrid=DATA["BDA.Degrid"])
+
+            DecorrMode = self.GD["RIME"]["DecorrMode"]
+            if 'F' in DecorrMode or "T" in DecorrMode:
+                uvw_dt = DATA["uvw_dt"]
+                DT, Dnu = DATA["dt"], DATA["dnu"][0]
+                lm_min=None
+                if self.GD["RIME"]["DecorrLocation"]=="Edge":
+                    lm_min=self.DicoImager[iFacet]["lm_min"]
+                GridMachine.setDecorr(uvw_dt, DT, Dnu, 
+                                      SmearMode=DecorrMode, 
+                                      lm_min=lm_min,
+                                      lm_PhaseCenter=DATA["lm_PhaseCenter"])
+
+            PlaneModel = ModelGrid
+            if self._wmode == "WStacking":
+                for jPlane, Phase in WPhases:
+                    if jPlane == iPlane:
+                        break
+                PlaneModel = (ModelGrid * Phase).astype(self.CType)
+
+            GridMachine.get(times, uvwThis, visThis, flagsThis, A0A1,
+                              PlaneModel, ImToGrid=False,
+                              DicoJonesMatrices=DicoJonesMatrices,
+                              freqs=freqs, TranformModelInput="FT",
+                              ChanMapping=ChanMapping,
+                              sparsification=Sparsification
+                            )
 
-        return {"iFacet": iFacet}
+        return {"iFacet": iFacet, "Stats": self._giveJobStats("Degrid", iFacet, t0, NVis=visThis.shape[0]*visThis.shape[1])}
+
+    def _degrid_private_worker(self, iBuffer, ListFacets, DATA, cf_dict, ChanSel, modeldict, outdict):
+        """
+        Degrids a group of facets into a private output buffer. No other job writes to this
+        buffer, so its grid machines are created without row semaphores. The buffer is summed into
+        DATA["data"] by collectDegriddingResults()
+        """
+        visThis = outdict[iBuffer]
+        visThis.fill(0)
+        ListStats = []
+        for iFacet in ListFacets:
+            DicoResult = self._degrid_worker(iFacet, DATA, cf_dict[iFacet], ChanSel, modeldict, None,
+                                             visThis=visThis)
+            ListStats.append(DicoResult["Stats"])
+        return {"iBuffer": iBuffer, "Facets": ListFacets, "Stats": ListStats}
+
+    def _giveDegridOutputBuffers(self, vis):
+        """
+        Sets up the private degridding buffers (one per group of facets), each of the same shape as
+        the visibilities. Each buffer is a full copy of the chunk, so there are at most
+        RIME-DegridMaxBuffers of them (and no more than CPUs or facets), fewer if they don't fit the
+        shared memory budget. Buffers are kept between chunks, and only reallocated when the chunk
+        shape changes.
+        """
+        Name = "%sDegridOutput" % self._app_id
+        if self._degrid_buffer_facets is None:
+            NBuffers = max(1, min(self.GD["Parallel"]["NCPU"], len(self.DicoImager),
+                                  self.GD["RIME"].get("DegridMaxBuffers", 4) or 4))
+            while NBuffers > 1 and self._giveSHMAccount().check(Name, NBuffers * vis.nbytes) is not None:
+                NBuffers -= 1
+            print>>log, "degridding into %i private buffers of %.2f GB" % (NBuffers, vis.nbytes / 1024.**3)
+            # spread facets over buffers, largest first, so that the jobs are of similar cost
+            Load = np.zeros(NBuffers, np.float64)
+            self._degrid_buffer_facets = [[] for iBuffer in xrange(NBuffers)]
+            for iFacet in sorted(self.DicoImager.keys(), key=lambda i: -self.DicoImager[i]["NpixFacetPadded"]):
+                if self._numa is not None and NBuffers >= len(self._numa.ListNodeCPUs):
+                    # buffer iBuffer only holds facets of node iBuffer%NNodes, so that its job runs on one node
+                    NNodes = len(self._numa.ListNodeCPUs)
+                    NodeLoad = np.where(np.arange(NBuffers) % NNodes == self._numa.NodeOfFacet[iFacet], Load, np.inf)
+                    iBuffer = np.argmin(NodeLoad)
+                else:
+                    iBuffer = np.argmin(Load)
+                self._degrid_buffer_facets[iBuffer].append(iFacet)
+                Load[iBuffer] += self.DicoImager[iFacet]["NpixFacetPadded"]**2
+        if self._degrid_output_dict is None:
+            self._degrid_output_dict = shared_dict.create(Name)
+        for iBuffer in xrange(len(self._degrid_buffer_facets)):
+            buf = self._degrid_output_dict.get(iBuffer)
+            if buf is not None and (buf.shape != vis.shape or buf.dtype != vis.dtype):
+                self._degrid_output_dict.delete_item(iBuffer)
+                buf = None
+            if buf is None:
+                self._accountSHM(Name, self._degrid_output_dict)
+                self._checkSHM(Name, vis.nbytes)
+                self._degrid_output_dict.addSharedArray(iBuffer, vis.shape, vis.dtype)
+        self._accountSHM(Name, self._degrid_output_dict)
+        return self._degrid_output_dict
 
     def degridChunkInBackground (self, DATA):
         """
@@ -1705,6 +3967,8 @@ class ClassFacetMachine():
         Preconditions: the dirty image buffers should be cleared before calling
         the predict and regridding methods
         to construct a new residual map
+        In "Private" degrid mode, facets are degridded into per-job buffers, and
+        subtracted from DATA["data"] by collectDegriddingResults().
         Args:
             times:
             uvwIn:
@@ -1722,13 +3986,33 @@ class ClassFacetMachine():
         # create FacetNorm in shared dict if not exist
         self.BuildFacetNormImage()
 
+        self._setWPlanes(DATA, "BDA.Degrid")
+        self._setBeamJones(DATA)
+
         self._degrid_job_label = DATA["label"]
         self._degrid_job_id = "%s.Degrid.%s:" % (self._app_id, self._degrid_job_label)
 
+        if self._degrid_mode == "Private":
+            outdict = self._giveDegridOutputBuffers(DATA["data"])
+            self._degrid_DATA = DATA
+            for iBuffer, ListFacets in enumerate(self._degrid_buffer_facets):
+                # only pin the job to a NUMA node if all its facets are on that node (there may be fewer buffers than nodes)
+                iFacetPin = None
+                if self._numa is not None and \
+                   len(set([self._numa.NodeOfFacet[iFacet] for iFacet in ListFacets])) == 1:
+                    iFacetPin = ListFacets[0]
+                self._runJob("%sB%d" % (self._degrid_job_id, iBuffer), self._degrid_private_worker,
+                                args=(iBuffer, ListFacets, DATA.readonly(), self._CF.readonly(),
+                                      ChanSel, self._model_dict.readonly(), outdict.readonly()),
+                             iFacet=iFacetPin, Estimate=any([self._isLearningWisdom(jFacet) for jFacet in ListFacets]))
+            return
+
+        ListSemaphores = self._setDegriddingSemaphores(DATA["uvw"].shape[0])
         for iFacet in self.DicoImager.keys():
-            APP.runJob("%sF%d" % (self._degrid_job_id, iFacet), self._degrid_worker,
+            self._runJob("%sF%d" % (self._degrid_job_id, iFacet), self._degrid_worker,
                             args=(iFacet, DATA.readonly(), self._CF[iFacet].readonly(),
-                                  ChanSel, self._model_dict.readonly()))#,serial=True)
+                                  ChanSel, self._model_dict.readonly(), ListSemaphores),
+                             iFacet=iFacet)#,serial=True)
         #APP.awaitJobResults(self._degrid_job_id + "*", progress="Degrid %s" % self._degrid_job_label)
 
 
@@ -1736,12 +4020,21 @@ class ClassFacetMachine():
         """
         If any degrid workers are still at work, waits for them to finish and collects the results.
         Otherwise does nothing.
+        In "Private" degrid mode, the per-job buffers are summed into DATA["data"] here.
         """
         # if this is set to None, then results already collected
         if self._degrid_job_id is None:
             return
         # collect results of degrid workers
-        APP.awaitJobResults(self._degrid_job_id + "*", progress="Degrid %s" % self._degrid_job_label)
+        results = self._awaitJobResults(self._degrid_job_id + "*", progress="Degrid %s" % self._degrid_job_label)
+        self._recordJobResults(results)
         self._degrid_job_id = None
+        if self._degrid_mode == "Private":
+            vis = self._degrid_DATA["data"]
+            numexpr.set_num_threads(self.GD["Parallel"]["NCPU"])
+            for iBuffer in xrange(len(self._degrid_buffer_facets)):
+                buf = self._degrid_output_dict[iBuffer]
+                numexpr.evaluate("vis+buf", out=vis, casting="unsafe")
+            self._degrid_DATA = None
         return True
 
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Benchmark of the ClassFacetMachine hot paths on synthetic data.
+
+A synthetic visibility server (VS) and the default DDFacet parset (GD) stand in for a real
+measurement set, so that setFacetsLocs, Init, initCFInBackground, gridChunkInBackground,
+FacetsToIm (dirty and PSF), the streaming FITS writer, degridChunkInBackground and
+giveRestoredFacets can be timed over a matrix of NPix, NFacets, NFreqBands and Padding. Each configuration runs in its own process,
+since the APP workers are forked once the facet machines have been set up. The facet machine
+benchmarked is the one installed as DDFacet.Imager.ClassFacetMachine (see README.md).
+
+Results are saved as JSON. Given a previous result file with --Baseline, the ratio of every
+timing to its baseline is printed, and the exit status is non-zero if any timing regressed
+by more than --Tolerance.
+
+Example:
+    python benchmark_facetmachine.py --NPix 1024,2048 --NFacets 9,25 --NCPU 8 --Out bench.json
+    python benchmark_facetmachine.py --NPix 1024,2048 --NFacets 9,25 --NCPU 8 --Out new.json --Baseline bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import itertools
+import optparse
+import subprocess
+import socket
+import numpy as np
+
+C = 299792458.
+
+
+class ClassSyntheticMS(object):
+    """The few measurement set attributes used by the facet machine"""
+    def __init__(self, ChanFreq, radec=(2.9, 0.83)):
+        self.ChanFreq = ChanFreq
+        self.radec = radec
+
+
+class ClassSyntheticCache(object):
+    """Cache manager that never has a valid cache, so that everything is recomputed"""
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def checkCache(self, name, hashkeys, directory=False, reset=False):
+        path = os.path.join(self.dirname, name)
+        if directory and not os.path.isdir(path):
+            os.makedirs(path)
+        return path, False
+
+    def saveCache(self, name=None):
+        pass
+
+
+class ClassSyntheticVS(object):
+    """
+    Stand-in for ClassVisServer: a single MS of NChan channels between 120 and 160 MHz,
+    mapped onto NFreqBands imaging bands.
+    """
+    def __init__(self, GD, NChan, cachedir):
+        from DDFacet.Data.ClassStokes import ClassStokes
+        NFreqBands = GD["Freq"]["NBand"]
+        # XX,XY,YX,YY, in casacore Stokes enumeration
+        self.StokesConverter = ClassStokes([9, 10, 11, 12], GD["RIME"]["PolMode"])
+        self.GlobalFreqs = np.linspace(120e6, 160e6, NChan)
+        self.ListMS = [ClassSyntheticMS(self.GlobalFreqs)]
+        self.nMS = 1
+        self.NFreqBands = NFreqBands
+        self.MultiFreqMode = NFreqBands > 1
+        ChanMapping = np.int32(np.arange(NChan) * NFreqBands // NChan)
+        self.FreqBandChannels = [self.GlobalFreqs[ChanMapping == band] for band in xrange(NFreqBands)]
+        self.DicoMSChanMapping = {0: ChanMapping}
+        self.DicoMSChanMappingChan = {0: np.int32(np.arange(NChan))}
+        self.ChanMapping = ChanMapping
+        self.maincache = ClassSyntheticCache(cachedir)
+
+
+def giveDefaultGD(Config, NCPU, cachedir):
+    """Default DDFacet parset, set up for the given benchmark configuration"""
+    import DDFacet.Parset
+    from DDFacet.Parset import ReadCFG
+    GD = ReadCFG.Parset(os.path.join(os.path.dirname(DDFacet.Parset.__file__), "DefaultParset.cfg")).DicoPars
+    GD["Image"]["NPix"] = Config["NPix"]
+    GD["Image"]["Cell"] = Config["Cell"]
+    GD["Facets"]["NFacets"] = Config["NFacets"]
+    GD["Facets"]["Padding"] = Config["Padding"]
+    GD["Freq"]["NBand"] = Config["NFreqBands"]
+    GD["RIME"]["PolMode"] = "I"
+    GD["RIME"]["DecorrMode"] = ""
+    GD["Beam"]["Model"] = None
+    GD["DDESolutions"]["DDSols"] = ""
+    GD["Parallel"]["NCPU"] = NCPU
+    GD["Cache"]["DirWisdomFFTW"] = os.path.join(cachedir, "wisdom")
+    # the wisdom dir is fresh: learn it before the timed stages, not in a background learner competing with them
+    GD["Cache"]["WisdomMode"] = "Serial"
+    return GD
+
+
+def giveSyntheticChunk(VS, GD, NRows, NAnt=48, seed=0):
+    """
+    Creates a shared dict of random visibilities in the layout produced by ClassVisServer,
+    with uv-coverage filling the image resolution and a trivial (one block per row) BDA mapping
+    """
+    from DDFacet.Array import shared_dict
+    rs = np.random.RandomState(seed)
+    NChan = VS.GlobalFreqs.size
+    DATA = shared_dict.create("BenchDATA")
+    DATA["iMS"], DATA["iChunk"], DATA["label"] = 0, 0, "0.0"
+    # baselines up to the length that resolves one cell at the highest frequency
+    CellRad = GD["Image"]["Cell"] / 3600. * np.pi / 180.
+    umax = C / VS.GlobalFreqs[-1] / (2 * CellRad)
+    r, th = umax * np.sqrt(rs.uniform(0, 1, NRows)), rs.uniform(0, 2 * np.pi, NRows)
+    uvw = np.zeros((NRows, 3), np.float64)
+    uvw[:, 0], uvw[:, 1], uvw[:, 2] = r * np.cos(th), r * np.sin(th), rs.normal(0, umax / 10., NRows)
+    DATA["uvw"] = uvw
+    DATA["data"] = np.complex64(rs.normal(size=(NRows, NChan, 4)) + 1j * rs.normal(size=(NRows, NChan, 4)))
+    DATA["flags"] = np.zeros((NRows, NChan, 4), np.bool)
+    DATA["times"] = np.sort(rs.uniform(0, 3600, NRows))
+    A0 = rs.randint(0, NAnt - 1, NRows)
+    DATA["A0"], DATA["A1"] = np.int32(A0), np.int32(A0 + 1 + rs.randint(0, NAnt - 1 - A0))
+    DATA["Weights"] = np.ones((NRows, NChan), np.float32)
+    DATA["freqs"] = VS.GlobalFreqs
+    DATA["ChanMapping"] = DATA["ChanMappingDegrid"] = VS.ChanMapping
+    DATA["dt"], DATA["dnu"] = 10., np.ones(NChan) * (VS.GlobalFreqs[1] - VS.GlobalFreqs[0])
+    # BDA mapping: [NBlocks, size of each block, rows of block 0, ChanStart, ChanEnd, rows of block 1, ...]
+    Blocks = np.zeros((NRows, 3), np.int32)
+    Blocks[:, 0], Blocks[:, 2] = np.arange(NRows), NChan
+    DATA["BDA.Grid"] = DATA["BDA.Degrid"] = np.concatenate([[NRows], np.ones(NRows, np.int32) * 3, Blocks.ravel()]).astype(np.int32)
+    DATA["Sparsification"] = np.array([])
+    return DATA
+
+
+class ClassTimer(object):
+    def __init__(self):
+        self.timings = {}
+
+    def __call__(self, name, func, *args, **kw):
+        t0 = time.time()
+        result = func(*args, **kw)
+        self.timings[name] = self.timings.get(name, 0.) + time.time() - t0
+        return result
+
+
+def runConfig(Config, NCPU, NRows, NChan):
+    """Runs one benchmark configuration in this process, returns its timings"""
+    from DDFacet.Other.AsyncProcessPool import APP
+    from DDFacet.Imager.ClassFacetMachine import ClassFacetMachine
+    cachedir = tempfile.mkdtemp(prefix="DDF.bench.")
+    T = ClassTimer()
+    try:
+        APP.init(NCPU, affinity=0, parent_affinity=0, verbose=0)
+        GD = giveDefaultGD(Config, NCPU, cachedir)
+        VS = ClassSyntheticVS(GD, NChan, cachedir)
+        ImageName = os.path.join(cachedir, "bench")
+        FM = ClassFacetMachine(VS, GD, Precision="S", PolMode=GD["RIME"]["PolMode"], DoPSF=False)
+        FMPSF = ClassFacetMachine(VS, GD, Precision="S", PolMode=GD["RIME"]["PolMode"], DoPSF=True)
+        # a single (direction-independent) solution direction at the phase centre
+        for fm in (FM, FMPSF):
+            fm.lmSols = (np.zeros(1), np.zeros(1))
+            fm.radecSols = (np.array([VS.ListMS[0].radec[0]]), np.array([VS.ListMS[0].radec[1]]))
+        # appendMainField is essentially setFacetsLocs()
+        T("setFacetsLocs", FM.appendMainField, ImageName=ImageName)
+        T("setFacetsLocs", FMPSF.appendMainField, ImageName=ImageName)
+        T("Init", FM.Init)
+        T("Init", FMPSF.Init)
+        # workers must be forked after the facet machines are set up
+        APP.startWorkers()
+        T("initCFInBackground", FM.initCFInBackground)
+        T("initCFInBackground", FMPSF.initCFInBackground, other_fm=FM)
+        T("initCFInBackground", FM.awaitInitCompletion)
+
+        DATA = giveSyntheticChunk(VS, GD, NRows)
+        T("gridChunkInBackground", FM.putChunkInBackground, DATA)
+        T("gridChunkInBackground", FM.collectGriddingResults)
+        T("gridChunkInBackground.PSF", FMPSF.putChunkInBackground, DATA)
+        T("gridChunkInBackground.PSF", FMPSF.collectGriddingResults)
+
+        DicoDirty = T("FacetsToIm", FM.FacetsToIm, NormJones=True)
+        FMPSF.setNormImages(DicoDirty)
+        T("FacetsToIm.PSF", FMPSF.FacetsToIm, NormJones=True)
+        # stitched residual streamed to FITS, in the background while the model is predicted
+        T("FacetsToFits", FM.ToCasaImage, None, ImageName="%s.dirty" % ImageName)
+
+        # sparse model of point sources
+        rs = np.random.RandomState(1)
+        Model = np.zeros(FM.OutImShape, np.float32)
+        Npix = FM.OutImShape[-1]
+        Model[:, :, rs.randint(0, Npix, 100), rs.randint(0, Npix, 100)] = 1.
+        FM.setModelImage(Model)
+        T("degridChunkInBackground", FM.getChunkInBackground, DATA)
+        T("degridChunkInBackground", FM.collectDegriddingResults)
+        T("FacetsToFits", FM.awaitFitsWriters)
+
+        T("giveRestoredFacets", FM.giveRestoredFacets, DicoDirty, (3., 3., 0.))
+        for fm in (FM, FMPSF):
+            fm.shutdown()
+        DATA.delete()
+    finally:
+        APP.shutdown()
+        shutil.rmtree(cachedir, ignore_errors=True)
+    return T.timings
+
+
+def giveConfigName(Config):
+    return "NPix%(NPix)i.NFacets%(NFacets)i.NBand%(NFreqBands)i.Pad%(Padding).2f" % Config
+
+
+def compareBaseline(Results, Baseline, Tolerance):
+    """Prints the ratio of each timing to the baseline. Returns True if nothing regressed beyond Tolerance"""
+    OK = True
+    for Name, Timings in sorted(Results["Configs"].items()):
+        if Name not in Baseline["Configs"]:
+            print "%s: not in baseline" % Name
+            continue
+        for Step, t in sorted(Timings.items()):
+            t0 = Baseline["Configs"][Name].get(Step)
+            if not t0:
+                continue
+            Ratio = t / t0
+            Flag = ""
+            if Ratio > 1 + Tolerance:
+                Flag, OK = "  <-- REGRESSION", False
+            print "%-40s %-28s %8.3fs  baseline %8.3fs  x%.2f%s" % (Name, Step, t, t0, Ratio, Flag)
+    return OK
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--NPix", default="1024", help="comma-separated image sizes [%default]")
+    parser.add_option("--NFacets", default="9", help="comma-separated number of facets (per side) [%default]")
+    parser.add_option("--NFreqBands", default="1", help="comma-separated number of bands [%default]")
+    parser.add_option("--Padding", default="1.7", help="comma-separated facet paddings [%default]")
+    parser.add_option("--Cell", type=float, default=5., help="cell size in arcsec [%default]")
+    parser.add_option("--NCPU", type=int, default=0, help="number of APP workers, 1 to run serially [all cores]")
+    parser.add_option("--NRows", type=int, default=100000, help="rows of the synthetic chunk [%default]")
+    parser.add_option("--NChan", type=int, default=16, help="channels of the synthetic chunk [%default]")
+    parser.add_option("--Out", default="benchmark_facetmachine.json", help="output JSON file [%default]")
+    parser.add_option("--Baseline", default=None, help="previous output JSON file to compare against")
+    parser.add_option("--Tolerance", type=float, default=0.2, help="allowed slowdown w.r.t. baseline [%default]")
+    parser.add_option("--Single", default=None, help=optparse.SUPPRESS_HELP)
+    options, _ = parser.parse_args()
+    NCPU = options.NCPU or os.sysconf("SC_NPROCESSORS_ONLN")
+
+    if options.Single:
+        # run one configuration, in a child process
+        Config = json.loads(options.Single)
+        Timings = runConfig(Config, NCPU, options.NRows, options.NChan)
+        with open(options.Out, "w") as f:
+            json.dump(Timings, f)
+        return 0
+
+    Results = {"host": socket.gethostname(), "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "NCPU": NCPU, "NRows": options.NRows, "NChan": options.NChan, "Configs": {}}
+    Matrix = itertools.product([int(x) for x in options.NPix.split(",")],
+                               [int(x) for x in options.NFacets.split(",")],
+                               [int(x) for x in options.NFreqBands.split(",")],
+                               [float(x) for x in options.Padding.split(",")])
+    for NPix, NFacets, NFreqBands, Padding in Matrix:
+        Config = dict(NPix=NPix, NFacets=NFacets, NFreqBands=NFreqBands, Padding=Padding, Cell=options.Cell)
+        Name = giveConfigName(Config)
+        print "running %s" % Name
+        fd, TmpOut = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), "--Single", json.dumps(Config),
+                                   "--NCPU", str(NCPU), "--NRows", str(options.NRows), "--NChan", str(options.NChan),
+                                   "--Out", TmpOut])
+            Results["Configs"][Name] = json.load(open(TmpOut))
+        finally:
+            os.unlink(TmpOut)
+        for Step, t in sorted(Results["Configs"][Name].items()):
+            print "  %-28s %8.3fs" % (Step, t)
+
+    with open(options.Out, "w") as f:
+        json.dump(Results, f, indent=1, sort_keys=True)
+    print "wrote %s" % options.Out
+
+    if options.Baseline:
+        if not compareBaseline(Results, json.load(open(options.Baseline)), options.Tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
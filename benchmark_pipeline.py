@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""
+Pipeline-level benchmark on a miniature observation with synthetic visibilities.
+
+This needs a real LOFAR measurement set (--Template): the observation layout (antennas, uvw,
+times, channels) is taken from it, only the visibilities are synthetic. A few minutes of the
+template are copied to a work directory, and its DATA and CORRECTED_DATA columns are replaced
+with noise plus the visibilities of a synthetic sky model (point and Gaussian sources, written
+in makesourcedb format and predicted with pipeline.predict_skymodel). A shortened stage
+list of pipeline.py is then run through the usual ddf_image, make_mask and killms_data
+wrappers, and the wall time of every stage is saved as JSON. Given a previous result file
+with --Baseline, the ratio of every stage time to its baseline is printed, and the exit status
+is non-zero if any stage regressed by more than --Tolerance.
+
+Example:
+    benchmark_pipeline.py --Template L123456_SB100.ms --WorkDir /data/scratch/bench --Out bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import optparse
+import numpy as np
+import pyrap.tables as pt
+
+# (name, type, offset in l and m in degrees, I, reference frequency, spectral index, major/minor FWHM in arcsec, PA in degrees)
+SKY_MODEL = [("bench_delta0", "POINT", (0.0, 0.0), 1.0, 125e6, [-0.7], None),
+             ("bench_delta1", "POINT", (0.8, 0.5), 0.5, 125e6, [-0.56, -0.05], None),
+             ("bench_delta2", "POINT", (-1.0, 0.9), 0.3, 125e6, [-0.8], None),
+             ("bench_delta3", "POINT", (0.4, -1.2), 0.2, 125e6, [-0.7], None),
+             ("bench_gauss0", "GAUSSIAN", (-0.6, -0.5), 0.4, 125e6, [-0.7], (90., 60., 30.)),
+             ("bench_gauss1", "GAUSSIAN", (1.3, -0.2), 0.2, 125e6, [-0.7], (180., 120., 62.6))]
+
+
+def give_radec(ra0, dec0, l, m):
+    """Inverse SIN projection of (l,m) around (ra0,dec0), all in radians"""
+    n = np.sqrt(1 - l**2 - m**2)
+    dec = np.arcsin(m * np.cos(dec0) + n * np.sin(dec0))
+    ra = ra0 + np.arctan2(l, n * np.cos(dec0) - m * np.sin(dec0))
+    return ra % (2 * np.pi), dec
+
+
+def format_ra(ra):
+    h = np.degrees(ra) / 15.
+    return "%02i:%02i:%07.4f" % (int(h), int(h * 60) % 60, (h * 3600) % 60)
+
+
+def format_dec(dec):
+    d = abs(np.degrees(dec))
+    return "%s%02i.%02i.%07.4f" % ("+" if dec >= 0 else "-", int(d), int(d * 60) % 60, (d * 3600) % 60)
+
+
+def write_skymodel(fname, ra0, dec0):
+    """Writes the synthetic sky model in makesourcedb format, as in sim.skymodel"""
+    with open(fname, "w") as f:
+        f.write("# (Name, Type, Ra, Dec, I, ReferenceFrequency, SpectralIndex, MajorAxis, MinorAxis, Orientation) = format\n")
+        for name, stype, (dl, dm), flux, freq0, alpha, shape in SKY_MODEL:
+            ra, dec = give_radec(ra0, dec0, np.radians(dl), np.radians(dm))
+            line = "%s, %s, %s, %s, %g, %g, [%s]" % (name, stype, format_ra(ra), format_dec(dec), flux, freq0,
+                                                     ", ".join(["%g" % a for a in alpha]))
+            if shape is not None:
+                line += ", %g, %g, %g" % shape
+            f.write(line + "\n")
+
+
+def make_synthetic_ms(template, msname, skymodel, duration, noise, ncpu, seed=0):
+    """
+    Copies the first duration seconds of template to msname, writes the synthetic sky model to
+    skymodel, and fills DATA and CORRECTED_DATA with the sky model plus gaussian noise of the
+    given rms per visibility
+    """
+    import pipeline
+    t = pt.table(template, ack=False)
+    tmin = t.getcol("TIME", 0, 1)[0]
+    sub = t.query("TIME < %f" % (tmin + duration))
+    sub.copy(msname, deep=True)
+    sub.close()
+    t.close()
+
+    ra0, dec0 = pt.table(msname + "/FIELD", ack=False).getcol("PHASE_DIR")[0, 0]
+    write_skymodel(skymodel, ra0, dec0)
+    t = pt.table(msname, readonly=False, ack=False)
+    shape = t.getcell("DATA", 0).shape
+    rs = np.random.RandomState(seed)
+    for row0 in range(0, t.nrows(), 10000):
+        nrow = min(10000, t.nrows() - row0)
+        data = noise * (rs.normal(size=(nrow,) + shape) + 1j * rs.normal(size=(nrow,) + shape)) / np.sqrt(2)
+        t.putcol("DATA", data.astype(np.complex64), row0, nrow)
+        t.putcol("FLAG", np.zeros((nrow,) + shape, np.bool), row0, nrow)
+    t.close()
+    pipeline.predict_skymodel(msname, skymodel, colname="DATA", out_colname="DATA", ncpu=ncpu)
+    pipeline.combine_columns(msname, "CORRECTED_DATA = DATA", ncpu=ncpu)
+
+
+def write_config(fname, mslist, imsize, cellsize, ndir, ncpu):
+    with open(fname, "w") as f:
+        f.write("[data]\nmslist=%s\n\n" % mslist)
+        f.write("[image]\nimsize=%i\ncellsize=%f\nrobust=-0.15\npsf_arcsec=12.0\n\n" % (imsize, cellsize))
+        f.write("[solutions]\nndir=%i\n\n" % ndir)
+        f.write("[machine]\nNCPU_DDF=%i\nNCPU_killms=%i\n\n" % (ncpu, ncpu))
+        f.write("[control]\nrestart=False\nlogging=logs\n\n")
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.stages = []
+
+    def __call__(self, name, func, *args, **kw):
+        t0 = time.time()
+        result = func(*args, **kw)
+        self.stages.append((name, time.time() - t0))
+        print "stage %-28s %8.1fs" % (name, self.stages[-1][1])
+        return result
+
+
+def run_stages(o, T):
+    """Shortened version of the pipeline.py stage list: initial imaging, masking, one phase self-calibration"""
+    import pipeline
+    # the wrappers fall back on the pipeline's global options
+    pipeline.o = o
+    colname = o['colname']
+    uvrange = [o['image_uvmin'], 1000]
+    T("check_imaging_weight", pipeline.check_imaging_weight, o['mslist'])
+    T("ddf_image:dirin_init", pipeline.ddf_image, 'image_dirin_SSD_init', o['mslist'], cleanmask=None, cleanmode='SSD',
+      majorcycles=0, robust=o['image_robust'], peakfactor=0.05, colname=colname, apply_weights=o['apply_weights'][0],
+      uvrange=uvrange, options=o)
+    external_mask = 'external_mask.fits'
+    T("make_external_mask", pipeline.make_external_mask, external_mask, 'image_dirin_SSD_init.dirty.fits',
+      use_tgss=False, clobber=True, options=o)
+    T("ddf_image:dirin", pipeline.ddf_image, 'image_dirin_SSD', o['mslist'], cleanmask=external_mask, cleanmode='SSD',
+      majorcycles=2, robust=o['image_robust'], reuse_psf=True, reuse_dirty=True, peakfactor=0.05, colname=colname,
+      automask=True, automask_threshold=o['thresholds'][0], apply_weights=o['apply_weights'][0], uvrange=uvrange, options=o)
+    T("make_mask", pipeline.make_mask, 'image_dirin_SSD.app.restored.fits', o['thresholds'][0],
+      external_mask=external_mask, options=o)
+    T("mask_dicomodel", pipeline.mask_dicomodel, 'image_dirin_SSD.DicoModel', 'image_dirin_SSD.app.restored.fits.mask.fits',
+      'image_dirin_SSD_masked.DicoModel')
+    T("make_model", pipeline.make_model, 'image_dirin_SSD.app.restored.fits.mask.fits', 'image_dirin_SSD')
+    T("killms_data", pipeline.killms_data, 'image_dirin_SSD', o['mslist'], 'killms_p1', colname=colname,
+      dicomodel='image_dirin_SSD_masked.DicoModel', clusterfile='image_dirin_SSD.npy.ClusterCat.npy',
+      niterkf=o['NIterKF'][0], uvrange=[0, 1000], robust=o['solutions_robust'], options=o)
+    T("ddf_image:phase1", pipeline.ddf_image, 'image_phase1', o['mslist'], cleanmask=external_mask, cleanmode='SSD',
+      ddsols='killms_p1', applysols='P', majorcycles=1, robust=o['image_robust'], colname=colname, peakfactor=0.01,
+      automask=True, automask_threshold=o['thresholds'][1], normalization=o['normalize'][0],
+      apply_weights=o['apply_weights'][1], uvrange=uvrange, use_dicomodel=True, dicomodel_base='image_dirin_SSD_masked',
+      options=o)
+
+
+def compare_baseline(results, baseline, tolerance):
+    ok = True
+    base = dict(baseline["stages"])
+    for name, t in results["stages"] + [("total", results["total"])]:
+        t0 = base.get(name, baseline["total"] if name == "total" else None)
+        if not t0:
+            print "%-28s %8.1fs  (not in baseline)" % (name, t)
+            continue
+        flag = ""
+        if t / t0 > 1 + tolerance:
+            flag, ok = "  <-- REGRESSION", False
+        print "%-28s %8.1fs  baseline %8.1fs  x%.2f%s" % (name, t, t0, t / t0, flag)
+    return ok
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--Template", help="real LOFAR measurement set to take the observation layout from (required)")
+    parser.add_option("--WorkDir", default="benchmark_pipeline", help="work directory, emptied first [%default]")
+    parser.add_option("--Duration", type=float, default=600., help="seconds of the template to keep [%default]")
+    parser.add_option("--Noise", type=float, default=0.5, help="noise rms per visibility in Jy [%default]")
+    parser.add_option("--ImSize", type=int, default=2000, help="image size in pixels [%default]")
+    parser.add_option("--CellSize", type=float, default=4.5, help="cell size in arcsec [%default]")
+    parser.add_option("--NDir", type=int, default=5, help="number of calibration directions [%default]")
+    parser.add_option("--NCPU", type=int, default=0, help="cores for DDF and killMS [all cores]")
+    parser.add_option("--Out", default="benchmark_pipeline.json", help="output JSON file [%default]")
+    parser.add_option("--Baseline", default=None, help="previous output JSON file to compare against")
+    parser.add_option("--Tolerance", type=float, default=0.2, help="allowed slowdown w.r.t. baseline [%default]")
+    opts, _ = parser.parse_args()
+    if opts.Template is None:
+        parser.error("--Template must be given")
+    ncpu = opts.NCPU or os.sysconf("SC_NPROCESSORS_ONLN")
+    out = os.path.abspath(opts.Out)
+    template = os.path.abspath(opts.Template)
+    baseline = json.load(open(opts.Baseline)) if opts.Baseline else None
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from pipeline import option_list
+    from options import options
+
+    if os.path.isdir(opts.WorkDir):
+        shutil.rmtree(opts.WorkDir)
+    os.makedirs(opts.WorkDir)
+    os.chdir(opts.WorkDir)
+    os.mkdir("logs")
+
+    T = StageTimer()
+    T("make_synthetic_ms", make_synthetic_ms, template, "bench.ms", "bench.skymodel", opts.Duration, opts.Noise, ncpu)
+    with open("mslist.txt", "w") as f:
+        f.write("bench.ms\n")
+    write_config("bench.cfg", "mslist.txt", opts.ImSize, opts.CellSize, opts.NDir, ncpu)
+    o = options(["bench.cfg"], option_list)
+
+    t0 = time.time()
+    run_stages(o, T)
+    results = {"host": socket.gethostname(), "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "template": template, "duration": opts.Duration, "imsize": opts.ImSize,
+               "ndir": opts.NDir, "ncpu": ncpu, "stages": T.stages, "total": time.time() - t0}
+    with open(out, "w") as f:
+        json.dump(results, f, indent=1)
+    print "wrote %s" % out
+
+    if baseline is not None and not compare_baseline(results, baseline, opts.Tolerance):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
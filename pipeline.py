@@ -22,6 +22,17 @@ import os,sys
 import os.path
 from auxcodes import report,run,find_imagenoise,warn,die,Catcher,dotdict
 from parset import option_list
+# options of this module that the parset module does not define: (section, name, type, default, help)
+option_list = tuple(option_list) + (
+    ('image', 'preview_sparsify', float, None,
+     'Sparsification factor of the quick-look dirty image used to make the external mask (None to image all the data)'),
+    ('image', 'preview_sparsify_mode', str, 'Stratified',
+     'How the quick-look image is sparsified: Stratified (seeded, over baseline length and time) or Random'),
+    ('image', 'preview_sparsify_seed', int, 0,
+     'Seed of the stratified sparsification of the quick-look image'),
+    ('image', 'sim_predict', str, 'inprocess',
+     'How the sources of sim_skymodel are predicted: inprocess (Stokes I, no primary beam), or bbs (calibrate-stand-alone with predict_parset)'),
+)
 from options import options,print_options
 from shutil import copyfile,rmtree,move
 import glob
@@ -39,55 +50,336 @@ import threading
 from archive_old_solutions import do_archive
 from remove_bootstrap import remove_columns
 
-def add_model(o):
-    f=file(o['full_mslist'])
-    mslist=f.readlines()
-    mslist=[msname.replace("\n","") for msname in mslist]
+import re
+import multiprocessing
+try:
+    import numexpr
+except ImportError:
+    numexpr=None
+
+C=299792458.
+
+def parse_angle(s):
+    """Parses a makesourcedb angle, i.e. hh:mm:ss.s (hours), dd.mm.ss.s (degrees) or a value with deg/rad units, returns radians"""
+    s=s.strip()
+    if s.endswith('rad'):
+        return float(s[:-3])
+    if s.endswith('deg'):
+        return np.radians(float(s[:-3]))
+    sign=-1. if s.startswith('-') else 1.
+    s=s.lstrip('+-')
+    if ':' in s:
+        fields,scale=s.split(':'),15.
+    elif s.count('.')>=2:
+        fields,scale=s.split('.',2),1.
+    else:
+        return sign*np.radians(float(s))
+    value=sum([float(x)/60**i for i,x in enumerate(fields)])
+    return sign*np.radians(value*scale)
+
+def split_skymodel_line(line):
+    """Splits a makesourcedb line on commas, keeping bracketed lists such as [a, b] in one field"""
+    fields,current,depth=[],'',0
+    for c in line:
+        if c=='[': depth+=1
+        if c==']': depth-=1
+        if c==',' and depth==0:
+            fields.append(current.strip())
+            current=''
+        else:
+            current+=c
+    fields.append(current.strip())
+    return fields
+
+def read_skymodel(skymodel):
+    """
+    Reads the point and Gaussian components of a makesourcedb (BBS) sky model. Returns a dict of arrays:
+    ra, dec (radians), I, ref_freq, alpha (one row of spectral terms per component, zero padded),
+    logsi (logarithmic or polynomial spectral terms), maj, min (FWHM, radians) and pa (radians).
+    Only Stokes I is read: components with non-zero Q, U or V are reported
+    """
+    names,defaults=None,{}
+    comps=[]
+    polarized=[]
+    for line in open(skymodel):
+        line=line.strip()
+        if not line: continue
+        if names is None and 'format' in line.lower():
+            # e.g. '# (Name, Type, Ra, Dec, I, ReferenceFrequency='150e6', SpectralIndex='[]') = format'
+            if '(' in line:
+                spec=line[line.index('(')+1:line.rindex(')')]
+            else:
+                spec=line.split('=',1)[1]
+            names=[]
+            for field in split_skymodel_line(spec):
+                if '=' in field:
+                    name,value=field.split('=',1)
+                    defaults[name.strip()]=value.strip().strip('"\'')
+                else:
+                    name=field
+                names.append(name.strip())
+            continue
+        if line.startswith('#'): continue
+        if names is None:
+            die('No format line found in sky model %s' % skymodel)
+        fields=dict(defaults)
+        for name,value in zip(names,split_skymodel_line(line)):
+            if value: fields[name]=value
+        # patch lines have no name or type
+        if not fields.get('Name') or not fields.get('Type'): continue
+        stype=fields['Type'].upper()
+        if stype not in ['POINT','GAUSSIAN']:
+            warn('Skipping component %s of unsupported type %s' % (fields['Name'],fields['Type']))
+            continue
+        if any([float(fields.get(k,0.) or 0.)!=0. for k in ['Q','U','V']]):
+            polarized.append(fields['Name'])
+        alpha=[float(a) for a in fields.get('SpectralIndex','[]').strip('[]').split(',') if a.strip()]
+        shape=[0.,0.,0.]
+        if stype=='GAUSSIAN':
+            shape=[float(fields.get(k,0.)) for k in ['MajorAxis','MinorAxis','Orientation']]
+        comps.append((parse_angle(fields['Ra']),parse_angle(fields['Dec']),float(fields['I']),
+                      float(fields.get('ReferenceFrequency',0.) or 0.),alpha,
+                      fields.get('LogarithmicSI','true').lower()!='false',shape))
+    if polarized:
+        warn('Sky model %s: Q, U and V are ignored, only Stokes I is predicted (%i polarized components: %s)' %
+             (skymodel,len(polarized),', '.join(polarized[:10])+(', ...' if len(polarized)>10 else '')))
+    nalpha=max([1]+[len(c[4]) for c in comps])
+    model={'ra':np.array([c[0] for c in comps]),
+           'dec':np.array([c[1] for c in comps]),
+           'I':np.array([c[2] for c in comps]),
+           'ref_freq':np.array([c[3] for c in comps]),
+           'alpha':np.array([c[4]+[0.]*(nalpha-len(c[4])) for c in comps]).reshape((-1,nalpha)),
+           'logsi':np.array([c[5] for c in comps],dtype=bool),
+           'maj':np.radians(np.array([c[6][0] for c in comps])/3600.),
+           'min':np.radians(np.array([c[6][1] for c in comps])/3600.),
+           'pa':np.radians(np.array([c[6][2] for c in comps]))}
+    return model
+
+def give_skymodel_components(model,ra0,dec0,freqs):
+    """
+    Projects the sky model around the phase centre (ra0,dec0) and evaluates its spectra at freqs.
+    Returns (lmn,spectra,gauss): lmn (nsrc,3) with n-1 as third coordinate, spectra (nsrc,nchan), and for
+    each component the (sin(pa),cos(pa),sigma_maj,sigma_min) of the Gaussian (sigmas are zero for points)
+    """
+    ra,dec=model['ra'],model['dec']
+    l=np.cos(dec)*np.sin(ra-ra0)
+    m=np.sin(dec)*np.cos(dec0)-np.cos(dec)*np.sin(dec0)*np.cos(ra-ra0)
+    n=np.sqrt(1-l**2-m**2)
+    lmn=np.array([l,m,n-1]).T
+    ref_freq=np.where(model['ref_freq']>0,model['ref_freq'],freqs.mean()).reshape((-1,1))
+    x=freqs.reshape((1,-1))/ref_freq
+    spectra=np.zeros((ra.size,freqs.size))
+    logsi=model['logsi']
+    # as makesourcedb: logarithmic I*x^(a0+a1*log10(x)+a2*log10(x)^2+...), otherwise I+sum a_i (x-1)^(i+1)
+    for i in range(model['alpha'].shape[1]):
+        a=model['alpha'][:,i:i+1]
+        spectra[logsi]+=a[logsi]*np.log(x[logsi])*np.log10(x[logsi])**i
+        spectra[~logsi]+=a[~logsi]*(x[~logsi]-1)**(i+1)
+    I=model['I'].reshape((-1,1))
+    spectra[logsi]=I[logsi]*np.exp(spectra[logsi])
+    spectra[~logsi]+=I[~logsi]
+    fwhm2sig=1./np.sqrt(8*np.log(2))
+    gauss=np.array([np.sin(model['pa']),np.cos(model['pa']),model['maj']*fwhm2sig,model['min']*fwhm2sig]).T
+    return lmn,spectra,gauss
+
+def init_pool_worker():
+    """Pool initializer: single-threaded numexpr, as the pool already has a process per core"""
+    if numexpr is not None:
+        numexpr.set_num_threads(1)
+
+def predict_skymodel_block(args):
+    """
+    Pool worker: Stokes I visibilities of the components for a block of rows, shape (nrow,nchan).
+    The sum over sources is vectorized over slabs of (rows,channels,sources) of bounded size
+    """
+    uvw,freqs,lmn,spectra,gauss=args
+    nrow,nchan,nsrc=uvw.shape[0],freqs.size,lmn.shape[0]
+    vis=np.zeros((nrow,nchan),np.complex128)
+    # phase (metres) and Gaussian taper (metres^2) of each row and source
+    phase=np.dot(uvw,lmn.T)
+    up=np.outer(uvw[:,0],gauss[:,0])+np.outer(uvw[:,1],gauss[:,1])
+    vp=np.outer(uvw[:,0],gauss[:,1])-np.outer(uvw[:,1],gauss[:,0])
+    taper=2*np.pi**2*((up*gauss[:,2])**2+(vp*gauss[:,3])**2)
+    K=(2*np.pi*freqs/C).reshape((1,-1,1))
+    K2=((freqs/C)**2).reshape((1,-1,1))
+    nsrc_slab=max(1,min(nsrc,2**20//max(1,nchan)))
+    nrow_slab=max(1,2**22//(nchan*nsrc_slab))
+    for s0 in range(0,nsrc,nsrc_slab):
+        s1=min(nsrc,s0+nsrc_slab)
+        S=spectra[s0:s1].T.reshape((1,nchan,-1))
+        for r0 in range(0,nrow,nrow_slab):
+            r1=min(nrow,r0+nrow_slab)
+            P=phase[r0:r1,s0:s1].reshape((r1-r0,1,-1))
+            A=taper[r0:r1,s0:s1].reshape((r1-r0,1,-1))
+            if numexpr is not None:
+                term=numexpr.evaluate('S*exp(1j*P*K-A*K2)')
+            else:
+                term=S*np.exp(1j*P*K-A*K2)
+            vis[r0:r1]+=term.sum(axis=2)
+    return vis
+
+def predict_skymodel(msname,skymodel,colname='CORRECTED_DATA',out_colname='MODEL_DATA',ncpu=1,rowchunk=None):
+    """
+    In-process predict of the point and Gaussian components of a makesourcedb sky model:
+    out_colname = colname + model, in one pass over row chunks (see combine_columns). The model
+    visibilities of each chunk are computed on a process pool, in row order. Only Stokes I is predicted,
+    and no primary beam is applied: the sources are added with their intrinsic fluxes
+    """
+    from pyrap.tables import table
+    model=read_skymodel(skymodel)
+    ra0,dec0=table(msname+'/FIELD',ack=False).getcol('PHASE_DIR')[0,0]
+    freqs=table(msname+'/SPECTRAL_WINDOW',ack=False).getcol('CHAN_FREQ')[0]
+    lmn,spectra,gauss=give_skymodel_components(model,ra0,dec0,freqs)
+    report('Predicting %i components into %s: %s = %s + model'%(lmn.shape[0],msname,out_colname,colname))
+    t=table(msname,ack=False)
+    nrow=t.nrows()
+    nchan,ncorr=t.getcell(colname,0).shape
+    t.close()
+    # Stokes I: XX=YY=I, cross hands are left as they are
+    corrs={1:[0],2:[0,1],4:[0,3]}[ncorr]
+    if rowchunk is None:
+        rowchunk=max(1,2**22//(nchan*ncorr))
+    rows=range(0,nrow,rowchunk)
+    nproc=max(1,min(ncpu,len(rows)))
+    pool=multiprocessing.Pool(nproc,initializer=init_pool_worker) if nproc>1 else None
+    def give_model_blocks():
+        # UVW is read here, one row chunk at a time, and at most 2*nproc chunks are in flight
+        tuvw=table(msname,ack=False)
+        pending=[]
+        def submit(row0):
+            job=(tuvw.getcol('UVW',row0,min(rowchunk,nrow-row0)),freqs,lmn,spectra,gauss)
+            pending.append(pool.apply_async(predict_skymodel_block,(job,)) if pool else job)
+        try:
+            for row0 in rows[:2*nproc]:
+                submit(row0)
+            for row0 in rows[2*nproc:]+[None]*min(len(rows),2*nproc):
+                job=pending.pop(0)
+                vis=job.get() if pool else predict_skymodel_block(job)
+                if row0 is not None:
+                    submit(row0)
+                d=np.zeros(vis.shape+(ncorr,),np.complex64)
+                for icorr in corrs:
+                    d[:,:,icorr]=vis
+                yield d
+        finally:
+            tuvw.close()
+    try:
+        combine_columns(msname,'%s = %s + SKYMODEL'%(out_colname,colname),sources={'SKYMODEL':give_model_blocks()},
+                        rowchunk=rowchunk,ncpu=ncpu)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+def add_model(o,colname='CORRECTED_DATA',out_colname='MODEL_DATA'):
+    """
+    Adds the sources of sim_skymodel to colname and stores the result in out_colname. By default the
+    predict runs in process (predict_skymodel). With sim_predict set to 'bbs', the sources are predicted
+    into the column set by predict_parset with calibrate-stand-alone and added with add_vis. The in-process
+    predict applies no beam, so a predict_parset that enables one is reported
+    """
+    if o['sim_predict']=='bbs':
+        f=file(o['full_mslist'])
+        mslist=f.readlines()
+        mslist=[msname.replace("\n","") for msname in mslist]
+        for msname in mslist:
+            report('Adding sources to %s'%(msname))
+            runcommand='calibrate-stand-alone '+'--replace-sourcedb '+'--replace-parmdb '+'%s %s %s'%(msname,o['predict_parset'],o['sim_skymodel'])
+            run(runcommand)
+        add_vis(o['mslist'],colname,"SIM_SKYMODEL",out_colname,ncpu=o['NCPU_DDF'])
+        return
+    if o['predict_parset'] and os.path.isfile(o['predict_parset']) and \
+       re.search(r'^\s*[^#]*Model\.Beam\.Enable\s*=\s*(T|True|1)\b',open(o['predict_parset']).read(),re.M|re.I):
+        warn('%s enables the beam, but the in-process predict applies none: the sources of %s are added with their intrinsic fluxes. Set sim_predict=bbs to predict them with calibrate-stand-alone' %
+             (o['predict_parset'],o['sim_skymodel']))
+    f=file(o['mslist'])
+    mslist=[msname.replace("\n","") for msname in f.readlines() if msname.strip()]
     for msname in mslist:
-        report('Adding sources to %s'%(msname))
-        runcommand='calibrate-stand-alone '+'--replace-sourcedb '+'--replace-parmdb '+'%s %s %s'%(msname,o['predict_parset'],o['sim_skymodel'])
-        run(runcommand)
+        predict_skymodel(msname,o['sim_skymodel'],colname=colname,out_colname=out_colname,ncpu=o['NCPU_DDF'])
 
-def add_vis(mslist=None,colname_a="CORRECTED_DATA",colname_b="MODEL_DATA",out_colname="MODEL_DATA"):
+def evaluate_column_expression(rhs,local_dict):
+    """Evaluates rhs over the blocks of local_dict with numexpr. Expressions numexpr can't evaluate are rejected"""
+    try:
+        return numexpr.evaluate(rhs,local_dict=local_dict)
+    except (SyntaxError,KeyError,ValueError,TypeError,NotImplementedError),e:
+        die('Cannot evaluate %s: %s'%(rhs,e))
+
+def combine_columns(msname,expressions,sources=None,rowchunk=None,ncpu=1):
+    """
+    Streaming column-expression engine: evaluates expressions such as 'OUT = A + B - C' over the
+    named columns of msname, in one pass per block of rows. Every input column is read once per block
+    however many expressions use it, and every output column is written once per block. Later expressions
+    can use the outputs of earlier ones. sources maps extra names to iterators giving, in row order, the
+    blocks of arrays that are not columns (e.g. predicted visibilities). Missing output columns are added
+    with the description of the first column of their expression. Evaluation is multithreaded with numexpr
+    """
     from pyrap.tables import table
-    f=file(mslist)
-    mslist=f.readlines()
-    mslist=[msname.replace("\n","") for msname in mslist]
-    for msname in mslist:
-        report('Adding: %s = %s + %s'%(out_colname,colname_a,colname_b))
-        t=table(msname,readonly=False)
-        d=t.getcol(colname_a)
-        p=t.getcol(colname_b)
-        d+=p
-        if out_colname not in t.colnames():
-            report('Adding column %s in %s'%(out_colname,msname))
-            desc=t.getcoldesc(colname_a)
-            desc["name"]=out_colname
+    if numexpr is None:
+        die('Combining columns needs numexpr')
+    if isinstance(expressions,str):
+        expressions=[expressions]
+    sources=sources or {}
+    t=table(msname,readonly=False,ack=False)
+    colnames=t.colnames()
+    parsed,inputs,outputs=[],[],[]
+    for expression in expressions:
+        out,rhs=[x.strip() for x in expression.split('=',1)]
+        # names not followed by '(' are columns, sources or earlier outputs, the rest are functions
+        names=[]
+        for name in re.findall(r'\b[A-Za-z_]\w*\b(?!\s*\()',rhs):
+            if name in names: continue
+            if name not in outputs and name not in sources:
+                if name not in colnames:
+                    t.close()
+                    die('Unknown column %s in %s'%(name,expression))
+                if name not in inputs:
+                    inputs.append(name)
+            names.append(name)
+        if not inputs:
+            t.close()
+            die('No column to combine in %s'%expression)
+        template=([name for name in names if name in colnames]+inputs)[0]
+        parsed.append((out,rhs,names,template))
+        if out not in outputs:
+            outputs.append(out)
+    for out,rhs,names,template in parsed:
+        if out not in t.colnames():
+            report('Adding column %s in %s'%(out,msname))
+            desc=t.getcoldesc(template)
+            desc["name"]=out
             desc['comment']=desc['comment'].replace(" ","_")
             t.addcols(desc)
-        t.putcol(out_colname,d)
-        t.close()
-
-def substract_vis(mslist=None,colname_a="CORRECTED_DATA",colname_b="DATA_SUB",out_colname="DATA_SUB"):
-    from pyrap.tables import table
+    nrow=t.nrows()
+    if rowchunk is None:
+        rowchunk=max(1,2**22//int(np.prod(t.getcell(inputs[0],0).shape)))
+    numexpr.set_num_threads(max(1,ncpu))
+    for row0 in range(0,nrow,rowchunk):
+        n=min(rowchunk,nrow-row0)
+        blocks=dict([(name,t.getcol(name,row0,n)) for name in inputs])
+        for name,it in sources.items():
+            blocks[name]=next(it)
+        for out,rhs,names,template in parsed:
+            dtype=blocks[template].dtype if template in blocks else None
+            blocks[out]=np.asarray(evaluate_column_expression(rhs,dict([(name,blocks[name]) for name in names])),dtype=dtype)
+        for out in outputs:
+            t.putcol(out,blocks[out],row0,n)
+    t.close()
+
+def combine_vis(mslist,expressions,ncpu=1):
+    """Runs combine_columns over the measurement sets listed in the file mslist"""
     f=file(mslist)
-    mslist=f.readlines()
-    mslist=[msname.replace("\n","") for msname in mslist]
+    mslist=[msname.replace("\n","") for msname in f.readlines() if msname.strip()]
+    if isinstance(expressions,str):
+        expressions=[expressions]
     for msname in mslist:
-        report('Subtracting: %s = %s - %s'%(out_colname,colname_a,colname_b))
-        t=table(msname,readonly=False)
-        d=t.getcol(colname_a)
-        p=t.getcol(colname_b)
-        d-=p
-        if out_colname not in t.colnames():
-            report('Adding column %s in %s'%(out_colname,msname))
-            desc=t.getcoldesc(colname_a)
-            desc["name"]=out_colname
-            desc['comment']=desc['comment'].replace(" ","_")
-            t.addcols(desc)
-        t.putcol(out_colname,d)
-        t.close()
-    
+        report('Combining columns of %s: %s'%(msname,'; '.join(expressions)))
+        combine_columns(msname,expressions,ncpu=ncpu)
+
+def add_vis(mslist=None,colname_a="CORRECTED_DATA",colname_b="MODEL_DATA",out_colname="MODEL_DATA",ncpu=1):
+    combine_vis(mslist,'%s = %s + %s'%(out_colname,colname_a,colname_b),ncpu=ncpu)
+
+def substract_vis(mslist=None,colname_a="CORRECTED_DATA",colname_b="DATA_SUB",out_colname="DATA_SUB",ncpu=1):
+    combine_vis(mslist,'%s = %s - %s'%(out_colname,colname_a,colname_b),ncpu=ncpu)
 
 def substractOuterSquare(o):
     NPixLarge=o['imsize']
@@ -123,7 +415,7 @@ def substractOuterSquare(o):
     if o['restart'] and os.path.isfile(FileHasSubstracted):
         warn('File %s already exists, skipping substract vis step'%FileHasSubstracted)
     else:
-        substract_vis(mslist=o['mslist'],colname_a=colname,colname_b="DATA_SUB",out_colname="DATA_SUB")
+        substract_vis(mslist=o['mslist'],colname_a=colname,colname_b="DATA_SUB",out_colname="DATA_SUB",ncpu=o['NCPU_DDF'])
         os.system("touch %s"%FileHasSubstracted)
 
 
@@ -197,7 +489,7 @@ def ddf_shift(imagename,shiftfile,catcher=None,options=None,verbose=False):
          run(runcommand,dryrun=options['dryrun'],log=logfilename('DDF-'+imagename+'_shift.log',options=options),quiet=options['quiet'])
 
 
-def ddf_image(imagename,mslist,cleanmask=None,cleanmode='HMP',ddsols=None,applysols=None,threshold=None,majorcycles=3,use_dicomodel=False,robust=0,beamsize=None,beamsize_minor=None,beamsize_pa=None,reuse_psf=False,reuse_dirty=False,verbose=False,saveimages=None,imsize=None,cellsize=None,uvrange=None,colname='CORRECTED_DATA',peakfactor=0.1,dicomodel_base=None,options=None,do_decorr=None,normalization=None,dirty_from_resid=False,clusterfile=None,HMPsize=None,automask=True,automask_threshold=10.0,smooth=False,noweights=False,cubemode=False,apply_weights=True,catcher=None,rms_factor=3.0):
+def ddf_image(imagename,mslist,cleanmask=None,cleanmode='HMP',ddsols=None,applysols=None,threshold=None,majorcycles=3,use_dicomodel=False,robust=0,beamsize=None,beamsize_minor=None,beamsize_pa=None,reuse_psf=False,reuse_dirty=False,verbose=False,saveimages=None,imsize=None,cellsize=None,uvrange=None,colname='CORRECTED_DATA',peakfactor=0.1,dicomodel_base=None,options=None,do_decorr=None,normalization=None,dirty_from_resid=False,clusterfile=None,HMPsize=None,automask=True,automask_threshold=10.0,smooth=False,noweights=False,cubemode=False,apply_weights=True,catcher=None,rms_factor=3.0,sparsify=None,sparsify_mode='Stratified',sparsify_seed=0):
 
     if catcher: catcher.check()
 
@@ -296,6 +588,10 @@ def ddf_image(imagename,mslist,cleanmask=None,cleanmode='HMP',ddsols=None,applys
     if smooth:
         runcommand += ' --Beam-Smooth=1'
 
+    if sparsify is not None:
+        # quick-look imaging: grid a subset of the data
+        runcommand += ' --Comp-Sparsification=[%g] --Comp-SparsificationMode=%s --Comp-SparsificationSeed=%i' % (sparsify,sparsify_mode,sparsify_seed)
+
     if options['restart'] and os.path.isfile(fname):
         warn('File '+fname+' already exists, skipping DDF step')
         if verbose:
@@ -535,9 +831,8 @@ if __name__=='__main__':
 
         ddf_image('image_predict_check',o['mslist'],imsize=ori_imsize,cleanmask=None,cleanmode='SSD',majorcycles=0,robust=o['image_robust'],reuse_psf=False,reuse_dirty=False,peakfactor=0.05,colname=colname,clusterfile=None,apply_weights=o['apply_weights'][0],uvrange=uvrange,catcher=None)
 
-    if o['sim_skymodel'] and o['predict_parset'] and not o['redofrom']:
-        add_model(o)
-        add_vis(o['mslist'],colname,"SIM_SKYMODEL","MODEL_DATA")
+    if o['sim_skymodel'] and not o['redofrom']:
+        add_model(o,colname,"MODEL_DATA")
         o['colname'] = "MODEL_DATA"
         colname = "MODEL_DATA"
 
@@ -586,13 +881,17 @@ if __name__=='__main__':
         else:
             do_archive(o,alist)
 
-    ddf_image('image_dirin_SSD_init',o['mslist'],cleanmask=None,cleanmode='SSD',majorcycles=0,robust=o['image_robust'],reuse_psf=False,reuse_dirty=False,peakfactor=0.05,colname=colname,clusterfile=None,apply_weights=o['apply_weights'][0],uvrange=uvrange,catcher=catcher)
+    # the initial dirty image is only used to make the external mask, so it can be a sparsified quick-look image
+    preview_sparsify=o['preview_sparsify']
+    ddf_image('image_dirin_SSD_init',o['mslist'],cleanmask=None,cleanmode='SSD',majorcycles=0,robust=o['image_robust'],reuse_psf=False,reuse_dirty=False,peakfactor=0.05,colname=colname,clusterfile=None,apply_weights=o['apply_weights'][0],uvrange=uvrange,catcher=catcher,sparsify=preview_sparsify,sparsify_mode=o['preview_sparsify_mode'],sparsify_seed=o['preview_sparsify_seed'])
 
     external_mask='external_mask.fits'
     make_external_mask(external_mask,'image_dirin_SSD_init.dirty.fits',use_tgss=True,clobber=False)
     
     # Deep SSD clean with this external mask and automasking
-    ddf_image('image_dirin_SSD',o['mslist'],cleanmask=external_mask,cleanmode='SSD',majorcycles=4,robust=o['image_robust'],reuse_psf=True,reuse_dirty=True,peakfactor=0.05,colname=colname,clusterfile=None,automask=True,automask_threshold=o['thresholds'][0],apply_weights=o['apply_weights'][0],uvrange=uvrange,catcher=catcher)
+    # (a sparsified PSF and dirty image can't be reused)
+    reuse_init=preview_sparsify is None
+    ddf_image('image_dirin_SSD',o['mslist'],cleanmask=external_mask,cleanmode='SSD',majorcycles=4,robust=o['image_robust'],reuse_psf=reuse_init,reuse_dirty=reuse_init,peakfactor=0.05,colname=colname,clusterfile=None,automask=True,automask_threshold=o['thresholds'][0],apply_weights=o['apply_weights'][0],uvrange=uvrange,catcher=catcher)
 
     # make a mask from the final image
     make_mask('image_dirin_SSD.app.restored.fits',o['thresholds'][0],external_mask=external_mask,catcher=catcher)